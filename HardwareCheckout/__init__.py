@@ -11,6 +11,7 @@ from .terminals import terms as terminal_blueprint
 from .queue import queue as queue_blueprint
 from .device import device as device_blueprint
 from .admin import admin as admin_blueprint
+from .metrics import metrics as metrics_blueprint, log_request
 from .models import db
 
 # init SQLAlchemy so we can use it later in our models
@@ -48,6 +49,7 @@ def create_app():
             *(queue_blueprint.publish('/queue')),
             *(device_blueprint.publish('/device')),
             *(admin_blueprint.publish("/admin")),
+            *(metrics_blueprint.publish('/')),
         ],
         login_url="/login",
         cookie_secret=os.environ.get('TORNADO_SECRET_KEY', open(os.path.join(os.path.dirname(os.path.realpath(__file__)), "../cookie.key"),'r').read()),
@@ -57,7 +59,8 @@ def create_app():
         # xsrf_cookies=True,  #TODO
         websocket_ping_interval=10000,
         websocket_ping_timeout=30000,
-        default_handler_class=NotFoundHandler
+        default_handler_class=NotFoundHandler,
+        log_function=log_request,
     )
 
     return app
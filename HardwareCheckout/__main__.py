@@ -1,14 +1,39 @@
+import signal
+
 import tornado
 import tornado.options
 
 from . import create_app, create_redirect
 from .config import ssl_config
+from .eventbus import bus
+from .hashing import hasher
+from .leader import leadership
+from .metrics import registry
+from .migrations import migrate
+
+
+def run():
+    """
+    Serve until SIGTERM or SIGINT, then leave the event bus and give up the leader lock.
+    """
+    loop = tornado.ioloop.IOLoop.current()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda signum, frame: loop.add_callback_from_signal(loop.stop))
+    loop.start()
+    bus.stop()
+    leadership.stop()
+
 
 tornado.options.parse_command_line()
+migrate()
 if not ssl_config['certfile'] or not ssl_config['keyfile']:
     app = create_app()
     app.listen(8080)
-    tornado.ioloop.IOLoop.current().start()
+    hasher.start()
+    bus.start()
+    leadership.start()
+    registry.start()
+    run()
 
 else:
     httpApp = create_redirect()
@@ -21,7 +46,15 @@ else:
         "keyfile": ssl_config['keyfile'],
         })
     http_server.bind(443)
+    # every worker forked below has to agree on where the event bus and the lock file live,
+    # runtime_dir in config.py, see runtime.py
+    bus.prepare()
+    leadership.prepare()
     http_server.start(0)
+    hasher.start()
+    bus.start()
+    leadership.start()
+    registry.start()
     #app.listen(80)
-    tornado.ioloop.IOLoop.current().start()
+    run()
     
@@ -1,18 +1,30 @@
-from configparser import ConfigParser
+from asyncio import gather
 from functools import partial
 from contextlib import contextmanager
 from sqlalchemy import func
 from tornado.web import authenticated, MissingArgumentError, RequestHandler
-from werkzeug.security import generate_password_hash
-from tornado_sqlalchemy import SessionMixin, as_future
+from tornado_sqlalchemy import SessionMixin
 
-from .models import DeviceQueue, Role, DeviceType, User, UserQueue
+from .database import as_future
+from .models import DeviceQueue, Role, DeviceType, User, UserQueue, writer
 from .webutil import Blueprint, UserBaseHandler, make_session
-from .auth import PASSWORD_CRYPTO_TYPE
+from .hashing import hasher
+from .bulk import DEVICE_COLUMNS, USER_COLUMNS, BulkImportError, add_devices, add_users, passwords, read_rows
 from .device import DeviceStateHandler
+from .dispatch import dispatcher
+from .credentials import device_credentials, identities
+from .main import MainHandler
 
 admin = Blueprint()
 
+
+def restart_errors(results):
+    return '\n'.join(
+        "Restarting {} failed: {}".format(result.device, result.error or "exit code {}".format(result.code))
+        for result in results if not result.ok
+    )
+
+
 @admin.route('/', name="admin")
 class AdminHandler(UserBaseHandler):
     @authenticated
@@ -28,6 +40,12 @@ class AdminHandler(UserBaseHandler):
 
     @authenticated
     async def post(self):
+        # every operation below changes users, devices or sessions, none of them are for villagers
+        current_user = await self.get_identity()
+        if current_user is None or not current_user.has_roles("Admin"):
+            self.redirect(self.reverse_url("ROTerminals"))
+            return
+
         # Try and get the type parameter so we can decide what type of request this is
         try:
             req_type = self.get_argument("type")
@@ -39,6 +57,8 @@ class AdminHandler(UserBaseHandler):
             errors = await self.addDeviceType()
         elif req_type == "addDevice":
             errors = await self.addDevice()
+        elif req_type == "importUsers":
+            errors = await self.importUsers()
         elif req_type == "addAdmin":
             errors = await self.addAdmin()
         elif req_type == "changeDevicePassword":
@@ -49,6 +69,8 @@ class AdminHandler(UserBaseHandler):
             errors = await self.killSession()
         elif req_type == "toggleQueue":
             errors = await self.toggle_queue()
+        elif req_type == "killQueueSessions":
+            errors = await self.killQueueSessions()
 
         # update queues
         with self.make_session() as session:
@@ -67,45 +89,48 @@ class AdminHandler(UserBaseHandler):
             name = self.get_argument("name")
         except MissingArgumentError:
             return "Missing device type"
-        with self.make_session() as session:
-            await as_future(partial(session.add,DeviceType(name=name, enabled=1)))
+        await writer.submit(lambda session: session.add(DeviceType(name=name, enabled=1)))
+        MainHandler.invalidate("queues", "pictures")
         return ''
 
     async def addDevice(self):
         try:
             device_info = self.get_argument("device_info")
-            device_type = self.get_argument("device_type")
         except MissingArgumentError:
             return "Missing device type or config file info"
+        # rows may name their own type, the field is the default for those that do not
+        device_type = self.get_argument("device_type", None) or None
 
-        config = ConfigParser()
         try:
-            config.read_string(device_info)
-        except KeyError:
-            return "Error while trying to read the config file"
+            rows = read_rows(device_info, DEVICE_COLUMNS, self.get_argument("format", None) or None)
+        except BulkImportError as e:
+            return str(e)
+
+        # hash them all at once, the pool works through them in parallel
+        hashes = await gather(
+            *(hasher.generate(password, bounded=False) for password in passwords(rows)),
+            return_exceptions=True
+        )
+        added, errors = await writer.submit(partial(add_devices, rows=rows, hashes=hashes, default_type=device_type))
+        return '\n'.join(errors)
+
+    async def importUsers(self):
+        try:
+            user_info = self.get_argument("user_info")
+        except MissingArgumentError:
+            return "Missing user list"
 
-        error_msg = ''
-        with self.make_session() as session:
-            device_type_id = await as_future(session.query(DeviceType.id).filter_by(name=device_type).one)
-
-            for section in config.sections():
-                try:
-                    session.add(
-                        DeviceQueue(
-                            name=config[section]['username'],
-                            password=generate_password_hash(
-                                config[section]["password"],
-                                method=PASSWORD_CRYPTO_TYPE
-                            ),
-                            state="want-provision",
-                            type=device_type_id
-                        )
-                    )
-                except Exception as e:
-                    error_msg += str(e) + '\n'
-                    continue
-
-        return error_msg
+        try:
+            rows = read_rows(user_info, USER_COLUMNS, self.get_argument("format", None) or None)
+        except BulkImportError as e:
+            return str(e)
+
+        hashes = await gather(
+            *(hasher.generate(password, bounded=False) for password in passwords(rows)),
+            return_exceptions=True
+        )
+        added, errors = await writer.submit(partial(add_users, rows=rows, hashes=hashes))
+        return '\n'.join(errors)
 
     async def addAdmin(self):
         try:
@@ -114,30 +139,22 @@ class AdminHandler(UserBaseHandler):
         except MissingArgumentError:
             return "Missing username or password"
 
-        with self.make_session() as session:
-            try:
-                admin = await as_future(session.query(Role).filter_by(name="Admin").first)
-                human = await as_future(session.query(Role).filter_by(name="Human").first)
-                device = await as_future(session.query(Role).filter_by(name="Device").first)
-            except Exception:
-                return "Error while finding roles"
+        def add(session):
+            user = User(
+                name=username,
+                password=pwhash,
+                roles=session.query(Role).filter(Role.name.in_(["Admin", "Human", "Device"])).all()
+            )
+            session.add(user)
+            session.flush()
+            return user.id
 
-            try:
-                await as_future(
-                    partial(
-                        session.add,
-                        User(
-                            name=username,
-                            password=generate_password_hash(
-                                password,
-                                method=PASSWORD_CRYPTO_TYPE
-                            ),
-                            roles=[admin, human, device]
-                        )
-                    )
-                )
-            except Exception:
-                return "Error while attempting to add user"
+        try:
+            pwhash = await hasher.generate(password, bounded=False)
+            userID = await writer.submit(add)
+        except Exception:
+            return "Error while attempting to add user"
+        identities.invalidate(userID)
         return ""
 
     async def changeDevicePassword(self):
@@ -147,28 +164,38 @@ class AdminHandler(UserBaseHandler):
         except MissingArgumentError:
             return "Missing username or password"
 
-        with self.make_session() as session:
-            try:
-                device = await as_future(session.query(DeviceQueue).filter_by(name=username).one)
-                device.password = generate_password_hash(password, method=PASSWORD_CRYPTO_TYPE)
-            except Exception:
-                return "Error while updating password"
+        def change(session):
+            device = session.query(DeviceQueue).filter_by(name=username).one()
+            device.password = pwhash
+
+        try:
+            pwhash = await hasher.generate(password, bounded=False)
+            await writer.submit(change)
+        except Exception:
+            return "Error while updating password"
+        device_credentials.invalidate(username)
 
         return ""
 
     async def rmDevice(self):
         # TODO: is this safe to do? what are the implications if someone is connected?
         try:
-            device = self.get_argument("device")
+            name = self.get_argument("device")
         except MissingArgumentError:
             return "Missing device"
 
-        with self.make_session() as session:
-            try:
-                device = await as_future(session.query(DeviceQueue).filter_by(name=device).one)
-                await as_future(partial(session.delete,device))
-            except Exception:
-                return "Failed to remove device"
+        def remove(session):
+            device = session.query(DeviceQueue).filter_by(name=name).one()
+            session.delete(device)
+            return device.id
+
+        try:
+            deviceID = await writer.submit(remove)
+        except Exception:
+            return "Failed to remove device"
+        dispatcher.device_removed(deviceID)
+        device_credentials.invalidate(name)
+        MainHandler.invalidate("RWTerminals", "ROTerminals")
         return ""
 
     async def killSession(self):
@@ -183,7 +210,24 @@ class AdminHandler(UserBaseHandler):
             except Exception:
                 return "Error while looking up device"
 
-        await DeviceStateHandler.killSession(deviceID[0])
+        results = await DeviceStateHandler.killSession(deviceID[0])
+        return restart_errors(results)
+
+    async def killQueueSessions(self):
+        try:
+            queueID = self.get_argument("queue")
+        except MissingArgumentError:
+            return "Missing queue"
+
+        with self.make_session() as session:
+            devices = await as_future(
+                session.query(DeviceQueue.id)
+                .filter(DeviceQueue.type == queueID, DeviceQueue.state.in_(("in-queue", "in-use")))
+                .all
+            )
+        # one batch, the controllers restart them all at once
+        results = await DeviceStateHandler.killSessions([deviceID for deviceID, in devices])
+        return "Killed {} sessions\n{}".format(len(devices), restart_errors(results)).strip()
 
     async def toggle_queue(self):
         try:
@@ -191,11 +235,13 @@ class AdminHandler(UserBaseHandler):
         except MissingArgumentError:
             return "Missing Device name"
 
-        with self.make_session() as session:
-            try:
-                queue = await as_future(session.query(DeviceType).filter_by(id=queueID).one)
-            except Exception:
-                return "Failed to find that queue type"
-            
+        def toggle(session):
+            queue = session.query(DeviceType).filter_by(id=queueID).one()
             queue.enabled = 1 if not queue.enabled else 0
+
+        try:
+            await writer.submit(toggle)
+        except Exception:
+            return "Failed to find that queue type"
+        MainHandler.invalidate("queues", "pictures")
             
@@ -1,16 +1,16 @@
 from tornado.web import RequestHandler, MissingArgumentError, authenticated
-from werkzeug.security import generate_password_hash, check_password_hash
-from tornado_sqlalchemy import SessionMixin, as_future
+from tornado_sqlalchemy import SessionMixin
 from functools import partial
+from sqlalchemy.exc import IntegrityError
 
 
-from .models import User, Role, db
+from .database import as_future
+from .models import User, Role, db, writer
 from .webutil import Blueprint, UserBaseHandler
+from .hashing import hasher, HashingBusy, PASSWORD_CRYPTO_TYPE
 
 auth = Blueprint()
 
-PASSWORD_CRYPTO_TYPE="pbkdf2:sha256:45000"
-
 @auth.route("/login", name="login")
 class LoginHandler(UserBaseHandler):
     async def post(self):
@@ -38,8 +38,12 @@ class LoginHandler(UserBaseHandler):
             return self.render("login.html", messages="Invalid username or password")
 
         # Check if they provided the right password
-        if not userPass or not check_password_hash(userPass, password):
-            return self.render("login.html", messages="Invalid username or password")
+        try:
+            if not userPass or not await hasher.check(userPass, password):
+                return self.render("login.html", messages="Invalid username or password")
+        except HashingBusy:
+            self.set_status(503)
+            return self.render("login.html", messages="Too many people are logging in right now, please try again")
 
         # Successful login, they deserve a cookie
         self.set_secure_cookie("user", str(userId), expires_days=2)
@@ -87,19 +91,25 @@ class SignUpHandler(UserBaseHandler):
             if user:
                 return self.render("signup.html", messages="User name already exists")
 
-            # Get a copy of the human role
-            roles = await as_future(session.query(Role).filter_by(name="Human").first)
-
-            # Create the new user entry
-            new_user = User(
+        try:
+            pwhash = await hasher.generate(password)
+        except HashingBusy:
+            self.set_status(503)
+            return self.render("signup.html", messages="Too many people are signing up right now, please try again")
+
+        def add(session):
+            # Create the new user entry with a copy of the human role
+            session.add(User(
                 name=name,
-                password=generate_password_hash(password, method=PASSWORD_CRYPTO_TYPE),
+                password=pwhash,
                 ctf=ctf,
-                roles=[roles],
-            )
+                roles=[session.query(Role).filter_by(name="Human").first()],
+            ))
 
-            # add it to the db
-            session.add(new_user)
+        try:
+            await writer.submit(add)
+        except IntegrityError:
+            return self.render("signup.html", messages="User name already exists")
 
         return self.redirect(self.reverse_url("login"))
 
@@ -0,0 +1,189 @@
+"""
+Bulk import of devices and users, for addDevice.py, importUsers.py and the admin page.
+
+Rows come from INI (one section per row), CSV (with or without a header line)
+or JSON (a list of objects) and use the keys of DEVICE_COLUMNS or USER_COLUMNS.
+Passwords are hashed across a process pool before the database is touched.
+add_devices()/add_users() then check every row against the database with
+one query per lookup and insert all good rows with one bulk statement in
+the caller's transaction. A bad row is reported and skipped, it does not
+keep the others out.
+"""
+import csv
+import io
+import json
+import re
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from configparser import ConfigParser, Error as ConfigError
+from functools import partial
+
+from werkzeug.security import generate_password_hash
+
+from .hashing import PASSWORD_CRYPTO_TYPE
+from .models import DeviceQueue, DeviceType, Role, User, UserRoles
+
+FORMATS = ("ini", "csv", "json")
+
+# positional CSV columns, also the keys every other format uses
+DEVICE_COLUMNS = ("username", "password", "type")
+USER_COLUMNS = ("username", "password", "roles", "ctf")
+
+Row = namedtuple("Row", ["label", "fields"])
+
+
+class BulkImportError(Exception):
+    """
+    The input as a whole could not be read.
+    """
+
+
+def detect_format(text):
+    stripped = text.lstrip()
+    if stripped[:1] == "{" or re.match(r"\[\s*[\[{\]]", stripped):
+        return "json"
+    if re.search(r"^\s*\[[^\]]+\]\s*$", text, re.MULTILINE):
+        return "ini"
+    return "csv"
+
+
+def read_rows(text, columns, fmt=None):
+    """
+    Parse `text` into Rows with the keys in `columns`, guessing the format unless given.
+    """
+    fmt = fmt or detect_format(text)
+    if fmt == "ini":
+        config = ConfigParser(interpolation=None)
+        try:
+            config.read_string(text)
+        except ConfigError as e:
+            raise BulkImportError("Error while trying to read the config file: {}".format(e))
+        return [Row("section {}".format(section), dict(config[section])) for section in config.sections()]
+    if fmt == "csv":
+        lines = [line for line in csv.reader(io.StringIO(text)) if any(field.strip() for field in line)]
+        if lines and "password" in [field.strip().lower() for field in lines[0]]:
+            header, lines, first = [field.strip().lower() for field in lines[0]], lines[1:], 2
+        else:
+            header, first = columns, 1
+        return [
+            Row("line {}".format(number), {key: value.strip() for key, value in zip(header, line)})
+            for number, line in enumerate(lines, first)
+        ]
+    if fmt == "json":
+        try:
+            items = json.loads(text)
+        except ValueError as e:
+            raise BulkImportError("Error while trying to read the JSON: {}".format(e))
+        if isinstance(items, dict):
+            items = [items]
+        if not isinstance(items, list) or not all(isinstance(item, dict) for item in items):
+            raise BulkImportError("The JSON must be a list of objects")
+        return [Row("item {}".format(number), {key: str(value) for key, value in item.items()}) for number, item in enumerate(items, 1)]
+    raise BulkImportError("Unknown format {!r}, expected one of {}".format(fmt, ", ".join(FORMATS)))
+
+
+def passwords(rows):
+    return [row.fields.get("password", "") for row in rows]
+
+
+def hash_all(passwords, max_workers=None):
+    """
+    Blocking, for the command line. Hashes in a process pool and returns a
+    hash or the exception it raised for every password, like asyncio.gather(return_exceptions=True).
+    """
+    def hashed(future):
+        try:
+            return future.result()
+        except Exception as e:
+            return e
+
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        futures = [pool.submit(partial(generate_password_hash, password, method=PASSWORD_CRYPTO_TYPE)) for password in passwords]
+        return [hashed(future) for future in futures]
+
+
+def _check(rows, hashes, existing):
+    """
+    Returns (index, row, name, hash) for every row with a name and a password
+    whose name is neither taken nor repeated, and (index, error) for every other row.
+    """
+    errors = []
+    good = []
+    seen = set()
+    for index, (row, pwhash) in enumerate(zip(rows, hashes)):
+        name = row.fields.get("username") or row.fields.get("name")
+        if not name or not row.fields.get("password"):
+            errors.append((index, "{}: missing username or password".format(row.label)))
+        elif isinstance(pwhash, Exception):
+            errors.append((index, "{}: {}".format(row.label, pwhash)))
+        elif name in existing or name in seen:
+            errors.append((index, "{}: {} already exists".format(row.label, name)))
+        else:
+            seen.add(name)
+            good.append((index, row, name, pwhash))
+    return good, errors
+
+
+def add_devices(session, rows, hashes, default_type=None):
+    """
+    Insert a DeviceQueue entry waiting to be provisioned for every good row.
+    A row without a type gets `default_type`. Returns (added, errors).
+    """
+    names = [row.fields.get("username") or row.fields.get("name") for row in rows]
+    existing = set(name for name, in session.query(DeviceQueue.name).filter(DeviceQueue.name.in_([n for n in names if n]))) if rows else set()
+    types = dict(session.query(DeviceType.name, DeviceType.id).filter(
+        DeviceType.name.in_(set(row.fields.get("type") or default_type for row in rows))
+    )) if rows else {}
+
+    good, errors = _check(rows, hashes, existing)
+    values = []
+    for index, row, name, pwhash in good:
+        typeName = row.fields.get("type") or default_type
+        if typeName is None:
+            errors.append((index, "{}: no device type".format(row.label)))
+            continue
+        if typeName not in types:
+            errors.append((index, "{}: unknown device type {}".format(row.label, typeName)))
+            continue
+        values.append({"name": name, "password": pwhash, "state": "want-provision", "type": types[typeName]})
+    if values:
+        session.execute(DeviceQueue.__table__.insert(), values)
+    return len(values), [error for _, error in sorted(errors)]
+
+
+def add_users(session, rows, hashes, default_roles=("Human",)):
+    """
+    Insert a User for every good row with the roles it names, separated by
+    spaces or commas, or `default_roles`. Returns (added, errors).
+    """
+    names = [row.fields.get("username") or row.fields.get("name") for row in rows]
+    existing = set(name for name, in session.query(User.name).filter(User.name.in_([n for n in names if n]))) if rows else set()
+    roles = dict(session.query(Role.name, Role.id))
+
+    good, errors = _check(rows, hashes, existing)
+    values = []
+    wanted = {}
+    for index, row, name, pwhash in good:
+        roleNames = [role for role in re.split(r"[\s,]+", row.fields.get("roles") or " ".join(default_roles)) if role]
+        unknown = [role for role in roleNames if role not in roles]
+        if unknown:
+            errors.append((index, "{}: unknown roles {}".format(row.label, ", ".join(unknown))))
+            continue
+        try:
+            ctf = int(row.fields.get("ctf") or 0)
+        except ValueError:
+            errors.append((index, "{}: ctf must be 0 or 1".format(row.label)))
+            continue
+        values.append({"name": name, "password": pwhash, "ctf": ctf})
+        wanted[name] = [roles[role] for role in roleNames]
+    errors = [error for _, error in sorted(errors)]
+    if not values:
+        return 0, errors
+
+    session.execute(User.__table__.insert(), values)
+    # the names were checked to be new above, so they find exactly the rows just inserted
+    ids = session.query(User.name, User.id).filter(User.name.in_(list(wanted)))
+    links = [{"user_id": userID, "role_id": roleID} for name, userID in ids for roleID in wanted[name]]
+    if links:
+        session.execute(UserRoles.__table__.insert(), links)
+    return len(values), errors
@@ -0,0 +1,118 @@
+"""
+Commands for the tmate controllers (tmate/controller.py) and their acknowledgements.
+
+A controller socket may be held by any worker, so commands go out over the
+event bus. Every worker hands the ones for devices registered with it to
+their controller, all commands for one controller in a single frame:
+
+    {"type": "commands", "commands": [{"id": "4711-1", "type": "restart", "params": "device1"}, ...]}
+
+The controller answers right away with the ids it got, then runs the
+commands concurrently and acknowledges each one as it finishes, with its
+result and how long it took:
+
+    {"type": "received", "ids": ["4711-1", ...]}
+    {"type": "ack", "id": "4711-1", "ok": true, "code": 0, "error": null, "seconds": 0.02}
+
+The worker holding the socket publishes both on "device.ack", so whichever
+worker sent a command learns how it went. A command that is not acknowledged
+within `timeout` seconds was lost if it never got to a controller, and is
+slow if it did.
+
+The worker that writes a batch to a controller's socket also publishes which
+controller (the device it logged in as) got those ids. Only that
+controller's received and ack messages count, whichever socket they come in on
+after a reconnect, so nobody else can report a command done.
+"""
+import os
+from asyncio import wait
+from collections import namedtuple
+from itertools import count
+
+from tornado.concurrent import Future
+
+from .eventbus import bus
+from .metrics import controller_commands
+
+CommandResult = namedtuple("CommandResult", ["id", "device", "ok", "received", "code", "error", "seconds"])
+
+
+class CommandChannel:
+    def __init__(self, channel="device.controller", acks="device.ack", timeout=60):
+        self.channel = channel
+        self.acks = acks
+        self.timeout = timeout
+        self.pending = dict()  # id -> [device, Future of the CommandResult, received, controller it was sent to]
+        self.__ids = count(1)
+        bus.subscribe(acks, self.__on_ack)
+
+    async def send(self, kind, devices, timeout=None, fields=None):
+        """
+        Send a `kind` command for every device name in `devices` as one batch,
+        `fields` has a dict of extra fields for each command if given.
+        Returns a CommandResult for each device, in the same order, once all
+        of them were acknowledged or timed out.
+        """
+        commands = []
+        for device, extra in zip(devices, fields or [{}] * len(devices)):
+            # unique across workers, the acks reach all of them
+            commandID = "{}-{}".format(os.getpid(), next(self.__ids))
+            self.pending[commandID] = [device, Future(), False, None]
+            commands.append(dict(extra, id=commandID, device=device, type=kind, params=device))
+        if not commands:
+            return []
+
+        bus.publish(self.channel, {"commands": commands})
+        await wait([self.pending[command["id"]][1] for command in commands], timeout=timeout or self.timeout)
+
+        results = []
+        for command in commands:
+            device, future, received, _ = self.pending.pop(command["id"])
+            if future.done():
+                result = future.result()
+                outcome = "ok" if result.ok else "failed"
+            else:
+                error = "no acknowledgement" if received else "never reached a controller"
+                result = CommandResult(command["id"], device, False, received, None, error, None)
+                outcome = "slow" if received else "lost"
+            controller_commands.inc(type=kind, outcome=outcome)
+            results.append(result)
+        return results
+
+    def delivered(self, ids, controller):
+        """
+        Not async. Record that these commands were written to the socket of `controller`.
+        """
+        bus.publish(self.acks, {"type": "delivered", "ids": ids, "controller": controller})
+
+    def acknowledge(self, message, controller):
+        """
+        Not async. Pass on a received or ack message from `controller` to whoever sent the command.
+        """
+        bus.publish(self.acks, dict(message, controller=controller))
+
+    def __on_ack(self, message):
+        if message.get("type") == "delivered":
+            for commandID in message.get("ids", ()):
+                if commandID in self.pending and self.pending[commandID][3] is None:
+                    self.pending[commandID][3] = message["controller"]
+            return
+
+        if message.get("type") == "received":
+            for commandID in message.get("ids", ()):
+                if commandID in self.pending and self.pending[commandID][3] == message["controller"]:
+                    self.pending[commandID][2] = True
+            return
+
+        pending = self.pending.get(message.get("id"))
+        # sent by another worker, timed out already, or not the controller that got it
+        if pending is None or pending[1].done() or pending[3] != message["controller"]:
+            return
+        pending[2] = True
+        pending[1].set_result(CommandResult(
+            message["id"], pending[0], bool(message.get("ok")), True,
+            message.get("code"), message.get("error"), message.get("seconds"),
+        ))
+
+
+commands = CommandChannel()
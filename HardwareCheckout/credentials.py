@@ -0,0 +1,118 @@
+import hashlib
+import hmac
+import os
+from collections import OrderedDict, defaultdict
+from time import monotonic
+
+from .eventbus import bus
+
+
+class CredentialCache:
+    """
+    Remembers credentials that already passed the PBKDF2 check.
+
+    Entries are keyed on an HMAC of the presented name and password under a
+    per-process random key, so neither the password nor anything that can be
+    brute forced offline ends up in memory. Bounded LRU with a TTL, and
+    invalidated by name on every worker when a password changes.
+    """
+
+    def __init__(self, channel, size=1024, ttl=300):
+        self.size = size
+        self.ttl = ttl
+        self.channel = channel
+        self.entries = OrderedDict()  # digest -> (expires, name, value)
+        self.names = defaultdict(set)  # name -> digests
+        self.hits = 0
+        self.misses = 0
+        self.__key = os.urandom(32)
+        bus.subscribe(channel, self.__on_invalidate)
+
+    def digest(self, name, password):
+        return hmac.new(self.__key, "{}\0{}".format(name, password).encode(), hashlib.sha256).digest()
+
+    def get(self, name, password):
+        digest = self.digest(name, password)
+        entry = self.entries.get(digest, None)
+        if entry is None or entry[0] < monotonic():
+            if entry is not None:
+                self.__drop(digest)
+            self.misses += 1
+            return None
+        self.entries.move_to_end(digest)
+        self.hits += 1
+        return entry[2]
+
+    def put(self, name, password, value):
+        digest = self.digest(name, password)
+        self.entries[digest] = (monotonic() + self.ttl, name, value)
+        self.entries.move_to_end(digest)
+        self.names[name].add(digest)
+        while len(self.entries) > self.size:
+            self.__drop(next(iter(self.entries)))
+
+    def invalidate(self, name):
+        """
+        Forget every cached credential for `name`, in all workers.
+        """
+        bus.publish(self.channel, name)
+
+    def __on_invalidate(self, name):
+        for digest in list(self.names.get(name, ())):
+            self.__drop(digest)
+
+    def __drop(self, digest):
+        _, name, _ = self.entries.pop(digest)
+        self.names[name].discard(digest)
+        if not self.names[name]:
+            del self.names[name]
+
+
+
+
+class IdentityCache:
+    """
+    What handlers need to know about a logged in user, by user id, so a page
+    view does not load the User row and its roles just to tell admins apart.
+    Bounded LRU with a TTL, and invalidated by id on every worker when a
+    user's roles change.
+    """
+
+    def __init__(self, channel, size=4096, ttl=300):
+        self.size = size
+        self.ttl = ttl
+        self.channel = channel
+        self.entries = OrderedDict()  # user id -> (expires, value)
+        self.hits = 0
+        self.misses = 0
+        bus.subscribe(channel, self.__on_invalidate)
+
+    def get(self, userID):
+        entry = self.entries.get(userID, None)
+        if entry is None or entry[0] < monotonic():
+            if entry is not None:
+                del self.entries[userID]
+            self.misses += 1
+            return None
+        self.entries.move_to_end(userID)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, userID, value):
+        self.entries[userID] = (monotonic() + self.ttl, value)
+        self.entries.move_to_end(userID)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, userID):
+        """
+        Forget the cached identity of `userID`, in all workers.
+        """
+        bus.publish(self.channel, userID)
+
+    def __on_invalidate(self, userID):
+        self.entries.pop(userID, None)
+
+
+device_credentials = CredentialCache("credentials.device")
+identities = IdentityCache("credentials.identity")
@@ -0,0 +1,252 @@
+"""
+Runs the blocking SQLAlchemy calls made by the handlers.
+
+SQLAlchemy 1.3, as pinned in requirements.txt, has no asyncio engine, so every
+query is a blocking call that runs on a ThreadPoolExecutor of `db_threads`
+threads (in config.py), one hop per call. Running the queries on the IOLoop
+thread is not an option, a locked SQLite database would stall the whole worker
+for up to the busy timeout.
+
+`as_future(callable)` is a drop-in for tornado_sqlalchemy.as_future. The
+query runs in the caller's context, so `statement_origin` tells the slow query
+log which handler a statement came from even when a pool thread runs it.
+Statements slower than `slow_query_ms` in config.py (or HWC_SLOW_QUERY_MS, 100 by default) are logged.
+
+SQLite gets an engine profile of its own (see Database) and every write goes
+through `Writer.submit()`, which batches them into as few transactions as possible.
+"""
+import os
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import ContextVar, copy_context
+from functools import partial
+from time import perf_counter
+
+from sqlalchemy import event
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import QueuePool
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+from tornado.queues import Queue
+from tornado_sqlalchemy import SQLAlchemy
+
+from . import config
+
+# "<method> <route>" of the request being handled, set by the handler base classes
+statement_origin = ContextVar("statement_origin", default=None)
+
+
+class QueryRunner:
+    def __init__(self, max_workers=None):
+        self.max_workers = max_workers or min(32, (os.cpu_count() or 1) + 4)
+        self.pending = 0
+        self.__pool = None
+        self.__pid = None
+
+    @property
+    def pool(self):
+        # threads do not survive fork(), every worker starts its own
+        if self.__pool is None or self.__pid != os.getpid():
+            self.__pool = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="db")
+            self.__pid = os.getpid()
+        return self.__pool
+
+    def as_future(self, query):
+        self.pending += 1
+        future = IOLoop.current().run_in_executor(self.pool, copy_context().run, query)
+        future.add_done_callback(self.__done)
+        return future
+
+    def __done(self, future):
+        self.pending -= 1
+
+
+runner = QueryRunner(getattr(config, "db_threads", None))
+
+as_future = runner.as_future
+
+
+class SlowQueryLog:
+    """
+    Prints every statement that takes longer than `threshold` seconds, and where it came from.
+    """
+
+    def __init__(self, threshold):
+        self.threshold = threshold
+        self.count = 0
+
+    def attach(self, engine):
+        event.listen(engine, "before_cursor_execute", self.__before)
+        event.listen(engine, "after_cursor_execute", self.__after)
+        event.listen(engine, "handle_error", self.__error)
+
+    @staticmethod
+    def __before(connection, cursor, statement, parameters, context, executemany):
+        connection.info.setdefault("query_start", []).append(perf_counter())
+        if context is not None:
+            context.slow_query_timed = True
+
+    @staticmethod
+    def __error(context):
+        # a failed statement never gets to after_cursor_execute, its start would stay on the pooled connection
+        if getattr(context.execution_context, "slow_query_timed", False):
+            context.connection.info["query_start"].pop()
+
+    def __after(self, connection, cursor, statement, parameters, context, executemany):
+        elapsed = perf_counter() - connection.info["query_start"].pop()
+        if elapsed < self.threshold:
+            return
+        self.count += 1
+        print("Slow query, {:.1f} ms for {}: {}".format(
+            elapsed * 1000, statement_origin.get() or "background task", " ".join(statement.split())[:500]
+        ))
+
+
+slow_queries = SlowQueryLog(float(os.environ.get("HWC_SLOW_QUERY_MS", getattr(config, "slow_query_ms", 100))) / 1000)
+
+
+class Database(SQLAlchemy):
+    """
+    tornado_sqlalchemy's SQLAlchemy, except that a SQLite URL gets an engine
+    profile for a file shared by every worker instead of the server pool settings:
+
+    - WAL, so readers never wait for the writer, with synchronous=NORMAL,
+      which is durable enough in WAL mode and skips an fsync per commit
+    - a busy timeout, so a locked database is waited on instead of failing
+    - a pool of as many connections as there are executor threads. It is
+      allowed to overflow, connections are cheap and a checkout must never wait
+    - transactions opened by the driver only when SQLAlchemy begins one, so
+      writer sessions can start with BEGIN IMMEDIATE and take the write lock up
+      front instead of failing to upgrade a read lock later on
+    """
+
+    busy_timeout = 30
+
+    def configure(self, url=None, binds=None, session_options=None, engine_options=None):
+        if url is not None and make_url(url).drivername.startswith("sqlite"):
+            engine_options = self.sqlite_engine_options(url, engine_options)
+        super().configure(url=url, binds=binds, session_options=session_options, engine_options=engine_options)
+
+    def sqlite_engine_options(self, url, engine_options=None):
+        connect_args = dict((engine_options or {}).get("connect_args", {}))
+        connect_args.update(check_same_thread=False, timeout=self.busy_timeout, isolation_level=None)
+        options = {"connect_args": connect_args}
+        if make_url(url).database not in (None, "", ":memory:"):
+            options.update(poolclass=QueuePool, pool_size=runner.max_workers, max_overflow=-1)
+        return options
+
+    def create_engine(self, bind=None):
+        engine = super().create_engine(bind)
+        slow_queries.attach(engine)
+        if engine.dialect.name == "sqlite":
+            event.listen(engine, "connect", self.__sqlite_connect)
+            event.listen(engine, "begin", self.__sqlite_begin)
+        return engine
+
+    @staticmethod
+    def __sqlite_connect(connection, record):
+        cursor = connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute("PRAGMA busy_timeout={}".format(Database.busy_timeout * 1000))
+        cursor.close()
+
+    @staticmethod
+    def __sqlite_begin(connection):
+        connection.execute("BEGIN " + connection.get_execution_options().get("sqlite_begin", "DEFERRED"))
+
+
+class Writer:
+    """
+    Applies writes for one worker.
+
+    `await writer.submit(job)` runs `job(session)` and returns what it returns.
+    On SQLite every job goes to a single task that takes all jobs queued up
+    while the previous commit ran, runs each in a savepoint of one
+    BEGIN IMMEDIATE transaction and commits them together, so a burst of writes
+    costs one lock and one commit. A failing job only rolls back its own
+    savepoint. Other databases can handle concurrent writers, there each job
+    gets a session of its own.
+
+    Jobs run off the IOLoop and must not touch ORM objects from other
+    sessions. Return plain values, the session is closed when the batch is done.
+    """
+
+    def __init__(self, db, max_batch=64):
+        self.db = db
+        self.max_batch = max_batch
+        self.batches = 0
+        self.jobs = 0
+        self.__queue = None
+        self.__pool = None
+        self.__pid = None
+
+    @property
+    def pending(self):
+        """
+        Jobs queued up behind the batch that is running, only ever non-zero on SQLite.
+        """
+        if self.__queue is None or self.__pid != os.getpid():
+            return 0
+        return self.__queue.qsize()
+
+    @property
+    def batching(self):
+        return self.db.engine.dialect.name == "sqlite"
+
+    async def submit(self, job):
+        if not self.batching:
+            result, error = (await as_future(partial(self.apply, [job])))[0]
+            if error is not None:
+                raise error
+            return result
+
+        if self.__pid != os.getpid():
+            # neither the queue nor the thread survive fork()
+            self.__queue = Queue()
+            self.__pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer")
+            self.__pid = os.getpid()
+            IOLoop.current().spawn_callback(self.__drain, self.__queue)
+        future = Future()
+        # the job runs in the submitter's context, so its statements are logged as theirs
+        self.__queue.put_nowait((partial(copy_context().run, job), future))
+        return await future
+
+    def apply(self, jobs):
+        """
+        Blocking. Runs the jobs in one transaction, returns a (result, exception) pair for each.
+        """
+        bind = self.db.engine.execution_options(sqlite_begin="IMMEDIATE")
+        session = self.db.sessionmaker(bind=bind, binds={}, expire_on_commit=False)
+        results = []
+        try:
+            for job in jobs:
+                try:
+                    with session.begin_nested():
+                        results.append((job(session), None))
+                except Exception as e:
+                    results.append((None, e))
+            session.commit()
+        except Exception as e:
+            session.rollback()
+            results = [(None, e)] * len(jobs)
+        finally:
+            session.close()
+        return results
+
+    async def __drain(self, queue):
+        while True:
+            batch = [await queue.get()]
+            while len(batch) < self.max_batch and queue.qsize():
+                batch.append(queue.get_nowait())
+            apply = partial(self.apply, [job for job, _ in batch])
+            try:
+                results = await IOLoop.current().run_in_executor(self.__pool, apply)
+            except Exception as e:
+                results = [(None, e)] * len(batch)
+            self.batches += 1
+            self.jobs += len(batch)
+            for (_, future), (result, error) in zip(batch, results):
+                if error is None:
+                    future.set_result(result)
+                else:
+                    future.set_exception(error)
@@ -18,30 +18,89 @@ Other states
   * provision-failed - provision script failed (non-zero exit code)
   * deprovision-failed - deprovision script failed (non-zero exit code)
   * disabled - device disabled by admin
+
+Spare sessions
+A device can run a second tmate session (spare@.service) as a user of its own,
+that the villager holding the device cannot reach. When it registers while the
+device already has a live session, its tokens are kept in the spare columns.
+When the device is returned or its session closes, the spare takes over in one
+UPDATE and the device goes to handing-over. The controller resets the spare
+user's home and ends the old session, then the device is provisioned and
+handed out. The old session's unit starts the next spare. A device whose
+controller did not confirm both stays handing-over. When the old session's unit
+registers its next session, the old one is gone and the hand-over is tried again.
+  * handing-over - the spare took over, waiting for the controller
 """
 
+from asyncio import gather
 from base64 import b64decode
+from collections import defaultdict, namedtuple
 from datetime import datetime, timedelta
 from functools import wraps, partial
+from time import time
 
 from tornado.web import authenticated
-from tornado.escape import json_decode
+from tornado.escape import json_decode, json_encode
 from tornado.ioloop import IOLoop
+from tornado.websocket import WebSocketClosedError
+from sqlalchemy import or_
 from sqlalchemy.orm.exc import NoResultFound
-from tornado_sqlalchemy import as_future
-from werkzeug.security import check_password_hash
 
-from .models import DeviceQueue, DeviceType, UserQueue, User
-from .webutil import Blueprint, UserBaseHandler, DeviceWSHandler, Timer, make_session
+from .database import as_future
+from .models import DeviceQueue, DeviceType, UserQueue, User, writer
+from .webutil import Blueprint, UserBaseHandler, DeviceWSHandler, make_session, check_device_credentials
 from .queue import QueueWSHandler, on_user_assigned_device, on_user_deallocated_device
+from .commands import commands
+from .dispatch import dispatcher
+from .main import MainHandler
+from .eventbus import bus
+from .timeouts import timeouts
+from .metrics import controller_sockets, device_returns, observe_request, session_seconds
 
 device = Blueprint()
 
+SESSION_TIMEOUT = 1800
+
+# a session registering while the device is in one of these has to wait as its spare
+LIVE_STATES = ("provisioned", "in-queue", "in-use", "handing-over")
+# how long hand_over() waits for the controller to confirm
+HAND_OVER_TIMEOUT = 5
+
+Promoted = namedtuple("Promoted", ["type", "entity", "sshAddr"])
+
+
+def promote_spare(session, deviceID):
+    """
+    Make the spare session of a device its session, in the caller's transaction.
+    The device is handing-over until hand_over() is done with it. Returns the
+    device's Promoted, None if it has no spare.
+    """
+    device = session.query(
+        DeviceQueue.type, DeviceQueue.spareEntity, DeviceQueue.spareSshAddr, DeviceQueue.spareWebUrl, DeviceQueue.spareRoUrl
+    ).filter_by(id=deviceID).first()
+    if device is None or device.spareEntity is None:
+        return None
+    session.query(DeviceQueue).filter_by(id=deviceID).update(
+        {
+            "entity_id": device.spareEntity,
+            "sshAddr": device.spareSshAddr,
+            "webUrl": device.spareWebUrl,
+            "roUrl": device.spareRoUrl,
+            "state": "handing-over",
+            "owner": None,
+            "spareEntity": None,
+            "spareSshAddr": None,
+            "spareWebUrl": None,
+            "spareRoUrl": None,
+        },
+        synchronize_session=False,
+    )
+    return Promoted(device.type, device.spareEntity, device.spareSshAddr)
+
 
 @device.route("/hook")
 class DeviceStateHandler(UserBaseHandler):
-    __timer = None
-    __timer_dict = dict()
+    sessions = {}  # deviceID -> when its session went in use, known to every worker
 
     def get(self):
         # send them home
@@ -49,11 +108,6 @@ class DeviceStateHandler(UserBaseHandler):
         return
 
     async def post(self):
-        # if there is no timer, start one
-        if self.__class__.__timer is None:
-            self.__class__.__timer = Timer(self.__class__.__callback, True)
-            self.__class__.__timer.start()
-
         try:
             data = json_decode(self.request.body)
         except Exception:
@@ -82,191 +136,228 @@ class DeviceStateHandler(UserBaseHandler):
         except Exception:
             return
 
-        # Checks the db to see if this is valid user data
-        with self.make_session() as session:
-            try:
-                device = await as_future(
-                    session.query(DeviceQueue).filter_by(name=username).one
-                )
-            except Exception:
-                return
-
-            if not check_password_hash(device.password, password):
-                return
-
-            # register entity id with db and update ssh/web/webro info
-            ssh_fmt = params.get("ssh_cmd_fmt", None)
-            web_fmt = params.get("web_url_fmt", None)
-            stoken = params.get("stoken", None)
-            stoken_ro = params.get("stoken_ro", None)
-            if not ssh_fmt or not web_fmt or not stoken or not stoken_ro:
-                return
+        # Checks to see if this is valid user data
+        device = await check_device_credentials(username, password)
+        if device is None:
+            return
 
-            device.sshAddr = ssh_fmt % stoken
-            device.webUrl = web_fmt % stoken
-            device.roUrl = web_fmt % stoken_ro
-            device.state = "provisioned"
-            device.entity_id = entity
-            session.add(device)
+        # register entity id with db and update ssh/web/webro info
+        ssh_fmt = params.get("ssh_cmd_fmt", None)
+        web_fmt = params.get("web_url_fmt", None)
+        stoken = params.get("stoken", None)
+        stoken_ro = params.get("stoken_ro", None)
+        if not ssh_fmt or not web_fmt or not stoken or not stoken_ro:
+            return
 
-            deviceID = device.id
-            deviceType = device.type
+        def register(session):
+            current = session.query(DeviceQueue.state, DeviceQueue.entity_id, DeviceQueue.name, DeviceQueue.sshAddr).filter_by(id=device.id).one()
+            if current.entity_id not in (None, entity) and current.state in LIVE_STATES:
+                # the device has a working session, this one takes over when that one is done
+                session.query(DeviceQueue).filter_by(id=device.id).update(
+                    {
+                        "spareSshAddr": ssh_fmt % stoken,
+                        "spareWebUrl": web_fmt % stoken,
+                        "spareRoUrl": web_fmt % stoken_ro,
+                        "spareEntity": entity,
+                    },
+                    synchronize_session=False,
+                )
+                return current
+            session.query(DeviceQueue).filter_by(id=device.id).update(
+                {
+                    "sshAddr": ssh_fmt % stoken,
+                    "webUrl": web_fmt % stoken,
+                    "roUrl": web_fmt % stoken_ro,
+                    "state": "provisioned",
+                    "entity_id": entity,
+                },
+                synchronize_session=False,
+            )
+            return None
 
-        # await DeviceStateHandler.check_for_new_owner(deviceID, deviceType)
+        waiting = await writer.submit(register)
+        if waiting is None:
+            dispatcher.device_ready(device.id, device.type)
+        elif waiting.state == "handing-over":
+            # Its controller never confirmed the hand-over. The session it was
+            # waiting on is gone, its unit started this one, so only the home is left to reset.
+            promoted = Promoted(device.type, waiting.entity_id, waiting.sshAddr)
+            IOLoop.current().spawn_callback(self.hand_over, [(device.id, waiting.name, None, promoted)], True)
 
     async def handle_session_join(self, entity, user_data, params):
         # Check if it is a read only session. We only care about R/W sessions
         if params.get("readonly", True):
             return
 
-        with make_session() as session:
-            try:
-                device = await as_future(
-                    session.query(DeviceQueue).filter_by(entity_id=entity).one
-                )
-            except Exception:
-                return
+        def start_use(session):
+            device = session.query(DeviceQueue.id, DeviceQueue.state).filter_by(entity_id=entity).first()
+            if device is None or device.state == "in-use":
+                return None
+            session.query(DeviceQueue).filter_by(id=device.id).update({"state": "in-use"}, synchronize_session=False)
+            return device.id
 
-            if device.state != "in-use":
-                device.state = "in-use"
-                session.add(device)
-                await self.device_in_use(device.id)
+        deviceID = await writer.submit(start_use)
+        if deviceID is None:
+            return
+        bus.publish("device.session", {"device": deviceID, "started": time()})
+        await self.device_in_use(deviceID)
+        MainHandler.invalidate("RWTerminals", "ROTerminals")
 
     async def handle_session_close(self, entity, user_data, params):
         # Technically there could be a race condition where the close message comes after the next start message.
         # In that case it is ok since the entity ID should have been updated before then.
-        with make_session() as session:
-            try:
-                device = await as_future(
-                    session.query(DeviceQueue).filter_by(entity_id=entity).one
+        def deprovision(session):
+            device = (
+                session.query(DeviceQueue.id, DeviceQueue.name, DeviceQueue.sshAddr, DeviceQueue.spareEntity)
+                .filter(or_(DeviceQueue.entity_id == entity, DeviceQueue.spareEntity == entity))
+                .first()
+            )
+            if device is None:
+                return None
+            if device.spareEntity == entity:
+                # only the spare went away, its unit starts another one
+                session.query(DeviceQueue).filter_by(id=device.id).update(
+                    {"spareEntity": None, "spareSshAddr": None, "spareWebUrl": None, "spareRoUrl": None},
+                    synchronize_session=False,
                 )
-            except Exception:
-                return
+                return None
+            promoted = promote_spare(session, device.id)
+            if promoted is None:
+                # TODO should I null more fields?
+                session.query(DeviceQueue).filter_by(id=device.id).update(
+                    {
+                        "state": "deprovisioned",
+                        "sshAddr": None,
+                        "webUrl": None,
+                        "roUrl": None,
+                        "entity_id": None,
+                        "owner": None,
+                    },
+                    synchronize_session=False,
+                )
+            return device.id, device.name, device.sshAddr, promoted
 
-            device.state = "deprovisioned"
-            device.sshAddr = None
-            device.webUrl = None
-            device.roUrl = None
-            device.entity_id = None
-            device.owner = None
-            # TODO should I null more fields?
-            session.add(device)
+        closed = await writer.submit(deprovision)
+        if closed is None:
+            return
+        deviceID, name, sshAddr, promoted = closed
+        self.end_session(deviceID)
+        # before the device can be handed out again, the next owner gets a timeout of their own
+        await timeouts.cancel(self.timeout_key(deviceID))
+        MainHandler.invalidate("RWTerminals", "ROTerminals")
+        if promoted is None:
+            dispatcher.device_removed(deviceID)
+        else:
+            # the old session's unit cleans up after it, without holding up tmate's webhook
+            IOLoop.current().spawn_callback(self.hand_over, [(deviceID, name, sshAddr, promoted)], True)
 
     @staticmethod
     async def deprovision_device(deviceID):
         raise NotImplementedError("TODO: this will tell the watcher to kill a session")
 
     @staticmethod
-    async def check_for_new_owner(deviceID, deviceType):
-        with make_session() as session:
-            next_user = await as_future(
-                session.query(UserQueue)
-                .filter_by(type=deviceType)
-                .order_by(UserQueue.id)
-                .first
-            )
-            if next_user:
-                session.delete(next_user)
-                session.commit()
-                return await DeviceStateHandler.device_in_queue(
-                    deviceID, next_user.userId
-                )
-
+    async def device_in_queue(claim):
+        # the dispatcher already marked the device in-queue and owned by the claiming user
+        await timeouts.arm(DeviceStateHandler.timeout_key(claim.id), SESSION_TIMEOUT, "return_device", claim.id, "queue_timeout")
+        on_user_assigned_device(claim.user, claim)
 
     @staticmethod
-    async def device_in_queue(deviceID, next_user):
-        with make_session() as session:
-            device = await as_future(session.query(DeviceQueue).filter_by(id=deviceID).first)
-            device.state = "in-queue"  # Set this to in queue so the callback doesn't try to hand it out again
-            device.owner = next_user
-            session.add(device)
-
-        timer = Timer(
-            DeviceStateHandler.return_device,
-            repeat=False,
-            timeout=1800,
-            args=[deviceID, "queue_timeout"],
-        )
-        timer.start()
-        try:
-            DeviceStateHandler.push_timer(deviceID, timer)
-        except KeyError:
-            old_timer = DeviceStateHandler.pop_timer(deviceID)
-            old_timer.stop()
-            del old_timer
-            DeviceStateHandler.push_timer(deviceID, timer)
+    async def return_device(deviceID, reason):
+        return await DeviceStateHandler.return_devices([deviceID], reason)
 
+    @staticmethod
+    async def return_devices(deviceIDs, reason):
+        """
+        Take the devices back from their users and have the controllers restart
+        them, all in one batch. Returns a CommandResult for each restart.
+        """
         with make_session() as session:
-            device = await as_future(
-                session.query(DeviceQueue).filter_by(id=deviceID).first
-            )
-            userID = await as_future(
-                session.query(User.id).filter_by(id=next_user).first
+            # read before the restart, the session_close it causes clears the owner
+            devices = await as_future(
+                session.query(DeviceQueue.id, DeviceQueue.owner, DeviceQueue.name, DeviceQueue.sshAddr)
+                .filter(DeviceQueue.id.in_(deviceIDs))
+                .all
             )
-            on_user_assigned_device(userID[0], device)
+        for deviceID, userID, _, _ in devices:
+            device_returns.inc(reason=reason)
+            DeviceStateHandler.end_session(deviceID)
+            if userID is not None:
+                on_user_deallocated_device(userID, deviceID, reason)
+
+        # a device with a spare session goes to the next user as soon as its controller is done
+        promoted = await writer.submit(lambda session: {device.id: promote_spare(session, device.id) for device in devices})
+        recycled, handed = await gather(
+            ControllerHandler.recycle([(device.name, device.sshAddr, None) for device in devices if promoted[device.id] is None]),
+            DeviceStateHandler.hand_over(
+                [(device.id, device.name, device.sshAddr, promoted[device.id]) for device in devices if promoted[device.id] is not None]
+            ),
+        )
+        return recycled + handed
 
     @staticmethod
-    async def return_device(deviceID, reason):
-        await ControllerHandler.restart_device(deviceID)
-        with make_session() as session:
-            userID = await as_future(
-                session.query(DeviceQueue.owner).filter_by(id=deviceID).one
-            )
-        on_user_deallocated_device(userID, deviceID, reason)
-        
+    async def hand_over(swaps, ended=False):
+        """
+        Finish promoting spare sessions. `swaps` has a (device id, name, sshAddr of
+        the old session, Promoted) for each device. The controllers reset the
+        promoted session's home and end the old one, unless it `ended` already.
+        Then every device whose controller confirmed that, and whose spare is
+        still its session, is handed out. Returns a CommandResult for each.
+        """
+        if not swaps:
+            return []
+        results = await ControllerHandler.recycle(
+            [(name, sshAddr, promoted.sshAddr) for _, name, sshAddr, promoted in swaps], ended=ended, timeout=HAND_OVER_TIMEOUT
+        )
+
+        def provision(session):
+            ready = []
+            for (deviceID, _, _, promoted), result in zip(swaps, results):
+                if not result.ok:
+                    # the old session may still be running, the next registration tries again
+                    continue
+                # the promoted session may have closed in the meantime
+                if session.query(DeviceQueue).filter_by(id=deviceID, entity_id=promoted.entity, state="handing-over").update(
+                    {"state": "provisioned"}, synchronize_session=False
+                ):
+                    ready.append((deviceID, promoted.type))
+            return ready
+
+        for deviceID, deviceType in await writer.submit(provision):
+            dispatcher.device_ready(deviceID, deviceType)
+        MainHandler.invalidate("RWTerminals", "ROTerminals")
+        return results
 
     @staticmethod
     async def device_in_use(deviceID):
-        timer = Timer(
-            DeviceStateHandler.return_device,
-            repeat=False,
-            timeout=1800,
-            args=[deviceID, "normal_timeout"],
-        )
-        timer.start()
-        try:
-            DeviceStateHandler.push_timer(deviceID, timer)
-        except KeyError:
-            old_timer = DeviceStateHandler.pop_timer(deviceID)
-            old_timer.stop()
-            del old_timer
-            DeviceStateHandler.push_timer(deviceID, timer)
+        await timeouts.arm(DeviceStateHandler.timeout_key(deviceID), SESSION_TIMEOUT, "return_device", deviceID, "normal_timeout")
 
     @staticmethod
     async def killSession(deviceID):
-        try:
-            timer = DeviceStateHandler.pop_timer(deviceID)
-            timer.stop()
-            del timer
-        except KeyError:
-            pass
-        await DeviceStateHandler.return_device(deviceID, "killed")
+        return await DeviceStateHandler.killSessions([deviceID])
 
-    @classmethod
-    def push_timer(cls, deviceID, timer):
-        """
-        not worth asyncing
-        """
-        if cls.__timer_dict.get(deviceID, False):
-            raise KeyError("device timer already registered")
-        cls.__timer_dict[deviceID] = timer
+    @staticmethod
+    async def killSessions(deviceIDs):
+        await gather(*(timeouts.cancel(DeviceStateHandler.timeout_key(deviceID)) for deviceID in deviceIDs))
+        return await DeviceStateHandler.return_devices(deviceIDs, "killed")
+
+    @staticmethod
+    def timeout_key(deviceID):
+        return "device:{}".format(deviceID)
 
     @classmethod
-    def pop_timer(cls, deviceID):
-        """
-        Not worth asyncing
-        """
-        return cls.__timer_dict.pop(deviceID)
+    def end_session(cls, deviceID):
+        started = cls.sessions.pop(deviceID, None)
+        if started is None:
+            return
+        session_seconds.observe(max(time() - started, 0))
+        bus.publish("device.session", {"device": deviceID, "started": None})
 
-    @staticmethod
-    async def __callback():
-        with make_session() as session:
-            for deviceID, deviceType in await as_future(
-                session.query(DeviceQueue.id, DeviceQueue.type)
-                .filter_by(state="provisioned")
-                .all
-            ):
-                await DeviceStateHandler.check_for_new_owner(deviceID, deviceType)
+    @classmethod
+    def on_session(cls, message):
+        if message["started"] is None:
+            cls.sessions.pop(message["device"], None)
+        else:
+            cls.sessions[message["device"]] = message["started"]
 
 
 @device.route("/controller")
@@ -274,12 +365,22 @@ class ControllerHandler(DeviceWSHandler):
     __listeners = {}
 
     async def open(self):
+        self.counted = True
+        controller_sockets.inc()
         # TODO : change this check to require a controller user name and password
         # not just any device.
         self.device = await self.check_authentication()
+        observe_request(self)
+        if not self.device:
+            # it could register any device, take its commands and acknowledge them
+            self.close(1008, "unauthorized")
+            return
         # self.__listeners[self.device] = self
 
     async def on_message(self, message):
+        if not self.device:
+            # frames sent before it saw us close the socket
+            return
         try:
             data = json_decode(message)
         except Exception:
@@ -297,16 +398,91 @@ class ControllerHandler(DeviceWSHandler):
                 self.__listeners[params] = self
             except Exception:
                 return
-
-    async def close(self):
-        self.__listeners.pop(self.device)
+        elif msg_type == "register_many":
+            # {"add": [...], "remove": [...], "replace": bool}, replace sends every device the controller has
+            if not isinstance(params, dict):
+                return
+            if params.get("replace", False):
+                self.unregister_all()
+            for name in params.get("add", ()):
+                if isinstance(name, str):
+                    self.__listeners[name] = self
+            for name in params.get("remove", ()):
+                if self.__listeners.get(name, None) is self:
+                    del self.__listeners[name]
+        elif msg_type in ("received", "ack"):
+            commands.acknowledge(data, self.device)
+
+    def on_close(self):
+        if getattr(self, "counted", False):
+            self.counted = False
+            controller_sockets.dec()
+        self.unregister_all()
+
+    def unregister_all(self):
+        for name in [name for name, listener in self.__listeners.items() if listener is self]:
+            del self.__listeners[name]
 
     @classmethod
     async def restart_device(cls, device):
+        results = await cls.restart_devices([device])
+        return bool(results) and results[0].ok
+
+    @classmethod
+    async def restart_devices(cls, devices):
+        """
+        Have the controllers kill the sessions of the devices, returns a CommandResult for each.
+        """
+        if not devices:
+            return []
         with make_session() as session:
-            deviceName = await as_future(session.query(DeviceQueue.name).filter_by(id=device).one)
-        try:
-            await cls.__listeners[deviceName[0]].write_message({"type":"restart", "params":deviceName[0]})
-        except Exception:
-            return False
-        return True
\ No newline at end of file
+            names = await as_future(session.query(DeviceQueue.name).filter(DeviceQueue.id.in_(devices)).all)
+        return cls.report(await commands.send("restart", [name for name, in names]))
+
+    @classmethod
+    async def recycle(cls, sessions, ended=False, timeout=None):
+        """
+        Have the controllers end tmate sessions and whatever their villagers
+        left running, but not the device's other session. `sessions` has a
+        (device name, sshAddr of the session, sshAddr of the spare that took over or None)
+        for each, the spare's home is reset. With `ended` the sessions are gone
+        already and only the homes are reset. Returns a CommandResult for each.
+        """
+        results = await commands.send(
+            "restart",
+            [name for name, _, _ in sessions],
+            timeout=timeout,
+            fields=[{"session": session, "keep": keep, "ended": ended} for _, session, keep in sessions],
+        )
+        return cls.report(results)
+
+    @staticmethod
+    def report(results):
+        for result in results:
+            if not result.ok:
+                print("Restarting {} failed: {}".format(result.device, result.error or "exit code {}".format(result.code)))
+        return results
+
+    @classmethod
+    def deliver(cls, envelope):
+        """
+        Send the commands for the devices registered here, one frame per controller.
+        """
+        batches = defaultdict(list)
+        for command in envelope["commands"]:
+            listener = cls.__listeners.get(command["device"], None)
+            if listener is not None:
+                batches[listener].append({key: value for key, value in command.items() if key != "device"})
+        for listener, batch in batches.items():
+            try:
+                listener.write_message(json_encode({"type": "commands", "commands": batch}))
+            except WebSocketClosedError:
+                # never received, the sender reports it lost once it times out
+                continue
+            commands.delivered([command["id"] for command in batch], listener.device)
+
+
+dispatcher.on_assign(DeviceStateHandler.device_in_queue)
+bus.subscribe("device.session", DeviceStateHandler.on_session)
+timeouts.register("return_device", DeviceStateHandler.return_device)
+bus.subscribe(commands.channel, ControllerHandler.deliver)
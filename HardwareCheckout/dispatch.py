@@ -0,0 +1,275 @@
+from collections import OrderedDict, defaultdict, namedtuple
+from functools import partial
+from time import time
+
+from tornado import locks
+from tornado.ioloop import IOLoop
+
+from .database import as_future
+from .eventbus import bus
+from .leader import leadership
+from .metrics import assignment_seconds
+from .models import DeviceQueue, DeviceType, UserQueue, writer
+from .positions import QueuePositions
+from .webutil import Timer, make_session
+
+
+class Unclaimed(Exception):
+    """
+    Rolls back a claim that only got one of the device and the queue entry.
+    """
+
+
+# everything on_user_assigned_device needs, so nothing is read back after the claim
+Claim = namedtuple("Claim", ["entry", "user", "id", "type", "typeName", "sshAddr", "webUrl"])
+
+
+def claim(session, deviceType):
+    """
+    Give the oldest waiter for `deviceType` the free device with the lowest id.
+
+    Runs in the caller's transaction, returns the Claim or None if nobody is
+    waiting or nothing is free. Postgres locks the two rows it picks and skips
+    rows other claims hold locked, so concurrent claims take different pairs
+    instead of queueing up behind each other. SQLite has a single writer, there
+    the state check in the UPDATE guards against a device claimed since the SELECT.
+    Either way a pair that cannot be taken whole raises Unclaimed.
+    """
+    entries = session.query(UserQueue.id, UserQueue.userId).filter_by(type=deviceType).order_by(UserQueue.id)
+    devices = (
+        session.query(DeviceQueue.id, DeviceQueue.sshAddr, DeviceQueue.webUrl, DeviceType.name.label("typeName"))
+        .join(DeviceType)
+        .filter(DeviceQueue.type == deviceType, DeviceQueue.state == "provisioned")
+        .order_by(DeviceQueue.id)
+    )
+    if session.get_bind().dialect.name == "postgresql":
+        entries = entries.with_for_update(skip_locked=True)
+        devices = devices.with_for_update(skip_locked=True, of=DeviceQueue)
+    entry = entries.first()
+    device = devices.first() if entry is not None else None
+    if device is None:
+        return None
+
+    claimed = session.query(DeviceQueue).filter_by(id=device.id, state="provisioned").update(
+        {"state": "in-queue", "owner": entry.userId},
+        synchronize_session=False,
+    )
+    taken = session.query(UserQueue).filter_by(id=entry.id).delete(synchronize_session=False)
+    if not claimed or not taken:
+        raise Unclaimed(claimed, taken)
+    return Claim(entry.id, entry.userId, device.id, deviceType, device.typeName, device.sshAddr, device.webUrl)
+
+
+class Dispatcher:
+    """
+    Hands provisioned devices to waiting users as soon as either side shows up.
+
+    Keeps a FIFO of waiting UserQueue entries and an ordered set of free
+    devices for every DeviceType, so a match never has to scan the tables.
+    Any worker can report events, they are only acted on by the elected leader.
+
+    The leader also knows everyone's place in line. Whenever an entry leaves a
+    queue it publishes one message on "queue.positions" naming the position
+    that was vacated, workers work out which of their users moved up. Workers
+    ask for the positions of the users they have connected in batches, which
+    the leader answers with one message each.
+
+    Every `reconcile_interval` seconds the leader reloads everything from the
+    database and dispatches again, so a user or device whose event never made
+    it here is not left waiting for the next election.
+    """
+
+    reconcile_interval = 60
+    positions_window = 0.1
+
+    def __init__(self):
+        self.waiting = defaultdict(OrderedDict)  # type -> {entryID: userID}
+        self.free = defaultdict(OrderedDict)  # type -> {deviceID: None}
+        self.positions = defaultdict(QueuePositions)  # type -> entries in line
+        self.queued = dict()  # (type, userID) -> entryID
+        self.joined = dict()  # entryID -> time it joined, for the ones that joined under this leader
+        self.loaded = False
+        self.lock = locks.Lock()
+        self.dispatching = defaultdict(locks.Lock)  # type -> held while claiming for it
+        self.requested = set()  # users to ask the leader about in the next batch
+        self.__assign = None
+        self.__reconciler = None
+        self.__request_handle = None
+        bus.subscribe("dispatch", self.__on_event)
+        leadership.on_elected(self.reload)
+        leadership.on_elected(self.start_reconciling)
+
+    def on_assign(self, callback):
+        """
+        Register the coroutine that is called with the Claim of every match.
+        """
+        self.__assign = callback
+
+    async def reload(self):
+        self.loaded = False
+        await self.load()
+
+    def start_reconciling(self):
+        if self.__reconciler is None:
+            self.__reconciler = Timer(self.reconcile, timeout=self.reconcile_interval)
+
+    async def reconcile(self):
+        self.loaded = False
+        await self.load(resync=False)
+
+    async def load(self, resync=True):
+        """
+        Pick up the current state from the database, only done once per election
+        and after the database disagreed with what was remembered. Workers are
+        told to ask for their users' positions again, unless `resync` is False
+        and nobody's place in line changed.
+        """
+        if self.loaded:
+            return
+        async with self.lock:
+            if self.loaded:
+                return
+            queued = dict(self.queued)
+            self.waiting.clear()
+            self.free.clear()
+            self.positions.clear()
+            self.queued.clear()
+            self.joined.clear()
+            with make_session() as session:
+                devices = await as_future(
+                    session.query(DeviceQueue.id, DeviceQueue.type)
+                    .filter_by(state="provisioned")
+                    .order_by(DeviceQueue.id)
+                    .all
+                )
+                entries = await as_future(
+                    session.query(UserQueue.id, UserQueue.userId, UserQueue.type)
+                    .order_by(UserQueue.id)
+                    .all
+                )
+            for deviceID, deviceType in devices:
+                self.free[deviceType][deviceID] = None
+            for entryID, userID, deviceType in entries:
+                self.__enqueue(deviceType, entryID, userID)
+            self.loaded = True
+            # a user who joined or left behind our back moved everyone behind them
+            resync = resync or queued != self.queued
+
+        if resync:
+            # whatever the workers knew came from the previous leader, or from what we missed
+            bus.publish("queue.positions", {"resync": True})
+
+        for deviceType in list(self.free):
+            await self.dispatch(deviceType)
+
+    def device_ready(self, deviceID, deviceType):
+        bus.publish("dispatch", {"event": "device_ready", "device": deviceID, "type": deviceType})
+
+    def user_joined(self, entryID, userID, deviceType):
+        bus.publish("dispatch", {"event": "user_joined", "entry": entryID, "user": userID, "type": deviceType, "at": time()})
+
+    def user_left(self, userID):
+        bus.publish("dispatch", {"event": "user_left", "user": userID})
+
+    def device_removed(self, deviceID):
+        bus.publish("dispatch", {"event": "device_removed", "device": deviceID})
+
+    def request_positions(self, *userIDs):
+        """
+        Ask the leader to publish where these users stand in every queue they
+        joined. Everything asked for within `positions_window` seconds goes out
+        as one message, so a reconnect storm does not turn into one per socket.
+        """
+        self.requested.update(userIDs)
+        if self.requested and self.__request_handle is None:
+            self.__request_handle = IOLoop.current().call_later(self.positions_window, self.__request_positions)
+
+    def __request_positions(self):
+        self.__request_handle = None
+        users, self.requested = list(self.requested), set()
+        bus.publish("dispatch", {"event": "positions", "users": users})
+
+    async def __on_event(self, message):
+        if not leadership.is_leader:
+            return
+        await self.load()
+        event = message["event"]
+        if event == "device_ready":
+            self.free[message["type"]][message["device"]] = None
+            await self.dispatch(message["type"])
+        elif event == "user_joined":
+            self.__enqueue(message["type"], message["entry"], message["user"])
+            self.joined[message["entry"]] = message.get("at", None)
+            self.__publish_position(message["type"], message["user"])
+            await self.dispatch(message["type"])
+        elif event == "user_left":
+            for deviceType, entries in self.waiting.items():
+                for entryID in [e for e, u in entries.items() if u == message["user"]]:
+                    del entries[entryID]
+                    self.__dequeue(deviceType, entryID, message["user"])
+        elif event == "device_removed":
+            for devices in self.free.values():
+                devices.pop(message["device"], None)
+        elif event == "positions":
+            positions = [
+                [deviceType, userID, self.position(deviceType, userID)]
+                for userID in message["users"]
+                for deviceType in list(self.positions)
+                if (deviceType, userID) in self.queued
+            ]
+            if positions:
+                bus.publish("queue.positions", {"positions": positions})
+
+    def position(self, deviceType, userID):
+        """
+        Leader only. 1 for the front of the line, None if `userID` is not waiting for `deviceType`.
+        """
+        entryID = self.queued.get((deviceType, userID), None)
+        if entryID is None:
+            return None
+        return self.positions[deviceType].position(entryID)
+
+    def __enqueue(self, deviceType, entryID, userID):
+        self.waiting[deviceType][entryID] = userID
+        self.positions[deviceType].add(entryID)
+        self.queued[(deviceType, userID)] = entryID
+
+    def __dequeue(self, deviceType, entryID, userID):
+        self.joined.pop(entryID, None)
+        position = self.positions[deviceType].remove(entryID)
+        if self.queued.get((deviceType, userID), None) == entryID:
+            del self.queued[(deviceType, userID)]
+        if position is not None:
+            bus.publish("queue.positions", {"queue": deviceType, "left": position, "user": userID})
+
+    def __publish_position(self, deviceType, userID):
+        position = self.position(deviceType, userID)
+        if position is not None:
+            bus.publish("queue.positions", {"queue": deviceType, "user": userID, "position": position})
+
+    async def dispatch(self, deviceType):
+        waiting = self.waiting[deviceType]
+        free = self.free[deviceType]
+        # one claim per queue at a time, a second one would only find what the first took
+        async with self.dispatching[deviceType]:
+            while waiting and free:
+                try:
+                    claimed = await writer.submit(partial(claim, deviceType=deviceType))
+                except Unclaimed:
+                    # somebody else got to one of the rows between our SELECT and UPDATE
+                    continue
+                if claimed is None:
+                    # what we remember is waiting or free is not in the database any more
+                    self.loaded = False
+                    IOLoop.current().spawn_callback(self.load)
+                    return
+                waiting.pop(claimed.entry, None)
+                free.pop(claimed.id, None)
+                joined = self.joined.get(claimed.entry, None)
+                if joined is not None:
+                    assignment_seconds.observe(max(time() - joined, 0), queue=claimed.typeName)
+                self.__dequeue(deviceType, claimed.entry, claimed.user)
+                await self.__assign(claimed)
+
+
+dispatcher = Dispatcher()
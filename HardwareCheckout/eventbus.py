@@ -0,0 +1,213 @@
+"""
+Publish/subscribe between the worker processes forked by http_server.start(0).
+
+Everything that has to reach a socket, timer or controller living in another
+worker goes through `bus.publish(channel, message)`. Every process, including
+the publisher, gets the message delivered to the callbacks it subscribed for
+that channel. Messages have to be JSON serialisable.
+
+The transport is pluggable, anything implementing `Backend` can be handed to
+`bus.configure()` before the workers start.
+"""
+import os
+import socket
+from collections import defaultdict
+from functools import partial
+from inspect import isawaitable
+
+from tornado.escape import json_decode, json_encode
+from tornado.gen import convert_yielded
+from tornado.ioloop import IOLoop
+from tornado.iostream import IOStream, StreamClosedError
+from tornado.netutil import add_accept_handler, bind_unix_socket
+
+from .runtime import runtime_dir
+
+
+class Backend:
+    """
+    What a transport has to provide. A Redis-style backend would map publish()
+    onto PUBLISH and feed the messages it gets from SUBSCRIBE into `deliver`.
+    """
+
+    def prepare(self):
+        """
+        Called once in the parent process before any worker is forked.
+        """
+
+    def start(self, deliver):
+        """
+        Called once in every worker, `deliver(channel, message)` must be called
+        on the IOLoop for every message published by any other process.
+        """
+        raise NotImplementedError
+
+    def publish(self, channel, message):
+        """
+        Send the message to every other process. Must not block, and must not
+        drop the message because a peer is slow to read it.
+        """
+        raise NotImplementedError
+
+    def stop(self):
+        pass
+
+
+class LocalBackend(Backend):
+    """
+    Every worker listens on a unix stream socket of its own, all in the bus
+    directory under runtime_dir(), and keeps a connection open to each of the
+    others. Publishing writes one line of JSON per peer. The IOStream buffers
+    whatever a busy peer has not read yet instead of dropping it, and a peer
+    gets the messages of one publisher in the order they were published.
+    There is no broker process to look after.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.name = None
+        self.streams = dict()  # peer socket -> IOStream we write to it with
+        self.peers = []
+        self.peers_mtime = None
+        self.__server = None
+        self.__stop_accepting = None
+
+    def prepare(self):
+        if self.path is None:
+            self.path = runtime_dir("bus")
+
+    def start(self, deliver):
+        self.prepare()
+        self.deliver = deliver
+        self.name = os.path.join(self.path, "{}.sock".format(os.getpid()))
+        # replaces a socket left behind by a dead process that had our pid
+        self.__server = bind_unix_socket(self.name, mode=0o600)
+        self.__stop_accepting = add_accept_handler(self.__server, self.__on_connection)
+
+    def publish(self, channel, message):
+        payload = json_encode([channel, message]).encode() + b"\n"
+        for peer in self.__peers():
+            stream = self.streams.get(peer, None)
+            if stream is None or stream.closed():
+                stream = self.streams[peer] = self.__connect(peer)
+            try:
+                # queued until the connection is up, and for as long as the peer is behind
+                stream.write(payload)
+            except StreamClosedError:
+                # that worker is gone, __on_close forgets about it
+                pass
+
+    def stop(self):
+        if self.__server is not None:
+            self.__stop_accepting()
+            self.__server.close()
+            self.__server = None
+            for stream in list(self.streams.values()):
+                stream.close()
+            self.streams.clear()
+            try:
+                os.unlink(self.name)
+            except OSError:
+                pass
+
+    def __peers(self):
+        # only re-list the directory when a worker came or went
+        mtime = os.stat(self.path).st_mtime_ns
+        if mtime != self.peers_mtime:
+            self.peers_mtime = mtime
+            self.peers = [
+                os.path.join(self.path, name)
+                for name in os.listdir(self.path)
+                if name.endswith(".sock") and os.path.join(self.path, name) != self.name
+            ]
+        return self.peers
+
+    def __connect(self, peer):
+        stream = IOStream(socket.socket(socket.AF_UNIX, socket.SOCK_STREAM))
+        stream.set_close_callback(partial(self.__on_close, peer, stream))
+        # a refused connection shows up in __on_close, nothing to do with the future
+        stream.connect(peer).add_done_callback(lambda future: future.exception())
+        return stream
+
+    def __on_close(self, peer, stream):
+        if self.streams.get(peer, None) is stream:
+            del self.streams[peer]
+        if isinstance(stream.error, (ConnectionRefusedError, FileNotFoundError)):
+            # nobody listens there any more, that worker is gone
+            try:
+                os.unlink(peer)
+            except OSError:
+                pass
+
+    def __on_connection(self, connection, address):
+        IOLoop.current().spawn_callback(self.__read, IOStream(connection))
+
+    async def __read(self, stream):
+        try:
+            while True:
+                payload = await stream.read_until(b"\n")
+                try:
+                    channel, message = json_decode(payload)
+                except Exception:
+                    continue
+                self.deliver(channel, message)
+        except StreamClosedError:
+            pass
+
+
+class EventBus:
+    def __init__(self, backend=None):
+        self.backend = backend or LocalBackend()
+        self.subscribers = defaultdict(list)
+        self.started = False
+
+    def configure(self, backend):
+        if self.started:
+            raise RuntimeError("the event bus is already running")
+        self.backend = backend
+
+    def prepare(self):
+        """
+        Call in the parent before forking so every worker ends up on the same transport.
+        """
+        self.backend.prepare()
+
+    def start(self):
+        """
+        Call once per worker after forking.
+        """
+        if not self.started:
+            self.backend.start(self.deliver)
+            self.started = True
+
+    def stop(self):
+        """
+        Call on the way out, so the other workers stop writing to this one.
+        """
+        if self.started:
+            self.backend.stop()
+            self.started = False
+
+    def subscribe(self, channel, callback):
+        self.subscribers[channel].append(callback)
+
+    def publish(self, channel, message):
+        """
+        Not async. The local subscribers run on the next IOLoop iteration.
+        """
+        self.start()
+        self.backend.publish(channel, message)
+        IOLoop.current().add_callback(self.deliver, channel, message)
+
+    def deliver(self, channel, message):
+        for callback in self.subscribers.get(channel, ()):
+            try:
+                result = callback(message)
+            except Exception as e:
+                print("Event bus: {} subscriber failed: {}".format(channel, e))
+                continue
+            if isawaitable(result):
+                IOLoop.current().add_future(convert_yielded(result), lambda f: f.result())
+
+
+bus = EventBus()
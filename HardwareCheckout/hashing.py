@@ -0,0 +1,124 @@
+"""
+PBKDF2 hashing and verification off the IOLoop.
+
+45,000 iterations of sha256 hold the GIL for tens of milliseconds, so every
+check runs in a small process pool instead. The number of requests that may
+wait for the pool is bounded; past that HashingBusy is raised and the caller
+should tell the user to try again rather than pile up more work. A pool that
+lost a process is replaced, and the checks it took down with it are retried once.
+"""
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+from time import monotonic
+
+from tornado.ioloop import IOLoop
+from werkzeug.security import check_password_hash, generate_password_hash
+
+PASSWORD_CRYPTO_TYPE = "pbkdf2:sha256:45000"
+
+
+class HashingBusy(Exception):
+    pass
+
+
+class HashingService:
+    def __init__(self, max_workers=None, max_pending=64):
+        self.max_workers = max_workers or min(4, os.cpu_count() or 1)
+        self.max_pending = max_pending
+        self.pending = 0
+        self.submitted = 0
+        self.completed = 0
+        self.rejected = 0
+        self.failed = 0
+        self.broken = 0
+        self.seconds = 0.0
+        self.__pool = None
+        self.__pid = None
+
+    async def check(self, pwhash, password, bounded=True):
+        """
+        Awaitable check_password_hash. Devices pass bounded=False, their
+        registrations are rare and must not be shed during a login burst.
+        """
+        return await self.__submit(partial(check_password_hash, pwhash, password), bounded)
+
+    async def generate(self, password, method=PASSWORD_CRYPTO_TYPE, bounded=True):
+        """
+        Awaitable generate_password_hash.
+        """
+        return await self.__submit(partial(generate_password_hash, password, method=method), bounded)
+
+    def stats(self):
+        return {
+            "workers": self.max_workers,
+            "pending": self.pending,
+            "submitted": self.submitted,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "failed": self.failed,
+            "broken": self.broken,
+            "seconds": self.seconds,
+        }
+
+    def start(self):
+        """
+        Fork the pool's processes now. Call once per worker after forking and
+        before anything starts a thread (bus.start(), the database executors),
+        a fork() of a process with running threads can leave the children
+        stuck on locks those threads held.
+        """
+        pool = self.pool()
+        # a fork pool starts all of its processes on the first submit
+        pool.submit(int).result()
+
+    def pool(self):
+        # Every forked worker needs a pool of its own, the parent's is useless after fork()
+        if self.__pool is None or self.__pid != os.getpid():
+            self.__pool = ProcessPoolExecutor(
+                max_workers=self.max_workers,
+                mp_context=multiprocessing.get_context("fork"),
+            )
+            self.__pid = os.getpid()
+        return self.__pool
+
+    async def __submit(self, func, bounded):
+        if bounded and self.pending >= self.max_pending:
+            self.rejected += 1
+            raise HashingBusy("too many password checks waiting")
+
+        self.pending += 1
+        self.submitted += 1
+        start = monotonic()
+        try:
+            try:
+                result = await self.__run(func)
+            except BrokenProcessPool:
+                result = await self.__run(func)
+        except Exception:
+            self.failed += 1
+            raise
+        finally:
+            self.pending -= 1
+            self.seconds += monotonic() - start
+        self.completed += 1
+        return result
+
+    async def __run(self, func):
+        pool = self.pool()
+        try:
+            return await IOLoop.current().run_in_executor(pool, func)
+        except BrokenProcessPool:
+            # One of its processes died (OOM, kill) and the pool refuses all work from now on.
+            # The checks that were waiting on it all get here, only the first one replaces it.
+            # The new one forks a process that runs threads, its children only ever hash.
+            if self.__pool is pool:
+                self.broken += 1
+                self.__pool = None
+                pool.shutdown(wait=False)
+            raise
+
+
+hasher = HashingService()
@@ -0,0 +1,81 @@
+"""
+Picks the one worker that runs the background schedulers.
+
+The lease is an exclusive flock() on leader.lock in the runtime directory
+(see runtime.py), shared by all workers and by an instance that overlaps
+with this one during a restart. The kernel drops it the moment the holding
+process dies or stop() closes it, and every other worker retries once per
+`interval`, so leadership moves on within about a second.
+"""
+import fcntl
+import os
+
+from tornado.ioloop import IOLoop, PeriodicCallback
+
+from .runtime import runtime_dir
+
+
+class Leadership:
+    def __init__(self, path=None, interval=1):
+        self.path = path
+        self.interval = interval
+        self.is_leader = False
+        self.callbacks = []
+        self.__fd = None
+        self.__timer = None
+
+    def on_elected(self, callback):
+        """
+        Run `callback()` (may be a coroutine) whenever this process becomes the leader.
+        """
+        self.callbacks.append(callback)
+
+    def prepare(self):
+        """
+        Call in the parent before forking so every worker competes for the same file.
+        """
+        if self.path is None:
+            self.path = os.path.join(runtime_dir(), "leader.lock")
+
+    def start(self):
+        """
+        Call once per worker after forking. Each worker needs its own open file,
+        a descriptor inherited through fork() would share the lock.
+        """
+        if self.__timer is not None:
+            return
+        self.prepare()
+        self.__fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        self.__timer = PeriodicCallback(self.__campaign, self.interval * 1000)
+        self.__timer.start()
+        self.__campaign()
+
+    def __campaign(self):
+        if self.is_leader:
+            return
+        try:
+            fcntl.flock(self.__fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return
+        self.is_leader = True
+        self.__timer.stop()
+        os.ftruncate(self.__fd, 0)
+        os.write(self.__fd, "{}\n".format(os.getpid()).encode())
+        print("Worker {} is now running the schedulers".format(os.getpid()))
+        for callback in self.callbacks:
+            IOLoop.current().add_callback(callback)
+
+    def stop(self):
+        """
+        Give up the lease on the way out. The lock file stays, had we removed it
+        a worker could lock a new file while another still holds this one.
+        """
+        if self.__timer is not None:
+            self.__timer.stop()
+            self.__timer = None
+            os.close(self.__fd)
+            self.__fd = None
+            self.is_leader = False
+
+
+leadership = Leadership()
@@ -1,26 +1,46 @@
+from functools import partial
+from hashlib import sha1
+
+from .database import as_future
 from .models import DeviceQueue, DeviceType, User, UserQueue, TwitchStream
-from .webutil import Blueprint, UserBaseHandler, Timer, make_session
-from tornado_sqlalchemy import as_future
+from .webutil import Blueprint, UserBaseHandler, Timer, make_session, rows_to_json, rows_from_json
+from .eventbus import bus
+from .leader import leadership
 from sqlalchemy import func, or_
 from tornado import locks
+from tornado.escape import json_encode, utf8
+from tornado.ioloop import IOLoop
 
 main = Blueprint()
 
 
 @main.route('/', name="main")
 class MainHandler(UserBaseHandler):
-    timer = None
     RWTerminals = []
     ROTerminals = []
     queues = []
     pictures = []
     tstreams = []
+    version = 0
+    digests = dict()  # part -> digest of what was last published, leader only
+    dirty = set()
+    refresh_window = 0.2
+    refresh_handle = None
+    # addDevice.py and the other scripts write the database directly, nothing invalidates for them
+    fallback_interval = 60
+    fallback = None
+    pages = dict()  # (role, devices) -> (etag, html) for the current version
+    max_pages = 1024
     lock = locks.Lock()
     
     async def get(self):
         """
         Home path for the site
 
+        Pages only depend on the snapshot, the role and the devices someone
+        owns, so they are rendered once per snapshot version and answered
+        from self.pages (or with a 304) after that.
+
         :return:
         """
         # default values
@@ -31,47 +51,113 @@ class MainHandler(UserBaseHandler):
         tstreams = self.tstreams
         pictures = self.pictures
         adminuser = False
-        
-        # If no background queue update thread as started, start it
-        if self.timer is None:
-            async with self.lock: # we don't want the overhead of getting the lock EVERY loop, so this should be fine
-                if self.timer is None:
-                    print("Scheduling")
-                    self.__class__.timer = Timer(self.updateQueues, timeout=5)
+        role = "anonymous"
 
         # check if use is logged in
         if self.current_user:
-            with self.make_session() as session:
-                #check if the user is an admin
-                try:
-                    current_user = await as_future(session.query(User).filter_by(id=self.current_user).one)
-                except Exception:
-                    pass
+            role = "user"
+            #check if the user is an admin
+            current_user = await self.get_identity()
+            if current_user is not None:
+                if current_user.has_roles('Admin'):
+                    role = "admin"
+                    adminuser = True
+                    terminals = self.RWTerminals
+                    show_streams = False
+                    devices = []
                 else:
-                    if current_user.has_roles('Admin'):
-                        adminuser = True
-                        terminals = self.RWTerminals
-                        show_streams = False
-                        devices = []
-                    else:
-                        # Get any devices the user may own.
+                    # Get any devices the user may own.
+                    with self.make_session() as session:
                         devices = await current_user.get_owned_devices_async(session)
-                        devices = [{'name': a[0], 'sshAddr': a[1], 'webUrl': a[2]} for a in devices]
+                    devices = [{'name': a[0], 'sshAddr': a[1], 'webUrl': a[2]} for a in devices]
 
             # get a listing of all the queues available
             # Make a copy of the list because we are iterating through it
             tqueues = self.queues
-            queues = [{"id": i[0], "name": i[1], "image": i[3], "size": i[3]} for i in tqueues]
+            queues = [{"id": i[0], "name": i[1], "image": i[2], "size": i[3]} for i in tqueues]
+
+        key = (role, tuple(tuple(device.values()) for device in devices))
+        page = self.pages.get(key)
+        if page is None:
+            html = self.render_string('index.html', devices=devices, tstreams=tstreams, queues=queues, show_streams=show_streams, terminals=terminals, pictures=pictures, adminuser=adminuser)
+            page = ('"{}"'.format(sha1(html).hexdigest()), html)
+            if len(self.pages) < self.max_pages:
+                self.pages[key] = page
 
-        self.render('index.html', devices=devices, tstreams=tstreams, queues=queues, show_streams=show_streams, terminals=terminals, pictures=pictures, adminuser=adminuser)
+        self.set_header("Etag", page[0])
+        if self.check_etag_header():
+            self.set_status(304)
+            return
+        self.finish(page[1])
+
+    # every part of the snapshot and the query that rebuilds it
+    parts = {
+        "RWTerminals": lambda session: session.query(User.name, DeviceQueue.webUrl).join(User.deviceQueueEntry).filter_by(state="in-use").all(),
+        "queues":      lambda session: session.query(DeviceType.id, DeviceType.name, DeviceType.image_path, func.count(UserQueue.userId).label("size")).select_from(DeviceType).filter_by(enabled=1).join(UserQueue, isouter=True).group_by(DeviceType.id, DeviceType.name).all(),
+        "ROTerminals": lambda session: session.query(User.name, DeviceQueue.roUrl).join(User.deviceQueueEntry).filter(DeviceQueue.state=="in-use").filter(User.ctf==0).all(),
+        "tstreams":    lambda session: session.query(TwitchStream.name).all(),
+        "pictures":    lambda session: session.query(DeviceType.image_path, DeviceType.name, DeviceType.enabled).all(),
+    }
 
     @classmethod
-    async def updateQueues(cls):
+    def start_updates(cls):
+        """
+        Only the elected leader builds the snapshot, every worker gets the results over the event bus.
+        """
+        cls.digests = dict()
+        cls.on_invalidate(list(cls.parts))
+        if cls.fallback is None:
+            # unchanged parts are not published again, so this costs the queries and nothing else
+            cls.fallback = Timer(lambda: cls.on_invalidate(list(cls.parts)), timeout=cls.fallback_interval)
+
+    @classmethod
+    def invalidate(cls, *parts):
+        """
+        Not async. Call after committing a change that shows up in these parts of the front page.
+        """
+        bus.publish("main.dirty", list(parts))
+
+    @classmethod
+    def on_invalidate(cls, parts):
+        if not leadership.is_leader:
+            return
+        cls.dirty.update(parts)
+        # let a burst of changes settle into a single refresh
+        if cls.refresh_handle is None:
+            cls.refresh_handle = IOLoop.current().call_later(cls.refresh_window, cls.refresh)
+
+    @classmethod
+    async def refresh(cls):
         async with cls.lock:
+            cls.refresh_handle = None
+            dirty, cls.dirty = cls.dirty, set()
+            rows = dict()
             with make_session() as session:
-                cls.RWTerminals = await as_future(session.query(User.name, DeviceQueue.webUrl).join(User.deviceQueueEntry).filter_by(state="in-use").all)
-                cls.queues      = await as_future(session.query(DeviceType.id, DeviceType.name, DeviceType.image_path, func.count(UserQueue.userId)).select_from(DeviceType).filter_by(enabled=1).join(UserQueue, isouter=True).group_by(DeviceType.id, DeviceType.name).all)
-                cls.ROTerminals = await as_future(session.query(User.name, DeviceQueue.roUrl).join(User.deviceQueueEntry).filter(DeviceQueue.state=="in-use").filter(User.ctf==0).all)
-                cls.tstreams    = await as_future(session.query(TwitchStream.name).all)
-                cls.pictures    = await as_future(session.query(DeviceType.image_path, DeviceType.name, DeviceType.enabled).all)
-                
+                for name in dirty:
+                    result = rows_to_json(await as_future(partial(cls.parts[name], session)))
+                    # nothing changed, keep the version and every cached page
+                    digest = sha1(utf8(json_encode(result))).hexdigest()
+                    if digest != cls.digests.get(name):
+                        cls.digests[name] = digest
+                        rows[name] = result
+            if not rows:
+                return
+            cls.version += 1
+            bus.publish("main.snapshot", {"version": cls.version, "rows": rows})
+
+    @classmethod
+    def on_snapshot(cls, snapshot):
+        """
+        Every worker swaps in the parts that changed and drops the pages rendered from the old ones.
+        A newly elected leader continues counting from the last version it received.
+        """
+        for name, rows in snapshot["rows"].items():
+            setattr(cls, name, rows_from_json(rows))
+        cls.version = max(cls.version, snapshot["version"])
+        cls.pages = dict()
+
+
+bus.subscribe("main.snapshot", MainHandler.on_snapshot)
+bus.subscribe("main.dirty", MainHandler.on_invalidate)
+leadership.on_elected(MainHandler.start_updates)
+
@@ -0,0 +1,305 @@
+"""
+Counters, gauges and histograms in the Prometheus text format, served on /metrics.
+
+Every metric lives in the process that updates it. Updates only ever happen
+on the IOLoop thread, so a plain dict update is enough and nothing is locked.
+Every `interval` seconds each worker publishes a snapshot of its metrics on
+"metrics.snapshot". Whichever worker answers a scrape adds up the latest
+snapshot of every worker, its own included, so consecutive scrapes answered
+by different workers agree and counters never go backwards. A worker that
+went quiet for three intervals stops counting towards the gauges, its last
+counters and histograms are kept.
+
+/metrics answers admins, and scrapers that send `metrics_token` from config.py
+as a bearer token.
+
+Gauges that are cheaper to read than to keep up to date take a function
+instead, it is called whenever a snapshot is taken. The queue depth and device
+state counts come straight from the database when /metrics is scraped, so
+they do not depend on any one worker's view.
+"""
+import os
+from bisect import bisect_left
+from hmac import compare_digest
+from functools import partial
+from time import monotonic
+
+from sqlalchemy import func
+from tornado.ioloop import PeriodicCallback
+from tornado.log import access_log
+
+from . import config
+from .database import as_future, runner
+from .eventbus import bus
+from .hashing import hasher
+from .models import DeviceQueue, DeviceType, UserQueue, writer
+from .webutil import Blueprint, UserBaseHandler, make_session
+
+metrics = Blueprint()
+
+# seconds, from a user in the queue or a device in use to hours
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900, 1800, 3600, 7200)
+
+
+class Metric:
+    kind = None
+    initial = None  # what an unlabelled metric starts at
+
+    def __init__(self, registry, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}  # label values -> value
+        if not self.labels and self.initial is not None:
+            self.values[()] = self.initial
+        if registry is not None:
+            registry.add(self)
+
+    def key(self, labels):
+        return tuple(str(labels[label]) for label in self.labels)
+
+    def snapshot(self):
+        return [[list(key), value] for key, value in self.values.items()]
+
+
+class Counter(Metric):
+    kind = "counter"
+    initial = 0
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """
+    Set and changed by hand, or read from `function()` on every snapshot.
+    A function returns a number, or a dict of label value tuples to numbers.
+    """
+    kind = "gauge"
+    initial = 0
+
+    def __init__(self, registry, name, help, labels=(), function=None):
+        super().__init__(registry, name, help, labels)
+        self.function = function
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        self.values[self.key(labels)] = value
+
+    def snapshot(self):
+        if self.function is not None:
+            value = self.function()
+            self.values = value if isinstance(value, dict) else {(): value}
+        return super().snapshot()
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, registry, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(registry, name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        if key not in self.values:
+            # a count per bucket plus the ones above the last, then the sum
+            self.values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+        counts = self.values[key]
+        counts[bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+
+class Registry:
+    def __init__(self, channel="metrics.snapshot", interval=5):
+        self.channel = channel
+        self.interval = interval
+        self.metrics = {}
+        self.peers = {}  # pid -> (received, snapshot), this worker's own last one too
+        self.__timer = None
+        bus.subscribe(channel, self.__on_snapshot)
+
+    def add(self, metric):
+        self.metrics[metric.name] = metric
+
+    def counter(self, name, help, labels=()):
+        return Counter(self, name, help, labels)
+
+    def gauge(self, name, help, labels=(), function=None):
+        return Gauge(self, name, help, labels, function)
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return Histogram(self, name, help, labels, buckets)
+
+    def start(self):
+        """
+        Call once per worker after forking, like bus.start().
+        """
+        if self.__timer is None:
+            self.__timer = PeriodicCallback(self.publish, self.interval * 1000)
+            self.__timer.start()
+            self.publish()
+
+    def snapshot(self):
+        return {name: metric.snapshot() for name, metric in self.metrics.items()}
+
+    def publish(self):
+        message = {"pid": os.getpid(), "metrics": self.snapshot()}
+        # kept before it goes out, whether or not the bus delivers it back to this worker
+        self.__on_snapshot(message)
+        bus.publish(self.channel, message)
+
+    def __on_snapshot(self, message):
+        self.peers[message["pid"]] = (monotonic(), message["metrics"])
+
+    def live(self):
+        """
+        Workers that published recently.
+        """
+        stale = monotonic() - 3 * self.interval
+        return [pid for pid, (received, _) in self.peers.items() if received >= stale]
+
+    def collect(self):
+        """
+        Every worker's last published metrics added up, name -> {label values: value}.
+        """
+        live = set(self.live())
+        totals = {name: {} for name in self.metrics}
+        for pid, (_, snapshot) in self.peers.items():
+            for name, values in snapshot.items():
+                if name not in totals:
+                    continue
+                # a dead worker's sockets are closed, but what it counted still happened
+                if pid not in live and self.metrics[name].kind == "gauge":
+                    continue
+                for key, value in values:
+                    key = tuple(key)
+                    if key not in totals[name]:
+                        totals[name][key] = value
+                    elif isinstance(value, list):
+                        totals[name][key] = [a + b for a, b in zip(totals[name][key], value)]
+                    else:
+                        totals[name][key] += value
+        return totals
+
+    def render(self, extra=()):
+        """
+        The text exposition format, `extra` are (metric, values) pairs that are
+        not kept in the registry.
+        """
+        lines = []
+        totals = self.collect()
+        families = [(metric, totals[name]) for name, metric in self.metrics.items()] + list(extra)
+        lines.append("# HELP hwc_workers Workers that reported metrics recently.")
+        lines.append("# TYPE hwc_workers gauge")
+        lines.append("hwc_workers {}".format(len(self.live())))
+        for metric, values in families:
+            lines.append("# HELP {} {}".format(metric.name, metric.help))
+            lines.append("# TYPE {} {}".format(metric.name, metric.kind))
+            for key, value in sorted(values.items()):
+                labels = list(zip(metric.labels, key))
+                if metric.kind != "histogram":
+                    lines.append("{}{} {}".format(metric.name, format_labels(labels), value))
+                    continue
+                cumulative = 0
+                for bound, count in zip(metric.buckets + ("+Inf",), value):
+                    cumulative += count
+                    lines.append("{}_bucket{} {}".format(metric.name, format_labels(labels + [("le", bound)]), cumulative))
+                lines.append("{}_sum{} {}".format(metric.name, format_labels(labels), value[-1]))
+                lines.append("{}_count{} {}".format(metric.name, format_labels(labels), cumulative))
+        return "\n".join(lines) + "\n"
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    escape = lambda value: str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+    return "{" + ",".join('{}="{}"'.format(name, escape(value)) for name, value in labels) + "}"
+
+
+class DatabaseGauge(Metric):
+    """
+    A gauge counted by `query(session)`, which returns (label value, count) rows.
+    """
+    kind = "gauge"
+
+    def __init__(self, name, help, labels, query):
+        super().__init__(None, name, help, labels)
+        self.query = query
+
+
+registry = Registry()
+
+queue_sockets = registry.gauge("hwc_queue_sockets", "Open QueueWSHandler websockets.")
+controller_sockets = registry.gauge("hwc_controller_sockets", "Open ControllerHandler websockets.")
+assignment_seconds = registry.histogram("hwc_assignment_seconds", "Time from joining a queue to being handed a device.", ("queue",))
+session_seconds = registry.histogram("hwc_session_seconds", "Time from a device going in use to it being returned or closed.")
+device_returns = registry.counter("hwc_device_returns_total", "Devices taken back from their user, by reason.", ("reason",))
+controller_commands = registry.counter("hwc_controller_commands_total", "Commands sent to the tmate controllers, by how they ended.", ("type", "outcome"))
+db_pending = registry.gauge("hwc_db_pending", "Queries waiting for or running on the database executor.", function=lambda: runner.pending)
+db_writes_pending = registry.gauge("hwc_db_writes_pending", "Writes waiting for the single writer.", function=lambda: writer.pending)
+request_seconds = registry.histogram("hwc_request_seconds", "Time to handle a request, or to open a websocket, by route.", ("route", "method"))
+hashing_pending = registry.gauge("hwc_hashing_pending", "Password hashes waiting for or running in the hashing pool.", function=lambda: hasher.pending)
+
+DATABASE_GAUGES = [
+    DatabaseGauge(
+        "hwc_queue_depth", "Users waiting in the queue of each device type.", ("queue",),
+        lambda session: session.query(DeviceType.name, func.count(UserQueue.id)).select_from(DeviceType).join(UserQueue, isouter=True).group_by(DeviceType.name).all(),
+    ),
+    DatabaseGauge(
+        "hwc_devices", "Devices in each state.", ("state",),
+        lambda session: session.query(DeviceQueue.state, func.count(DeviceQueue.id)).group_by(DeviceQueue.state).all(),
+    ),
+]
+
+
+def observe_request(handler):
+    route = getattr(handler, "route_pattern", None) or type(handler).__name__
+    request_seconds.observe(handler.request.request_time(), route=route, method=handler.request.method)
+
+
+def log_request(handler):
+    """
+    The Application's log_function. Records the request's latency, then logs
+    it the way tornado does by default. Websockets never get here once they
+    are open, their handlers call observe_request() at the end of open().
+    """
+    observe_request(handler)
+    if handler.get_status() < 400:
+        log_method = access_log.info
+    elif handler.get_status() < 500:
+        log_method = access_log.warning
+    else:
+        log_method = access_log.error
+    log_method("%d %s %.2fms", handler.get_status(), handler._request_summary(), 1000.0 * handler.request.request_time())
+
+
+@metrics.route("/metrics", name="metrics")
+class MetricsHandler(UserBaseHandler):
+    async def get(self):
+        if not await self.allowed():
+            self.set_status(403)
+            self.finish("Forbidden")
+            return
+        extra = []
+        with make_session() as session:
+            for gauge in DATABASE_GAUGES:
+                rows = await as_future(partial(gauge.query, session))
+                extra.append((gauge, {(str(label),): count for label, count in rows}))
+        self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.finish(registry.render(extra))
+
+    async def allowed(self):
+        token = getattr(config, "metrics_token", None)
+        authorization = self.request.headers.get("Authorization", "")
+        if token and compare_digest(authorization.encode(), "Bearer {}".format(token).encode()):
+            return True
+        identity = await self.get_identity()
+        return identity is not None and identity.has_roles("Admin")
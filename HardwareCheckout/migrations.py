@@ -0,0 +1,86 @@
+"""
+Versioned schema changes for databases that were created before a model changed.
+
+`db.create_all()` only adds missing tables, so anything else a deployed
+database needs goes into MIGRATIONS. Every migration runs once, in order, in
+its own transaction, and is recorded in the schema_version table. Migrations
+must be idempotent, an interrupted run is simply repeated on the next start.
+
+`migrate()` is run by __main__ in the parent process before any worker forks.
+"""
+from sqlalchemy import func, inspect, select, text
+
+from .models import DeviceQueue, SchemaVersion, User, UserQueue, db
+
+# arbitrary key for pg_advisory_xact_lock, shared by everything running migrate()
+LOCK_ID = 0x4857434B
+
+
+def add_indexes(connection, *models):
+    """
+    Create every index declared on the models that the database does not have
+    yet. Indexes on columns a later migration adds are left to that migration.
+    """
+    inspector = inspect(connection)
+    for model in models:
+        existing = set(index["name"] for index in inspector.get_indexes(model.__tablename__))
+        columns = set(column["name"] for column in inspector.get_columns(model.__tablename__))
+        for index in model.__table__.indexes:
+            if index.name not in existing and all(column.name in columns for column in index.columns):
+                index.create(bind=connection)
+
+
+def add_columns(connection, model, *names):
+    """
+    Add the named columns of the model that the database does not have yet, they start out NULL.
+    """
+    existing = set(column["name"] for column in inspect(connection).get_columns(model.__tablename__))
+    quote = connection.dialect.identifier_preparer.quote
+    for name in names:
+        if name not in existing:
+            column = model.__table__.c[name]
+            connection.execute(text("ALTER TABLE {} ADD COLUMN {} {}".format(
+                quote(model.__tablename__), quote(column.name), column.type.compile(connection.dialect)
+            )))
+
+
+def add_spare_sessions(connection):
+    add_columns(connection, DeviceQueue, "spareEntity", "spareSshAddr", "spareWebUrl", "spareRoUrl")
+    add_indexes(connection, DeviceQueue)
+
+
+MIGRATIONS = [
+    (1, "indexes for the hot lookup columns", lambda connection: add_indexes(connection, User, UserQueue, DeviceQueue)),
+    (2, "spare tmate sessions", add_spare_sessions),
+]
+
+
+def current_version(connection):
+    return connection.execute(select([func.max(SchemaVersion.version)])).scalar() or 0
+
+
+def migrate(engine=None):
+    """
+    Bring the database up to the latest version, returns the version it ends up at.
+    Without an engine it runs on db.engine and closes its pooled connections
+    after, __main__ migrates before forking the workers and they must not share them.
+    """
+    if engine is None:
+        try:
+            return migrate(db.engine)
+        finally:
+            db.engine.dispose()
+
+    SchemaVersion.__table__.create(bind=engine, checkfirst=True)
+    version = 0
+    for version, description, apply in MIGRATIONS:
+        with engine.begin() as connection:
+            if connection.dialect.name == "postgresql":
+                # somebody else may be starting up against the same database
+                connection.execute(text("SELECT pg_advisory_xact_lock(:id)"), id=LOCK_ID)
+            if current_version(connection) >= version:
+                continue
+            print("Applying migration {}: {}".format(version, description))
+            apply(connection)
+            connection.execute(SchemaVersion.__table__.insert().values(version=version))
+    return version
@@ -1,17 +1,20 @@
-from sqlalchemy import Column, Integer, String, ForeignKey, DateTime
+from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, Float, Index
 from sqlalchemy import func, or_
 from sqlalchemy.orm import relationship
 
 from .config import db_path #This is created dynamically during install...
-from tornado_sqlalchemy import SQLAlchemy, as_future
+from .database import Database, Writer, as_future
+from collections import namedtuple
 from functools import partial
 
-db = SQLAlchemy(url=db_path, engine_options={
+# server settings, a SQLite URL gets the profile from database.Database instead
+db = Database(url=db_path, engine_options={
     "max_overflow": 15,
     "pool_pre_ping": True,
     "pool_recycle": 60 * 60,
     "pool_size": 30,
 })
+writer = Writer(db)
 
 class User(db.Model):
     """
@@ -19,6 +22,9 @@ class User(db.Model):
     """
 
     __tablename__ = "user"
+    __table_args__ = (
+        Index("ix_user_name", "name"),  # login
+    )
     id = Column(Integer, primary_key=True)
     password = Column(String(93), unique=True)
     ctf = Column(Integer)
@@ -49,6 +55,33 @@ class User(db.Model):
                 return True
         return False
 
+    @staticmethod
+    def get_identity(session, userID):
+        """
+        One query for the Identity of a user, None if there is no such user.
+        """
+        rows = (
+            session.query(User.id, User.name, User.ctf, Role.name.label("role"))
+            .outerjoin(User.roles)
+            .filter(User.id == userID)
+            .all()
+        )
+        if not rows:
+            return None
+        return Identity(rows[0].id, rows[0].name, rows[0].ctf, frozenset(row.role for row in rows if row.role is not None))
+
+
+class Identity(namedtuple("Identity", ["id", "name", "ctf", "roles"])):
+    """
+    The parts of a User that handlers check on every request, detached from any session.
+    """
+
+    get_owned_devices = User.get_owned_devices
+    get_owned_devices_async = User.get_owned_devices_async
+
+    def has_roles(self, role):
+        return role in self.roles
+
 
 class Role(db.Model):
     __tablename__ = "roles"
@@ -73,6 +106,10 @@ class DeviceType(db.Model):
 
 class UserQueue(db.Model):
     __tablename__ = "userqueue"
+    __table_args__ = (
+        Index("ix_userqueue_type_id", "type", "id"),  # FIFO order within a queue
+        Index("ix_userqueue_userId", "userId"),  # leaving the queue, joins to user
+    )
     id = Column(Integer, primary_key=True)
     userId = Column(Integer, ForeignKey("user.id"))
     type = Column(Integer, ForeignKey("devicetype.id"))
@@ -80,6 +117,11 @@ class UserQueue(db.Model):
 
 class DeviceQueue(db.Model):
     __tablename__ = "devicequeue"
+    __table_args__ = (
+        Index("ix_devicequeue_state_type", "state", "type"),  # free devices, terminals
+        Index("ix_devicequeue_owner_state", "owner", "state"),  # owned devices
+        Index("ix_devicequeue_spareEntity", "spareEntity", unique=True),  # session_close of a spare
+    )
     id = Column(Integer, primary_key=True)
     name = Column(String(200), unique=True)
     password = Column(String(93), unique=True)
@@ -88,6 +130,11 @@ class DeviceQueue(db.Model):
     webUrl = Column(String(200))
     roUrl = Column(String(200))
     state = Column(String(200))
+    # a second tmate session of the device, started ahead of time to take over from the one in use
+    spareEntity = Column(String(200))
+    spareSshAddr = Column(String(200))
+    spareWebUrl = Column(String(200))
+    spareRoUrl = Column(String(200))
     ctf = Column(Integer)
 
     owner = Column(Integer, ForeignKey("user.id"))
@@ -122,4 +169,26 @@ class DeviceQueue(db.Model):
 class TwitchStream(db.Model):
     __tablename__ = "twitchstreams"
     id = Column(Integer, primary_key=True)
-    name = Column(String(200))
\ No newline at end of file
+    name = Column(String(200))
+
+
+class Timeout(db.Model):
+    """
+    A pending deadline owned by the timing wheel, kept here so it survives a restart.
+    """
+
+    __tablename__ = "timeouts"
+    key = Column(String(200), primary_key=True)
+    deadline = Column(Float)
+    action = Column(String(200))
+    args = Column(String(1000))
+
+
+class SchemaVersion(db.Model):
+    """
+    The last migration from migrations.py applied to this database.
+    """
+
+    __tablename__ = "schema_version"
+    id = Column(Integer, primary_key=True)
+    version = Column(Integer)
@@ -0,0 +1,80 @@
+class QueuePositions:
+    """
+    Order statistics over the entries of one queue.
+
+    UserQueue ids only ever grow, so an entry's place in line is the number of
+    live ids up to and including its own. A Fenwick tree indexed by
+    `id - base` answers that and applies a join or departure in O(log n).
+    The tree is rebuilt around the live ids whenever an id falls outside it,
+    which happens O(log n) times as the queue grows.
+    """
+
+    def __init__(self):
+        self.live = set()
+        self.base = 0
+        self.tree = [0]
+
+    def __len__(self):
+        return len(self.live)
+
+    def __contains__(self, entryID):
+        return entryID in self.live
+
+    def add(self, entryID):
+        if entryID in self.live:
+            return
+        self.live.add(entryID)
+        index = entryID - self.base + 1
+        if index < 1 or index >= len(self.tree):
+            self.__rebuild()
+            return
+        self.__update(index, 1)
+
+    def remove(self, entryID):
+        """
+        Drop the entry and return the position it had, None if it was not in line.
+        """
+        if entryID not in self.live:
+            return None
+        position = self.position(entryID)
+        self.live.remove(entryID)
+        self.__update(entryID - self.base + 1, -1)
+        return position
+
+    def position(self, entryID):
+        """
+        1 for the front of the line, None if the entry is not in line.
+        """
+        if entryID not in self.live:
+            return None
+        index = entryID - self.base + 1
+        total = 0
+        while index > 0:
+            total += self.tree[index]
+            index -= index & -index
+        return total
+
+    def ahead(self, entryID):
+        position = self.position(entryID)
+        return None if position is None else position - 1
+
+    def __update(self, index, delta):
+        while index < len(self.tree):
+            self.tree[index] += delta
+            index += index & -index
+
+    def __rebuild(self):
+        if not self.live:
+            self.base, self.tree = 0, [0]
+            return
+        self.base = min(self.live)
+        size = max(16, 2 * (max(self.live) - self.base + 1))
+        tree = [0] * (size + 1)
+        for entryID in self.live:
+            tree[entryID - self.base + 1] += 1
+        # linear time construction, push every node's sum into its parent
+        for index in range(1, size + 1):
+            parent = index + (index & -index)
+            if parent <= size:
+                tree[parent] += tree[index]
+        self.tree = tree
@@ -1,16 +1,71 @@
+from collections import defaultdict
+
+from sqlalchemy import func
+from tornado.ioloop import IOLoop
 from tornado.web import authenticated, RequestHandler
 from tornado.websocket import WebSocketClosedError, WebSocketHandler
-from tornado_sqlalchemy import SessionMixin, as_future
+from tornado_sqlalchemy import SessionMixin
 
-from .models import DeviceType, UserQueue, User
-from .webutil import Blueprint, Waiters, UserBaseHandler, Timer, make_session
+from .database import as_future
+from .models import DeviceType, UserQueue, User, writer
+from .webutil import Blueprint, Frame, FrameWriterMixin, ListingMixin, Waiters, UserBaseHandler, make_session
+from .dispatch import dispatcher
+from .eventbus import bus
+from .leader import leadership
+from .main import MainHandler
+from .timeouts import timeouts
+from .metrics import observe_request, queue_sockets
 
 queue = Blueprint()
 
+
+class QueueSizes:
+    """
+    Coalesces queue joins and departures into one queue_sizes message.
+
+    Every worker reports changes over the event bus. The leader collects the
+    affected queues for `window` seconds, counts them once and broadcasts the
+    absolute sizes, so a burst of joins costs one query and one frame.
+    """
+
+    def __init__(self, window=0.5):
+        self.window = window
+        self.dirty = set()
+        self.__handle = None
+        bus.subscribe("queue.changed", self.__on_changed)
+
+    def changed(self, queueID):
+        bus.publish("queue.changed", queueID)
+        MainHandler.invalidate("queues")
+
+    def __on_changed(self, queueID):
+        if not leadership.is_leader:
+            return
+        self.dirty.add(queueID)
+        if self.__handle is None:
+            self.__handle = IOLoop.current().call_later(self.window, self.flush)
+
+    async def flush(self):
+        self.__handle = None
+        dirty, self.dirty = self.dirty, set()
+        with make_session() as session:
+            counts = await as_future(
+                session.query(UserQueue.type, func.count(UserQueue.id))
+                .filter(UserQueue.type.in_(dirty))
+                .group_by(UserQueue.type)
+                .all
+            )
+        sizes = {queueID: 0 for queueID in dirty}
+        sizes.update(counts)
+        QueueWSHandler.waiters.broadcast({'type': 'queue_sizes', 'queues': sizes})
+
+
+queue_sizes = QueueSizes()
+
+
 def on_user_assigned_device(userId, device):
-    message = {'type': 'queue_shrink', 'queue': device.type}
-    QueueWSHandler.waiters.broadcast(message)
-    device_info = {'id':device.id,'name': device.type_obj.name, 'sshAddr': device.sshAddr, 'webUrl': device.webUrl}
+    queue_sizes.changed(device.type)
+    device_info = {'id':device.id,'name': device.typeName, 'sshAddr': device.sshAddr, 'webUrl': device.webUrl}
     message = {'type': 'new_device', 'device': device_info}
     return QueueWSHandler.waiters[userId].send(message)
 
@@ -21,36 +76,39 @@ def on_user_deallocated_device(userId, deviceID, reason="normal"):
 
 
 @queue.route("/event")
-class QueueWSHandler(UserBaseHandler, WebSocketHandler):
-    waiters = Waiters()
-    closed = {}
+class QueueWSHandler(FrameWriterMixin, UserBaseHandler, WebSocketHandler):
+    waiters = Waiters("queue.waiters")
+    positions = defaultdict(dict)  # queue -> {user: position} for users connected to this process
 
     def get_compression_options(self):
         # Non-None enables compression with default options.
         return {}
 
     async def open(self):
+        self.counted = True
+        queue_sockets.inc()
         if self.current_user:
-            if self.closed.get(self.current_user,False):
-                self.closed[self.current_user].stop()
-                del self.closed[self.current_user]
+            await timeouts.cancel(self.timeout_key(self.current_user))
             self.waiters[self.current_user].add(self)
+            dispatcher.request_positions(self.current_user)
             # send all devices, in case WS connecton was terminated then re-established
             # and a device was assigned in the meantime
-            with self.make_session() as session:
-                current_user = await as_future(session.query(User).filter_by(id=self.current_user).one)
-                devices = await current_user.get_owned_devices_async(session)
+            current_user = await self.get_identity()
+            if current_user is not None:
+                with self.make_session() as session:
+                    devices = await current_user.get_owned_devices_async(session)
                 devices = [{'name': a[0], 'sshAddr': a[1], 'webUrl': a[2], "id":a[3]} for a in devices]
-                self.write_message({'type': 'all_devices', 'devices': devices})
+                self.write_frame(Frame({'type': 'all_devices', 'devices': devices}))
         else:
             # support updating queue numbers even if not logged in
             self.waiters[-1].add(self)
+        observe_request(self)
 
     # TODO: find out when this runs and how to make it async
-    def send(self, message):
+    def send(self, frame):
         """Callback for webutil.Waiters"""
         try:
-            return self.write_message(message)
+            return self.write_frame(frame)
         except WebSocketClosedError:
             self.on_close()
 
@@ -59,18 +117,85 @@ class QueueWSHandler(UserBaseHandler, WebSocketHandler):
         print("Unhandled message received on websocket: {}".format(message))
 
     def on_close(self):
+        # send() calls this too when it finds the socket closed
+        if getattr(self, "counted", False):
+            self.counted = False
+            queue_sockets.dec()
         if self.current_user:
             QueueWSHandler.waiters[self.current_user].remove(self)
             if 0 >= len(QueueWSHandler.waiters[self.current_user].bucket):
-                t = Timer(self.remove_user, repeat=False, timeout=(60*15), args=(self.current_user,))
-                self.closed[self.current_user] = t
+                IOLoop.current().add_callback(timeouts.arm, self.timeout_key(self.current_user), 60*15, "remove_user", self.current_user)
+                for positions in QueueWSHandler.positions.values():
+                    positions.pop(self.current_user, None)
         else:
             QueueWSHandler.waiters[-1].remove(self)
 
+    @staticmethod
+    def timeout_key(user):
+        return "user:{}".format(user)
+
+    @classmethod
+    def on_positions(cls, message):
+        """
+        Keeps the place in line of the users connected here up to date. The
+        leader only says which position was vacated, everyone behind it moved up one.
+        """
+        if message.get("resync", False):
+            cls.positions.clear()
+            dispatcher.request_positions(*[
+                user for user in cls.waiters.waiters if user != -1 and cls.waiters.connected(user)
+            ])
+            return
+
+        if "positions" in message:
+            # the leader's answer to a batch of requests, from any worker
+            for queueID, user, position in message["positions"]:
+                cls.set_position(queueID, user, position)
+            return
+
+        queueID, user = message["queue"], message["user"]
+        positions = cls.positions[queueID]
+        if "position" in message:
+            cls.set_position(queueID, user, message["position"])
+            return
+
+        if positions.pop(user, None) is not None:
+            cls.send_position(queueID, user, None)
+        for user, position in positions.items():
+            if position > message["left"]:
+                positions[user] = position - 1
+                cls.send_position(queueID, user, position - 1)
+
+    @classmethod
+    def set_position(cls, queueID, user, position):
+        if cls.waiters.connected(user):
+            cls.positions[queueID][user] = position
+            cls.send_position(queueID, user, position)
+
+    @classmethod
+    def send_position(cls, queueID, user, position):
+        message = {
+            'type': 'queue_position',
+            'queue': queueID,
+            'position': position,
+            'ahead': None if position is None else position - 1,
+        }
+        cls.waiters[user].deliver(Frame(message))
+
     @classmethod
     async def remove_user(cls, user):
-        with make_session() as session:
-            queueEntry = await as_future(session.query(UserQueue).filter_by(userId=user).delete)
+        def leave(session):
+            queueEntries = session.query(UserQueue.type).filter_by(userId=user).all()
+            session.query(UserQueue).filter_by(userId=user).delete()
+            return queueEntries
+
+        queueEntries = await writer.submit(leave)
+        dispatcher.user_left(user)
+        for (queueID,) in queueEntries:
+            queue_sizes.changed(queueID)
+
+timeouts.register("remove_user", QueueWSHandler.remove_user)
+bus.subscribe("queue.positions", QueueWSHandler.on_positions)
 
 # @queue.route('/')
 # class ListAllQueuesHandler(SessionMixin, RequestHandler):
@@ -80,24 +205,21 @@ class QueueWSHandler(UserBaseHandler, WebSocketHandler):
 
 
 @queue.route(r'/(\d+)')
-class SingleQueueHandler(UserBaseHandler):
+class SingleQueueHandler(ListingMixin, UserBaseHandler):
     @authenticated
     async def get(self, id):
-        with self.make_session() as session:
-            current_user = await as_future(session.query(User).filter_by(id=self.current_user).one)
-
-            if not current_user.has_roles("Admin"):
-                self.redirect(self.reverse_url("ROTerminals"))
-                return
+        current_user = await self.get_identity()
+        if current_user is None or not current_user.has_roles("Admin"):
+            self.redirect(self.reverse_url("ROTerminals"))
+            return
         try:
             id = int(id)
         except ValueError:
             self.render("error.html", error="Invalid Queue")
             return
 
-        with self.make_session() as session:
-            names = await as_future(session.query(User.name).select_from(UserQueue).join(User).filter(UserQueue.type == id).order_by(UserQueue.id).all)
-        self.write({'result': [{'name': name} for name in names]})
+        query = lambda session: session.query(User.name).select_from(UserQueue).join(User).filter(UserQueue.type == id)
+        await self.write_listing('result', query, UserQueue.id, lambda row: {'name': row.name})
         # self.redirect(self.reverse_url("main"))   
 
     @authenticated
@@ -109,35 +231,35 @@ class SingleQueueHandler(UserBaseHandler):
             return
 
 
-        with self.make_session() as session:
+        userID = self.current_user
+
+        def join(session):
             # Check if the user is already registered for a queue
-            try:
-                entry = await as_future(session.query(UserQueue).filter_by(userId=self.current_user, type=id).first)
-            except Exception:
-                return self.render("error.html", error="Error while trying to join queue") # meh... someone else write a better error message
-
-            if entry:
-                return self.render("error.html", error="User already registered for this queue")
-            else:
-                #quickly check if the queue is enabled
-                try:
-                    await as_future(session.query(DeviceType.name).filter_by(id=id, enabled=1).one)
-                except Exception:
-                    return self.render("error.html", error="Queue is disabled")
-
-                # Add user to the queue
-                newEntry = UserQueue(userId=self.current_user, type=id)
-                session.add(newEntry)
-                # Send them back to the front page
-                self.redirect(self.reverse_url("main"))
-
-            self.on_userqueue_insert(id)
+            if session.query(UserQueue.id).filter_by(userId=userID, type=id).first():
+                return None, "User already registered for this queue"
+            #quickly check if the queue is enabled
+            if not session.query(DeviceType.id).filter_by(id=id, enabled=1).first():
+                return None, "Queue is disabled"
+            # Add user to the queue
+            newEntry = UserQueue(userId=userID, type=id)
+            session.add(newEntry)
+            session.flush()
+            return newEntry.id, None
+
+        try:
+            entryID, error = await writer.submit(join)
+        except Exception:
+            return self.render("error.html", error="Error while trying to join queue") # meh... someone else write a better error message
+        if error:
+            return self.render("error.html", error=error)
+
+        # Send them back to the front page
+        self.redirect(self.reverse_url("main"))
+
+        # the entry has to be committed before the dispatcher can hand it a device
+        dispatcher.user_joined(entryID, self.current_user, id)
+        queue_sizes.changed(id)
 
             # # Check if someone is able to claim a device
             # current_user = await as_future(session.query(User).filter_by(id=self.current_user).one)
             # current_user.try_to_claim_device(session, id, on_user_assigned_device)
-
-    @staticmethod
-    def on_userqueue_insert(targetID):
-        message = {'type': 'queue_grow', 'queue': targetID}
-        QueueWSHandler.waiters.broadcast(message)
@@ -0,0 +1,30 @@
+"""
+Where the workers of one installation find each other: the event bus sockets
+and the leader lock file live in one directory.
+
+It is `runtime_dir` in config.py, or the HWC_RUNTIME_DIR environment variable,
+and by default a directory of the server user's own in the system temp
+directory. The path is the same on every start, so a server that is still
+shutting down while the next one comes up shares the lock and the bus with it
+instead of electing a leader of its own.
+"""
+import os
+import tempfile
+
+from . import config
+
+
+def runtime_dir(*parts):
+    """
+    The runtime directory, or the directory `parts` names inside it, created if missing.
+    """
+    base = os.environ.get("HWC_RUNTIME_DIR", getattr(config, "runtime_dir", None))
+    if base is None:
+        base = os.path.join(tempfile.gettempdir(), "hardwarecheckout-{}".format(os.getuid()))
+    os.makedirs(base, mode=0o700, exist_ok=True)
+    # anyone else could put a lock or a socket in there
+    if os.stat(base).st_uid != os.getuid():
+        raise RuntimeError("{} belongs to another user, set runtime_dir in config.py".format(base))
+    path = os.path.join(base, *parts)
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    return path
@@ -49,12 +49,24 @@ var updater = {
                 } else if (msg.reason == "normal") {
                     updater.notify("Thank you for participating in the virtual CHV CTF. If you would like more time, you may enter the queue again.");
                 }
-            } else if (msg.type == "queue_grow") {
-                let count = parseInt(document.getElementById("qs_" + msg.queue).innerText);
-                document.getElementById("qs_" + msg.queue).innerText = (count + 1)
-            } else if (msg.type == "queue_shrink") {
-                let count = parseInt(document.getElementById("qs_" + msg.queue).innerText);
-                document.getElementById("qs_" + msg.queue).innerText = (count - 1)
+            } else if (msg.type == "queue_sizes") {
+                for (let queue in msg.queues) {
+                    let element = document.getElementById("qs_" + queue);
+                    if (element) {
+                        element.innerText = msg.queues[queue];
+                    }
+                }
+            } else if (msg.type == "queue_position") {
+                let element = document.getElementById("qp_" + msg.queue);
+                if (element) {
+                    if (msg.position === null) {
+                        element.innerText = "";
+                    } else if (msg.ahead == 0) {
+                        element.innerText = "You are next in line.";
+                    } else {
+                        element.innerText = "You are number " + msg.position + " in line, " + msg.ahead + " ahead of you.";
+                    }
+                }
             } else if (msg.error) {
                 updater.notify(msg.error);
             }
@@ -0,0 +1,180 @@
+from math import ceil
+from time import time
+
+from tornado import locks
+from tornado.escape import json_decode, json_encode
+from tornado.ioloop import IOLoop, PeriodicCallback
+
+from .database import as_future
+from .eventbus import bus
+from .leader import leadership
+from .models import Timeout, db, writer
+from .webutil import Timer, make_session
+
+
+class TimingWheel:
+    """
+    Hierarchical timing wheel holding every device and queue deadline.
+
+    Level 0 has `slots` buckets of `tick` seconds each, every level above covers
+    `slots` times the span of the one below. Arming, re-arming and cancelling
+    are a dict insert/delete, a single PeriodicCallback drives the whole wheel.
+    Every deadline is mirrored in the timeouts table and reloaded by start().
+
+    Only the elected leader runs the wheel, the other workers write the table
+    and tell the leader about it over the event bus. Every `reconcile_interval`
+    seconds the leader also places whatever is in the table but not on the
+    wheel, in case one of those messages never arrived.
+    """
+
+    reconcile_interval = 60
+
+    def __init__(self, tick=1, slots=64, levels=4):
+        self.tick = tick
+        self.slots = slots
+        self.levels = [[dict() for _ in range(slots)] for _ in range(levels)]
+        self.entries = dict()  # key -> (tick, deadline, action, args, bucket)
+        self.actions = dict()
+        self.origin = time()
+        self.now = 0
+        self.started = False
+        self.lock = locks.Lock()
+        self.touched = None  # keys armed or cancelled over the bus while reconcile() reads the table
+        self.__timer = None
+        self.__reconciler = None
+        bus.subscribe("timeouts.arm", self.__on_arm)
+        bus.subscribe("timeouts.cancel", self.__on_cancel)
+        leadership.on_elected(self.start)
+
+    def register(self, name, callback):
+        """
+        Expose a coroutine to the wheel under a name that can be stored in the database.
+        """
+        self.actions[name] = callback
+
+    async def start(self):
+        """
+        Load every pending deadline and start ticking.
+        """
+        if self.started:
+            return
+        async with self.lock:
+            if self.started:
+                return
+            await as_future(lambda: Timeout.__table__.create(bind=db.engine, checkfirst=True))
+            with make_session() as session:
+                pending = await as_future(session.query(Timeout).all)
+                for timeout in pending:
+                    self.__place(timeout.key, timeout.deadline, timeout.action, json_decode(timeout.args))
+            self.__timer = PeriodicCallback(self.__advance, self.tick * 1000)
+            self.__timer.start()
+            self.__reconciler = Timer(self.reconcile, timeout=self.reconcile_interval)
+            self.started = True
+
+    async def reconcile(self):
+        """
+        Leader only. Put every deadline from the table on the wheel that is not on it yet.
+        """
+        self.touched = set()
+        try:
+            with make_session() as session:
+                pending = await as_future(
+                    session.query(Timeout.key, Timeout.deadline, Timeout.action, Timeout.args).all
+                )
+        finally:
+            # what came over the bus in the meantime is newer than what we read
+            touched, self.touched = self.touched, None
+        for key, deadline, action, args in pending:
+            entry = self.entries.get(key, None)
+            if key in touched or (entry is not None and entry[1] == deadline):
+                continue
+            # a deadline held here that is not in the table any more is harmless, __expire skips it
+            self.__discard(key)
+            self.__place(key, deadline, action, json_decode(args))
+
+    async def arm(self, key, timeout, action, *args):
+        """
+        Schedule `action(*args)` to run in `timeout` seconds, replacing any deadline already set for `key`.
+        """
+        deadline = time() + timeout
+        await writer.submit(lambda session: session.merge(
+            Timeout(key=key, deadline=deadline, action=action, args=json_encode(list(args)))
+        ))
+        bus.publish("timeouts.arm", {"key": key, "deadline": deadline, "action": action, "args": list(args)})
+
+    async def cancel(self, key):
+        await writer.submit(lambda session: session.query(Timeout).filter_by(key=key).delete())
+        bus.publish("timeouts.cancel", key)
+
+    def __on_arm(self, message):
+        if self.started:
+            self.__touch(message["key"])
+            self.__discard(message["key"])
+            self.__place(message["key"], message["deadline"], message["action"], message["args"])
+
+    def __on_cancel(self, key):
+        if self.started:
+            self.__touch(key)
+            self.__discard(key)
+
+    def __touch(self, key):
+        if self.touched is not None:
+            self.touched.add(key)
+
+    def __place(self, key, deadline, action, args):
+        expires = max(ceil((deadline - self.origin) / self.tick), self.now + 1)
+        delta = expires - self.now
+        level = 0
+        while level < len(self.levels) - 1 and delta >= self.slots ** (level + 1):
+            level += 1
+        bucket = self.levels[level][(expires // self.slots ** level) % self.slots]
+        bucket[key] = expires
+        self.entries[key] = (expires, deadline, action, args, bucket)
+
+    def __discard(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            entry[4].pop(key, None)
+
+    def __advance(self):
+        target = int((time() - self.origin) / self.tick)
+        while self.now < target:
+            self.now += 1
+            self.__cascade()
+            bucket = self.levels[0][self.now % self.slots]
+            for key in list(bucket):
+                expires, deadline, action, args, _ = self.entries.pop(key)
+                del bucket[key]
+                if expires > self.now:
+                    # parked on the top level for longer than one revolution
+                    self.__place(key, deadline, action, args)
+                    continue
+                IOLoop.current().add_callback(self.__expire, key, deadline, action, args)
+
+    def __cascade(self):
+        for level in range(1, len(self.levels)):
+            span = self.slots ** level
+            if self.now % span:
+                return
+            bucket = self.levels[level][(self.now // span) % self.slots]
+            for key in list(bucket):
+                _, deadline, action, args, _ = self.entries.pop(key)
+                del bucket[key]
+                self.__place(key, deadline, action, args)
+
+    async def __expire(self, key, deadline, action, args):
+        # Only whoever removes the row gets to run it. A re-arm or cancel in the
+        # meantime changed or dropped the row, so a stale entry falls through here.
+        claimed = await writer.submit(
+            lambda session: session.query(Timeout).filter_by(key=key, deadline=deadline).delete()
+        )
+        if not claimed:
+            return
+        callback = self.actions.get(action)
+        if callback is None:
+            print("No timeout action named {}".format(action))
+            return
+        await callback(*args)
+
+
+timeouts = TimingWheel()
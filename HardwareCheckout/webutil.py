@@ -1,20 +1,37 @@
+import zlib
 from base64 import b64decode
+from collections import namedtuple
 from functools import partial
 from contextlib import contextmanager
-from asyncio import iscoroutine
+from asyncio import ensure_future, iscoroutine
 
 from sqlalchemy.orm.exc import NoResultFound
+from tornado.escape import json_encode, utf8
 from tornado.ioloop import IOLoop, PeriodicCallback
+from tornado.iostream import StreamClosedError
 from tornado.locks import Condition
 from tornado.web import RequestHandler, URLSpec
-from tornado.websocket import WebSocketHandler
-from tornado_sqlalchemy import SessionMixin, as_future
-from werkzeug.security import check_password_hash
+from tornado.websocket import WebSocketClosedError, WebSocketHandler
+from tornado_sqlalchemy import SessionMixin
 
+from .database import as_future, statement_origin
+from .credentials import device_credentials, identities
+from .eventbus import bus
+from .hashing import hasher
 from .models import DeviceQueue, User, db
 
 
+def track_origin(handler):
+    '''
+    Attribute the queries made while handling this request to its route.
+    '''
+    statement_origin.set('{} {}'.format(handler.request.method, getattr(handler, 'route_pattern', None) or type(handler).__name__))
+
+
 class UserBaseHandler(SessionMixin, RequestHandler):
+    def prepare(self):
+        track_origin(self)
+
     def get_current_user(self):
         '''
         Not allowed to be async
@@ -25,28 +42,39 @@ class UserBaseHandler(SessionMixin, RequestHandler):
         except Exception:
             return False
 
+    async def get_identity(self):
+        '''
+        The Identity of the logged in user, None if nobody is logged in
+        or the user no longer exists.
+        '''
+        if not self.current_user:
+            return None
+        return await load_identity(self.current_user)
+
 
 class DeviceBaseHandler(SessionMixin, RequestHandler):
-    def get_current_user(self):
+    async def prepare(self):
         '''
-        Not allowed to be async
+        get_current_user is not allowed to be async, and checking the password
+        has to wait for the hashing pool, so authenticate here instead.
         '''
+        track_origin(self)
+        self.current_user = await self.check_authentication()
+
+    async def check_authentication(self):
         if 'Authorization' not in self.request.headers:
             return self.unauthorized()
         if not self.request.headers['Authorization'].startswith('Basic '):
             return self.unauthorized()
         name, password = b64decode(self.request.headers['Authorization'][6:]).decode().split(':', 1)
-        try:
-            device = DeviceQueue.query.filter_by(name=name).one()
-            if not check_password_hash(device.password, password):
-                return self.unauthorized()
-            return device
-        except NoResultFound:
+        device = await check_device_credentials(name, password)
+        if device is None:
             return self.unauthorized()
+        return device.id
 
     def unauthorized(self):
         '''
-        Not allowed to be async, used by get_current_user
+        Not allowed to be async, used by check_authentication
         '''
         self.set_header('WWW-Authenticate', 'Basic realm="CarHackingVillage"')
         self.set_status(401)
@@ -54,21 +82,115 @@ class DeviceBaseHandler(SessionMixin, RequestHandler):
 
 
 class DeviceWSHandler(SessionMixin, WebSocketHandler):
+    def prepare(self):
+        track_origin(self)
+
     async def check_authentication(self):
         if 'Authorization' not in self.request.headers:
             return False
         if not self.request.headers['Authorization'].startswith('Basic '):
             return False
         name, password = b64decode(self.request.headers['Authorization'][6:]).decode().split(':', 1)
-        try:
-            with self.make_session() as session:
-                deviceID, devicePassword = await as_future(session.query(DeviceQueue.id, DeviceQueue.password).filter_by(name=name).one)
-            if not check_password_hash(devicePassword, password):
-                return False
-            return deviceID
-        except NoResultFound:
+        device = await check_device_credentials(name, password)
+        if device is None:
             return False
-
+        return device.id
+
+
+VerifiedDevice = namedtuple('VerifiedDevice', ['id', 'type'])
+
+async def check_device_credentials(name, password):
+    '''
+    Returns the VerifiedDevice for a correct name and password, None otherwise.
+    Repeat checks of the same credentials are answered from device_credentials.
+    '''
+    device = device_credentials.get(name, password)
+    if device is not None:
+        return device
+    with make_session() as session:
+        row = await as_future(session.query(DeviceQueue.id, DeviceQueue.type, DeviceQueue.password).filter_by(name=name).first)
+    if row is None or not row.password or not await hasher.check(row.password, password, bounded=False):
+        return None
+    device = VerifiedDevice(row.id, row.type)
+    device_credentials.put(name, password, device)
+    return device
+
+
+
+async def load_identity(userID):
+    '''
+    Returns the Identity of a user, from `identities` unless it is not cached yet.
+    '''
+    identity = identities.get(userID)
+    if identity is not None:
+        return identity
+    with make_session() as session:
+        identity = await as_future(partial(User.get_identity, session, userID))
+    if identity is not None:
+        identities.put(userID, identity)
+    return identity
+
+class ListingMixin:
+    """
+    Keyset pagination for JSON listings.
+
+    Without a limit every row is returned, as before pagination. With
+    `?after_id=<cursor>&limit=<n>` only the next page is, and the cursor to ask
+    for the one after it in "next". With `?format=ndjson` (or an Accept header
+    asking for application/x-ndjson) every row is written on its own line and
+    flushed `stream_chunk` rows at a time, only one chunk is held in memory.
+    """
+    max_limit = 1000
+    stream_chunk = 500
+
+    async def write_listing(self, key, query, cursor, render):
+        '''
+        `query(session)` returns the query to list, it is ordered and paged on the `cursor` column.
+        `render(row)` turns a row into JSON.
+        '''
+        try:
+            after_id = self.get_argument('after_id', None)
+            after_id = None if after_id is None else int(after_id)
+            limit = self.get_argument('limit', None)
+            limit = None if limit is None else min(max(int(limit), 1), self.max_limit)
+        except ValueError:
+            self.set_status(400)
+            self.write({'error': 'after_id and limit must be integers'})
+            return
+
+        if self.get_argument('format', None) == 'ndjson' or 'application/x-ndjson' in self.request.headers.get('Accept', ''):
+            await self.__stream(query, cursor, after_id, limit, render)
+            return
+
+        rows = await self.__page(query, cursor, after_id, limit)
+        self.write({
+            key: [render(row) for row in rows],
+            'next': rows[-1].cursor if limit is not None and len(rows) == limit else None,
+        })
+
+    async def __stream(self, query, cursor, after_id, limit, render):
+        self.set_header('Content-Type', 'application/x-ndjson')
+        while limit is None or limit > 0:
+            size = self.stream_chunk if limit is None else min(limit, self.stream_chunk)
+            rows = await self.__page(query, cursor, after_id, size)
+            for row in rows:
+                self.write(json_encode(render(row)) + '\n')
+            await self.flush()
+            if len(rows) < size:
+                break
+            after_id = rows[-1].cursor
+            if limit is not None:
+                limit -= len(rows)
+
+    async def __page(self, query, cursor, after_id, limit):
+        # a session per page, none is held while a slow client is flushed to
+        with self.make_session() as session:
+            page = query(session).add_columns(cursor.label('cursor')).order_by(cursor)
+            if after_id is not None:
+                page = page.filter(cursor > after_id)
+            if limit is not None:
+                page = page.limit(limit)
+            return await as_future(page.all)
 
 
 class Blueprint:
@@ -92,29 +214,66 @@ class Blueprint:
         base = [part for part in base.split('/') if part]
         for route in self.routes:
             route['pattern'] = '/' + '/'.join(base + route['pattern'])
+            # metrics and the slow query log report requests by route, not by path
+            route['handler'].route_pattern = route['pattern']
             finalRoutes.append(URLSpec(**route))
         return finalRoutes
 
 
 class Waiters:
-    def __init__(self):
+    """
+    Sockets grouped by user id. With a channel set, broadcast() and send()
+    go over the event bus so sockets held by other workers get them too.
+    """
+    def __init__(self, channel=None):
         self.waiters = dict()
+        self.channel = channel
+        if channel is not None:
+            bus.subscribe(channel, self.deliver)
 
     def __getitem__(self, id):
         if id not in self.waiters:
-            self.waiters[id] = WaiterBucket()
+            self.waiters[id] = WaiterBucket(self, id)
         return self.waiters[id]
 
+    def connected(self, id):
+        '''
+        Whether user `id` has a socket in this process.
+        '''
+        return id in self.waiters and len(self.waiters[id].bucket) > 0
+
     def broadcast(self, message):
         '''
         Not async. Send returns a future, just ignore it.
         '''
-        for bucket in self.waiters.values():
-            bucket.send(message)
+        self.send(None, message)
+
+    def send(self, id, message):
+        '''
+        Not async. Sends to every socket of user `id`, or everyone if `id` is None.
+        '''
+        if self.channel is None:
+            self.deliver({'to': id, 'message': message})
+        else:
+            bus.publish(self.channel, {'to': id, 'message': message})
+
+    def deliver(self, envelope):
+        '''
+        Hand a message to the sockets held by this process, as one Frame
+        shared by all of them.
+        '''
+        frame = Frame(envelope['message'])
+        if envelope['to'] is None:
+            for bucket in self.waiters.values():
+                bucket.deliver(frame)
+        elif envelope['to'] in self.waiters:
+            self.waiters[envelope['to']].deliver(frame)
 
 
 class WaiterBucket:
-    def __init__(self):
+    def __init__(self, parent, id):
+        self.parent = parent
+        self.id = id
         self.bucket = set()
 
     def __getattr__(self, name):
@@ -125,8 +284,72 @@ class WaiterBucket:
             self.bucket.remove(waiter)
 
     def send(self, message):
-        for waiter in self.bucket:
-            waiter.send(message)
+        self.parent.send(self.id, message)
+
+    def deliver(self, frame):
+        for waiter in list(self.bucket):
+            waiter.send(frame)
+
+
+class Frame:
+    """
+    A websocket message that is JSON encoded once and deflated at most once
+    per set of compression parameters, no matter how many sockets it goes to.
+    """
+    def __init__(self, message):
+        self.message = message
+        self.__data = None
+        self.__compressed = dict()
+
+    @property
+    def data(self):
+        if self.__data is None:
+            self.__data = utf8(json_encode(self.message))
+        return self.__data
+
+    def compressed(self, max_wbits, level, mem_level):
+        key = (max_wbits, level, mem_level)
+        if key not in self.__compressed:
+            # same steps as tornado's _PerMessageDeflateCompressor with a fresh context
+            compressor = zlib.compressobj(level, zlib.DEFLATED, -max_wbits, mem_level)
+            data = compressor.compress(self.data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+            self.__compressed[key] = data[:-4]
+        return self.__compressed[key]
+
+
+class FrameWriterMixin:
+    """
+    Lets a WebSocketHandler write a prepared Frame without encoding or
+    compressing it again.
+
+    A frame deflated without context takeover can be read by any client, but
+    it leaves the client's window out of step with tornado's per-connection
+    compressor. Handlers using this must send everything through write_frame().
+    This reaches into tornado's WebSocketProtocol13 (pinned in requirements.txt).
+    """
+    def write_frame(self, frame):
+        connection = self.ws_connection
+        if connection is None or connection.is_closing():
+            raise WebSocketClosedError()
+        compressor = getattr(connection, '_compressor', None)
+        if compressor is None:
+            data, flags = frame.data, 0
+        else:
+            data = frame.compressed(compressor._max_wbits, compressor._compression_level, compressor._mem_level)
+            flags = connection.RSV1
+        connection._message_bytes_out += len(frame.data)
+        try:
+            fut = connection._write_frame(True, 0x1, data, flags=flags)
+        except StreamClosedError:
+            raise WebSocketClosedError()
+
+        async def wrapper():
+            try:
+                await fut
+            except StreamClosedError:
+                raise WebSocketClosedError()
+
+        return ensure_future(wrapper())
 
 
 class Timer():
@@ -196,3 +419,29 @@ def make_session():
     finally:
         if session:
             session.close()
+
+
+def rows_to_json(rows):
+    '''
+    Turn query result rows into something that can go over the event bus.
+    '''
+    keys = list(rows[0].keys()) if rows else []
+    return {
+        # unlabeled columns have no key, those rows can only be used by index
+        'keys': keys if rows and len(keys) == len(rows[0]) else [],
+        'rows': [list(row) for row in rows],
+    }
+
+
+__row_types = {}
+
+def rows_from_json(data):
+    '''
+    The inverse of rows_to_json, rows can be used by index or by name again.
+    '''
+    keys = tuple(data['keys'])
+    if not keys:
+        return [tuple(row) for row in data['rows']]
+    if keys not in __row_types:
+        __row_types[keys] = namedtuple('Row', keys, rename=True)
+    return [__row_types[keys](*row) for row in data['rows']]
@@ -1,13 +1,13 @@
 #!/usr/bin/env python3
 from HardwareCheckout import create_app
 from HardwareCheckout.models import DeviceQueue, Role, DeviceType
+from HardwareCheckout.bulk import DEVICE_COLUMNS, FORMATS, BulkImportError, add_devices, hash_all, passwords, read_rows
 from HardwareCheckout.config import db_path
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
 from werkzeug.security import generate_password_hash
 from argparse import ArgumentParser
 import os
-import configparser
 import sys
 
 
@@ -16,6 +16,8 @@ parser.add_argument('-u', '--username', help="Device user name", required=False)
 parser.add_argument('-p','--password',  help="Device user password", required=False)
 parser.add_argument('-t', '--type', help="Device type", required=False)
 parser.add_argument('-i', '--ini', help='Ini file containing list of device users', required=False)
+parser.add_argument('-f', '--file', help='INI, CSV or JSON file containing list of device users', required=False)
+parser.add_argument('--format', choices=FORMATS, help='Format of --file, guessed from its contents by default', required=False)
 args = parser.parse_args()
 # parser.add_argument("Roles", nargs='+')
 
@@ -45,44 +47,28 @@ def deviceAdd(username, password, devtype):
     s.commit()
 
 
-def iniParse(confPath, devType):
-    config = configparser.ConfigParser()
-    config.read(confPath)
-    result = []
-    
-    
-    for item in config.sections():
-        innerList = []
-        innerList.append(config[item]["username"])
-        innerList.append(config[item]["password"])
-        innerList.append(devType)
-        result.append(innerList)
-    
-    return result
-    
-def csvParse(csvPath):
-    with open(csvPath, 'r') as ulist:
+def bulkAdd(path, fmt, devtype):
+    with open(path) as f:
         try:
-            users = list(filter(bool, ulist.read().split('\n')))
-            result = []
-            for user in users:
-                components = user.split(",")
-                if len(components) < 2:
-                    print("Parameter missing in line {}".format(user))
-                    parser.print_help(sys.stderr)
-                    exit(1)
-                else:
-                    result.append(components)
-        except:
-            print("Couldn't read {}, {}".format(args.ini))
-            parser.print_help(sys.stderr)
+            rows = read_rows(f.read(), DEVICE_COLUMNS, fmt)
+        except BulkImportError as e:
+            print(e)
             exit(1)
-            
-    return result
+
+    # hash everything up front across all cores, then insert in one transaction
+    added, errors = add_devices(s, rows, hash_all(passwords(rows)), default_type=devtype)
+    s.commit()
+    for error in errors:
+        print(error)
+    print("Added {} of {} devices".format(added, len(rows)))
+    if errors:
+        exit(1)
+
 
 def printHelp():
     print("Adding multiple devices:")
     print("python3 addDevice.py -i <path/to/inifile> -t <devicetype>")
+    print("python3 addDevice.py -f <path/to/ini/csv/json> [-t <default devicetype>]")
     print()
     print("Add a single device:")
     print("python3 addDevice.py -u <devicename> -p <password> -t <devicetype>")
@@ -94,6 +80,12 @@ def main():
         parser.print_help(sys.stderr)
     elif args.username and args.password and args.type:
         deviceAdd(args.username,args.password,args.type)
+    elif args.file:
+        if not os.path.isfile(args.file):
+            print ("File {} doesn't exist!".format(args.file))
+            parser.print_help(sys.stderr)
+            exit(1)
+        bulkAdd(args.file, args.format, args.type)
     else:
         if not args.ini or not args.type:
             parser.print_help(sys.stderr)
@@ -103,12 +95,7 @@ def main():
             print ("Ini file {} doesn't exist!".format(args.ini))
             parser.print_help(sys.stderr)
             exit(1)
-        # for parsing csv files replace this with
-        # csvParse(csvPath) --> Note that csvParse expects device type in the file
-        users = iniParse(args.ini, args.type) 
-        
-        for user in users:
-            deviceAdd(user[0],user[1],user[2])
+        bulkAdd(args.ini, "ini", args.type)
 
 if __name__ == '__main__':    
     main()
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+"""
+Races dispatch.claim() from several processes and checks nothing is handed out twice.
+
+A database is filled with queued users and provisioned devices spread over
+a few queues. Then `--processes` processes claim from every queue as fast as
+they can until no queue has a pair left. Every claim runs the way the
+dispatcher runs it, through Writer.apply(). At the end no device, queue entry
+or user may have been claimed twice. The database must agree with what was
+claimed. Exits non-zero if anything is off.
+
+    python3 benchmarks/claim_race.py --processes 16
+    python3 benchmarks/claim_race.py --url postgresql://hwc@localhost/hwc_scratch
+
+Against Postgres the tables are dropped and recreated, never point it at a live database.
+"""
+import argparse
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+import types
+from collections import Counter
+from functools import partial
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), ".."))
+
+
+def setup(url):
+    # config.py is written by install.sh, the benchmark brings its own database
+    config = types.ModuleType("HardwareCheckout.config")
+    config.db_path = url
+    config.ssl_config = {"certfile": "", "keyfile": ""}
+    sys.modules["HardwareCheckout.config"] = config
+
+
+def fill(users, devices, queues):
+    from HardwareCheckout.models import DeviceQueue, DeviceType, User, UserQueue, db
+
+    db.drop_all()
+    db.create_all()
+    with db.engine.begin() as connection:
+        connection.execute(DeviceType.__table__.insert(), [{"id": i, "name": "type%d" % i, "enabled": 1} for i in range(1, queues + 1)])
+        connection.execute(User.__table__.insert(), [{"id": i, "name": "user%d" % i, "password": "hash%d" % i, "ctf": 0} for i in range(1, users + 1)])
+        connection.execute(UserQueue.__table__.insert(), [{"id": i, "userId": i, "type": i % queues + 1} for i in range(1, users + 1)])
+        connection.execute(DeviceQueue.__table__.insert(), [
+            {"id": i, "name": "device%d" % i, "password": "device%d" % i, "state": "provisioned", "type": i % queues + 1}
+            for i in range(1, devices + 1)
+        ])
+    db.engine.dispose()
+
+
+def claimer(queues, results):
+    from HardwareCheckout.dispatch import Unclaimed, claim
+    from HardwareCheckout.models import writer
+
+    claims, conflicts, errors = [], 0, 0
+    remaining = list(range(1, queues + 1))
+    while remaining:
+        for deviceType in list(remaining):
+            result, error = writer.apply([partial(claim, deviceType=deviceType)])[0]
+            if isinstance(error, Unclaimed):
+                conflicts += 1
+            elif error is not None:
+                # lock timeouts and the like, the claim is simply tried again
+                errors += 1
+            elif result is None:
+                remaining.remove(deviceType)
+            else:
+                claims.append(tuple(result[:4]))
+    results.put((claims, conflicts, errors))
+
+
+def check(users, devices, queues, claims):
+    from HardwareCheckout.models import DeviceQueue, UserQueue, db
+
+    problems = []
+    for label, column in (("device", 2), ("queue entry", 0), ("user", 1)):
+        twice = [key for key, count in Counter(claim[column] for claim in claims).items() if count > 1]
+        if twice:
+            problems.append("{} {} claimed more than once".format(len(twice), label + "s"))
+    waiting = Counter(i % queues + 1 for i in range(1, users + 1))
+    free = Counter(i % queues + 1 for i in range(1, devices + 1))
+    expected = sum(min(waiting[q], free[q]) for q in range(1, queues + 1))
+    if len(claims) != expected:
+        problems.append("{} claims, expected {}".format(len(claims), expected))
+
+    session = db.sessionmaker()
+    owners = dict(session.query(DeviceQueue.id, DeviceQueue.owner).filter_by(state="in-queue").all())
+    left = session.query(UserQueue.id).count()
+    session.close()
+    if owners != {claim[2]: claim[1] for claim in claims}:
+        problems.append("devices in the database do not match the claims")
+    if left != users - len(claims):
+        problems.append("{} queue entries left, expected {}".format(left, users - len(claims)))
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--url", help="database to race on, a scratch SQLite file by default")
+    parser.add_argument("--processes", type=int, default=8)
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--devices", type=int, default=500)
+    parser.add_argument("--queues", type=int, default=4)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        setup(args.url or "sqlite:///" + os.path.join(directory, "race.db"))
+        fill(args.users, args.devices, args.queues)
+
+        # every process gets its own connections, the pool is not shared across fork()
+        context = multiprocessing.get_context("fork")
+        results = context.Queue()
+        processes = [context.Process(target=claimer, args=(args.queues, results)) for _ in range(args.processes)]
+        start = time.perf_counter()
+        for process in processes:
+            process.start()
+        outcomes = [results.get() for _ in processes]
+        for process in processes:
+            process.join()
+        elapsed = time.perf_counter() - start
+
+        claims = [claim for outcome in outcomes for claim in outcome[0]]
+        print("{} claims by {} processes in {:.2f}s, {} lost races, {} retried errors".format(
+            len(claims), args.processes, elapsed, sum(o[1] for o in outcomes), sum(o[2] for o in outcomes)
+        ))
+        problems = check(args.users, args.devices, args.queues, claims)
+
+    for problem in problems:
+        print("FAIL", problem)
+    if problems:
+        sys.exit(1)
+    print("no double assignments")
+
+
+if __name__ == "__main__":
+    main()
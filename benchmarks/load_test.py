@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+"""
+End to end load test: simulated villagers and devices against a local server.
+
+The server is create_app() in a child process, one worker, on a scratch
+SQLite database. It is seeded with `--devices` devices and one queue.
+Nothing talks to a real tmate. The simulated devices post the webhooks tmate
+would post and hold a /device/controller socket each. The run goes like this:
+
+1. `--users` users sign up and log in, `--concurrency` at a time
+2. every user opens a /queue/event socket, the server's memory is compared
+   before and after to get the cost of a socket
+3. every device registers (session_register) and every user joins the queue
+4. a user that gets a new_device frame "connects" (session_join), keeps the
+   device for `--hold` seconds and is done (session_close). The device
+   registers again and goes to the next user. This runs until everybody was
+   served or `--seconds` ran out.
+5. one more user joins and the time until every socket got the queue_sizes
+   broadcast is measured
+
+    python3 benchmarks/load_test.py --users 2000 --devices 50
+
+Needs Linux for the memory numbers (/proc).
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import signal
+import sys
+import tempfile
+import time
+import types
+from base64 import b64encode
+from urllib.parse import urlencode
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), ".."))
+
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest
+from tornado.ioloop import IOLoop
+from tornado.websocket import websocket_connect
+
+QUEUE = 1
+
+
+def serve(path, devices, ready):
+    # the hashing pool forks workers of its own, a process group takes them down with the server
+    os.setpgrp()
+
+    # config.py is written by install.sh, the load test brings its own database
+    config = types.ModuleType("HardwareCheckout.config")
+    config.db_path = "sqlite:///" + path
+    config.ssl_config = {"certfile": "", "keyfile": ""}
+    # and a bus and leader lock of its own, away from a server running on this machine
+    config.runtime_dir = os.path.dirname(path)
+    sys.modules["HardwareCheckout.config"] = config
+
+    import logging
+    from tornado.httpserver import HTTPServer
+    from tornado.netutil import bind_sockets
+    from werkzeug.security import generate_password_hash
+
+    from HardwareCheckout import create_app
+    from HardwareCheckout.eventbus import bus
+    from HardwareCheckout.hashing import hasher
+    from HardwareCheckout.leader import leadership
+    from HardwareCheckout.metrics import registry
+    from HardwareCheckout.migrations import migrate
+    from HardwareCheckout.models import DeviceQueue, DeviceType, Role, db
+
+    db.create_all()
+    migrate()
+    with db.engine.begin() as connection:
+        connection.execute(Role.__table__.insert(), [{"name": name} for name in ("Human", "Device", "Admin")])
+        connection.execute(DeviceType.__table__.insert(), [{"id": QUEUE, "name": "car", "enabled": 1}])
+        # devices are checked on every webhook, keep their hashes cheap so the villagers are what is measured
+        connection.execute(DeviceQueue.__table__.insert(), [
+            {"id": i + 1, "name": "device%d" % i, "password": generate_password_hash("device%d" % i, method="pbkdf2:sha256:1000"),
+             "state": "want-provision", "type": QUEUE}
+            for i in range(devices)
+        ])
+    logging.getLogger("tornado.access").setLevel(logging.ERROR)
+
+    sockets = bind_sockets(0, "127.0.0.1")
+    HTTPServer(create_app()).add_sockets(sockets)
+    hasher.start()
+    bus.start()
+    leadership.start()
+    registry.start()
+    ready.send(sockets[0].getsockname()[1])
+    IOLoop.current().start()
+
+
+def rss(pid):
+    with open("/proc/{}/status".format(pid)) as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) * 1024
+    return 0
+
+
+def percentiles(values):
+    if not values:
+        return "n/a"
+    values = sorted(values)
+    pick = lambda q: values[min(int(len(values) * q), len(values) - 1)] * 1000
+    return "p50 {:.1f} ms, p90 {:.1f} ms, p99 {:.1f} ms, max {:.1f} ms ({} samples)".format(pick(0.5), pick(0.9), pick(0.99), values[-1] * 1000, len(values))
+
+
+class LoadTest:
+    def __init__(self, port, args):
+        self.url = "http://127.0.0.1:{}".format(port)
+        self.ws_url = "ws://127.0.0.1:{}".format(port)
+        self.args = args
+        self.http = None
+        self.cookies = {}
+        self.sockets = {}
+        self.controllers = []
+        self.joined = {}  # user -> when the join was posted
+        self.ready = {}  # device -> when it last registered
+        self.entities = {}  # device -> tmate session it registered last
+        self.served = set()
+        self.assignment = []
+        self.dispatch = []
+        self.rejected = 0
+        self.broadcast = None
+        self.fanout = []
+        self.tasks = []
+        self.done = asyncio.Event()
+
+    async def limited(self, jobs):
+        semaphore = asyncio.Semaphore(self.args.concurrency)
+
+        async def run(job):
+            async with semaphore:
+                await job
+
+        await asyncio.gather(*(run(job) for job in jobs))
+
+    async def post(self, path, body, cookie=None, headers=None):
+        headers = dict(headers or {})
+        if cookie:
+            headers["Cookie"] = cookie
+        return await self.http.fetch(self.url + path, method="POST", body=body, headers=headers, raise_error=False, follow_redirects=False)
+
+    async def signup(self, user):
+        body = urlencode({"name": "villager%d" % user, "password": "secret%d" % user})
+        for path in ("/signup", "/login"):
+            while True:
+                response = await self.post(path, body)
+                if response.code != 503:
+                    break
+                # the hashing pool sheds load, come back later like a person would
+                self.rejected += 1
+                await asyncio.sleep(0.2)
+        self.cookies[user] = response.headers.get_list("Set-Cookie")[0].split(";")[0]
+
+    async def connect(self, user):
+        socket = await websocket_connect(HTTPRequest(self.ws_url + "/queue/event", headers={"Cookie": self.cookies[user]}))
+        self.sockets[user] = socket
+        self.tasks.append(asyncio.ensure_future(self.listen(user, socket)))
+
+    async def listen(self, user, socket):
+        while True:
+            message = await socket.read_message()
+            if message is None:
+                return
+            now = time.perf_counter()
+            message = json.loads(message)
+            if message["type"] == "queue_sizes" and self.broadcast is not None:
+                self.fanout.append(now - self.broadcast)
+            elif message["type"] == "new_device" and user in self.joined and user not in self.served:
+                self.served.add(user)
+                device = message["device"]["id"]
+                self.assignment.append(now - self.joined[user])
+                if device in self.ready:
+                    self.dispatch.append(now - self.ready.pop(device))
+                self.tasks.append(asyncio.ensure_future(self.use(device)))
+                if len(self.served) == len(self.cookies):
+                    self.done.set()
+
+    def hook(self, device, kind, params):
+        name = "device%d" % (device - 1)
+        if kind == "session_register":
+            # tmate starts a new session, with a new entity id, every time the device provisions
+            self.entities[device] = "entity-{}-{}".format(device, len(self.served))
+        body = json.dumps({
+            "type": kind,
+            "entity_id": self.entities[device],
+            "userdata": b64encode("{}={}".format(name, name).encode()).decode(),
+            "params": params,
+        })
+        return self.post("/device/hook", body)
+
+    async def register(self, device):
+        token = "token{}x{}".format(device, len(self.served))
+        self.ready[device] = time.perf_counter()
+        await self.hook(device, "session_register", {
+            "ssh_cmd_fmt": "ssh %s@tmate.invalid", "web_url_fmt": "https://tmate.invalid/t/%s",
+            "stoken": token, "stoken_ro": "ro" + token,
+        })
+
+    async def use(self, device):
+        await self.hook(device, "session_join", {"readonly": False})
+        await asyncio.sleep(self.args.hold)
+        await self.hook(device, "session_close", {})
+        await self.register(device)
+
+    async def controller(self, device):
+        name = "device%d" % (device - 1)
+        auth = "Basic " + b64encode("{}:{}".format(name, name).encode()).decode()
+        socket = await websocket_connect(HTTPRequest(self.ws_url + "/device/controller", headers={"Authorization": auth}))
+        socket.write_message(json.dumps({"type": "register", "params": name}))
+        self.controllers.append(socket)
+
+    async def join(self, user):
+        self.joined[user] = time.perf_counter()
+        await self.post("/queue/{}".format(QUEUE), "", self.cookies[user])
+
+    async def run(self, server):
+        args = self.args
+        AsyncHTTPClient.configure(None, max_clients=args.concurrency)
+        self.http = AsyncHTTPClient()
+        users = range(args.users)
+        devices = range(1, args.devices + 1)
+
+        start = time.perf_counter()
+        await self.limited([self.signup(user) for user in users])
+        elapsed = time.perf_counter() - start
+        print("signup and login   {:.0f} users/s ({} users in {:.1f} s, {} turned away by the hashing pool)".format(
+            args.users / elapsed, args.users, elapsed, self.rejected))
+
+        before = rss(server)
+        start = time.perf_counter()
+        await self.limited([self.connect(user) for user in users])
+        elapsed = time.perf_counter() - start
+        await asyncio.sleep(1)
+        print("queue sockets      {:.0f} opened/s, {:.1f} KiB of server memory each".format(
+            args.users / elapsed, (rss(server) - before) / args.users / 1024))
+
+        before = rss(server)
+        await self.limited([self.controller(device) for device in devices])
+        print("controller sockets {} open, {:.1f} KiB of server memory each".format(
+            len(self.controllers), (rss(server) - before) / max(len(self.controllers), 1) / 1024))
+
+        start = time.perf_counter()
+        await self.limited([self.register(device) for device in devices])
+        await self.limited([self.join(user) for user in users])
+        elapsed = time.perf_counter() - start
+        print("register and join  {:.0f} requests/s".format((args.users + args.devices) / elapsed))
+
+        try:
+            await asyncio.wait_for(self.done.wait(), args.seconds)
+        except asyncio.TimeoutError:
+            pass
+        elapsed = time.perf_counter() - start
+        print("assignments        {} of {} users served in {:.1f} s, {:.1f} sessions/s".format(
+            len(self.served), args.users, elapsed, len(self.served) / elapsed))
+        print("enqueue to device  " + percentiles(self.assignment))
+        print("ready to device    " + percentiles(self.dispatch))
+
+        # everybody is listening for queue_sizes, one more join makes the leader broadcast it
+        await asyncio.sleep(1)
+        extra = args.users
+        await self.signup(extra)
+        self.fanout = []
+        self.broadcast = time.perf_counter()
+        await self.post("/queue/{}".format(QUEUE), "", self.cookies[extra])
+        await asyncio.sleep(2)
+        print("broadcast fan-out  " + percentiles(self.fanout))
+
+        for socket in list(self.sockets.values()) + self.controllers:
+            socket.close()
+        for task in self.tasks:
+            task.cancel()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--devices", type=int, default=20)
+    parser.add_argument("--concurrency", type=int, default=64, help="requests the villagers have in flight at once")
+    parser.add_argument("--hold", type=float, default=0.2, help="seconds a villager keeps a device")
+    parser.add_argument("--seconds", type=float, default=120, help="give up on serving everybody after this long")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        receive, send = multiprocessing.Pipe(duplex=False)
+        server = multiprocessing.get_context("fork").Process(target=serve, args=(os.path.join(directory, "load.db"), args.devices, send))
+        server.start()
+        port = receive.recv()
+        try:
+            IOLoop.current().run_sync(lambda: LoadTest(port, args).run(server.pid))
+        finally:
+            os.killpg(server.pid, signal.SIGKILL)
+            server.join()
+
+
+if __name__ == "__main__":
+    main()
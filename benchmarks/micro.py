@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+"""
+Microbenchmarks of the in-process hot paths, written out as JSON to compare releases.
+
+Everything runs in this process against a scratch SQLite database, so the
+numbers are CPU cost and the hop to the query threads, and nothing else:
+
+waiters.broadcast       one message to every socket of `--waiters` users
+waiter_bucket.send      one message to one user among `--waiters`
+blueprint.publish       building the URLSpecs of a blueprint with 10 routes
+get_owned_devices       the devices query of the front page and the queue socket
+snapshot.queries        every query of MainHandler.parts, the front page snapshot
+dispatch.claim          taking the oldest waiter and a free device, rolled back
+session_register        DeviceStateHandler.handle_session_register with cached credentials
+timer.once/repeat       creating and stopping a webutil.Timer
+timing_wheel.arm        arming and cancelling a deadline on a started TimingWheel
+
+The database ones run at every `--rows` users, with a tenth as many devices.
+
+    python3 benchmarks/micro.py --output before.json
+    python3 benchmarks/micro.py --output after.json --compare before.json
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import types
+from base64 import b64encode
+from inspect import isawaitable
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), ".."))
+
+# config.py is written by install.sh, the benchmark brings its own database.
+# Not sqlite://, every connection to that is a database of its own and the queries run on several threads.
+scratch = tempfile.TemporaryDirectory()
+config = types.ModuleType("HardwareCheckout.config")
+config.db_path = "sqlite:///" + os.path.join(scratch.name, "micro.db")
+config.slow_query_ms = 60000
+config.ssl_config = {"certfile": "", "keyfile": ""}
+sys.modules["HardwareCheckout.config"] = config
+
+from tornado.ioloop import IOLoop
+from tornado.web import RequestHandler
+from werkzeug.security import generate_password_hash
+
+from HardwareCheckout.device import DeviceStateHandler
+from HardwareCheckout.dispatch import claim
+from HardwareCheckout.eventbus import Backend, bus
+from HardwareCheckout.main import MainHandler
+from HardwareCheckout.models import DeviceQueue, DeviceType, Identity, User, UserQueue, db
+from HardwareCheckout.timeouts import TimingWheel
+from HardwareCheckout.webutil import Blueprint, Timer, Waiters
+
+TYPES = 8
+
+
+class InProcess(Backend):
+    """
+    No other workers, published messages only reach this process.
+    """
+
+    def start(self, deliver):
+        pass
+
+    def publish(self, channel, message):
+        pass
+
+
+class Socket:
+    """
+    Stands in for a QueueWSHandler, takes the encoded frame like write_frame() does.
+    """
+
+    def send(self, frame):
+        return frame.data
+
+
+class Handler(RequestHandler):
+    pass
+
+
+class Suite:
+    def __init__(self, args):
+        self.args = args
+        self.results = []
+
+    async def measure(self, name, function, **params):
+        """
+        Call `function` (and await what it returns, if anything) often enough
+        to fill `--min-time`, keep the best of `--repeat` runs.
+        """
+        if self.args.only and not any(only in name for only in self.args.only):
+            return
+
+        async def run(number):
+            start = time.perf_counter()
+            for _ in range(number):
+                result = function()
+                if isawaitable(result):
+                    await result
+            return time.perf_counter() - start
+
+        number = 1
+        elapsed = await run(number)
+        while elapsed < self.args.min_time:
+            number = max(number * 2, int(number * self.args.min_time / max(elapsed, 1e-9) * 1.1))
+            elapsed = await run(number)
+        best = min([elapsed] + [await run(number) for _ in range(self.args.repeat - 1)])
+
+        result = {"name": name, "params": params, "number": number, "us_per_op": best / number * 1e6, "ops_per_second": number / best}
+        self.results.append(result)
+        print("{:<22} {:<14} {:>12.2f} us/op {:>12.0f} ops/s".format(
+            name, " ".join("{}={}".format(k, v) for k, v in params.items()), result["us_per_op"], result["ops_per_second"]
+        ))
+
+    async def waiters(self, count):
+        waiters = Waiters()
+        for user in range(count):
+            waiters[user].add(Socket())
+        sizes = {"type": "queue_sizes", "queues": {str(queue): 10 for queue in range(1, TYPES + 1)}}
+        device = {"type": "new_device", "device": {"id": 1, "name": "car", "sshAddr": "ssh x@tmate", "webUrl": "https://tmate/t/x"}}
+        await self.measure("waiters.broadcast", lambda: waiters.broadcast(sizes), waiters=count)
+        await self.measure("waiter_bucket.send", lambda: waiters[count // 2].send(device), waiters=count)
+
+    async def blueprint(self):
+        def publish():
+            # publish() fills in the patterns in place, every run needs a blueprint of its own
+            blueprint = Blueprint()
+            for route in range(10):
+                blueprint.route("/route{}/(\\d+)".format(route), name="route{}".format(route))(Handler)
+            return blueprint.publish("/base")
+
+        await self.measure("blueprint.publish", publish, routes=10)
+
+    def fill(self, rows):
+        db.drop_all()
+        db.create_all()
+        states = ["want-provision", "provisioned", "in-queue", "in-use", "deprovisioned"]
+        # devices are checked on every webhook, keep their hashes cheap so session_register is about the rest
+        password = generate_password_hash("device1", method="pbkdf2:sha256:1000")
+        with db.engine.begin() as connection:
+            connection.execute(DeviceType.__table__.insert(), [{"id": i, "name": "type%d" % i, "enabled": 1} for i in range(1, TYPES + 1)])
+            connection.execute(User.__table__.insert(), [{"id": i, "name": "user%d" % i, "password": "hash%d" % i, "ctf": i % 2} for i in range(1, rows + 1)])
+            connection.execute(UserQueue.__table__.insert(), [{"userId": i, "type": i % TYPES + 1} for i in range(1, rows + 1)])
+            connection.execute(DeviceQueue.__table__.insert(), [
+                {
+                    "id": i, "name": "device%d" % i, "password": password if i == 1 else "hash%d" % i,
+                    "state": states[i % len(states)], "type": i % TYPES + 1,
+                    "owner": i if states[i % len(states)] in ("in-queue", "in-use") else None,
+                    "webUrl": "https://tmate/t/%d" % i, "roUrl": "https://tmate/t/ro%d" % i,
+                }
+                for i in range(1, rows // 10 + 2)
+            ])
+
+    async def database(self, rows):
+        self.fill(rows)
+        session = db.sessionmaker()
+        try:
+            # an owner of an in-use device, see fill()
+            identity = Identity(3, "user3", 1, frozenset(["Human"]))
+            await self.measure("get_owned_devices", lambda: identity.get_owned_devices(session).all(), rows=rows)
+            await self.measure("snapshot.queries", lambda: [part(session) for part in MainHandler.parts.values()], rows=rows)
+        finally:
+            session.close()
+
+        def claim_once():
+            session = db.sessionmaker()
+            try:
+                # type 2 has provisioned devices (ids 1, 9, ...) and waiters, see fill()
+                return claim(session, 2)
+            finally:
+                session.rollback()
+                session.close()
+
+        await self.measure("dispatch.claim", claim_once, rows=rows)
+
+        userdata = b64encode(b"device1=device1").decode()
+        params = {"ssh_cmd_fmt": "ssh %s@tmate", "web_url_fmt": "https://tmate/t/%s", "stoken": "token", "stoken_ro": "ro"}
+        # the first one verifies the password, from then on it comes from device_credentials
+        await DeviceStateHandler.handle_session_register(None, "entity", userdata, params)
+        await self.measure("session_register", lambda: DeviceStateHandler.handle_session_register(None, "entity", userdata, params), rows=rows)
+
+    async def timers(self):
+        callback = lambda: None
+        await self.measure("timer.once", lambda: Timer(callback, repeat=False, timeout=60).stop())
+        await self.measure("timer.repeat", lambda: Timer(callback, repeat=True, timeout=60).stop())
+
+        wheel = TimingWheel()
+        wheel.started = True
+        keys = iter(range(1 << 62))
+
+        def arm():
+            # deadlines spread over an hour end up on every level of the wheel
+            key = "device:{}".format(next(keys) % 1000)
+            bus.deliver("timeouts.arm", {"key": key, "deadline": time.time() + hash(key) % 3600, "action": "return_device", "args": [1, "normal_timeout"]})
+            bus.deliver("timeouts.cancel", key)
+
+        await self.measure("timing_wheel.arm", arm, keys=1000)
+
+    async def run(self):
+        for count in self.args.waiters:
+            await self.waiters(count)
+        await self.blueprint()
+        for rows in self.args.rows:
+            await self.database(rows)
+        await self.timers()
+
+
+def revision():
+    try:
+        return subprocess.check_output(["git", "describe", "--always", "--dirty"], cwd=os.path.dirname(os.path.realpath(__file__)), stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, path):
+    with open(path) as f:
+        before = {(r["name"], json.dumps(r["params"], sort_keys=True)): r for r in json.load(f)["results"]}
+    print("\ncompared to {}".format(path))
+    for result in results:
+        old = before.get((result["name"], json.dumps(result["params"], sort_keys=True)))
+        if old is None:
+            continue
+        print("{:<22} {:<14} {:>12.2f} -> {:.2f} us/op, {:+.1f}%".format(
+            result["name"], " ".join("{}={}".format(k, v) for k, v in result["params"].items()),
+            old["us_per_op"], result["us_per_op"], (result["us_per_op"] / old["us_per_op"] - 1) * 100
+        ))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--waiters", type=int, nargs="+", default=[10, 1000, 10000])
+    parser.add_argument("--rows", type=int, nargs="+", default=[100, 1000, 10000])
+    parser.add_argument("--min-time", type=float, default=0.2, help="seconds every run of a benchmark takes at least")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--only", nargs="+", help="only run benchmarks whose name contains one of these")
+    parser.add_argument("--output", help="write the results here as JSON")
+    parser.add_argument("--compare", help="a JSON file from an earlier run to compare with")
+    args = parser.parse_args()
+
+    bus.configure(InProcess())
+    suite = Suite(args)
+    IOLoop.current().run_sync(suite.run)
+
+    document = {
+        "revision": revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "min_time": args.min_time,
+        "repeat": args.repeat,
+        "results": suite.results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(document, f, indent=2)
+    if args.compare:
+        compare(suite.results, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""
+Query plans and latency of the hot lookups before and after the migrations.
+
+For every row count a scratch SQLite database is built from models.py with
+the migrated indexes dropped again, as a database deployed before them would
+look. It is filled with users, queue entries and devices, every hot query is
+timed and explained, then migrations.migrate() is run and the same is done again.
+
+    python3 benchmarks/query_plans.py --rows 1000 10000 100000
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+import types
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), ".."))
+
+# config.py is written by install.sh, the benchmark brings its own database
+config = types.ModuleType("HardwareCheckout.config")
+config.db_path = "sqlite://"
+config.ssl_config = {"certfile": "", "keyfile": ""}
+sys.modules["HardwareCheckout.config"] = config
+
+from sqlalchemy import create_engine, or_, text
+from sqlalchemy.orm import sessionmaker
+
+from HardwareCheckout.migrations import MIGRATIONS, migrate
+from HardwareCheckout.models import DeviceQueue, DeviceType, User, UserQueue, db
+
+TYPES = 8
+
+
+def build(path, rows):
+    engine = create_engine("sqlite:///" + path)
+    db.Model.metadata.create_all(engine)
+    for model in (User, UserQueue, DeviceQueue):
+        for index in model.__table__.indexes:
+            index.drop(bind=engine)
+
+    users = [{"id": i, "name": "user%d" % i, "password": "hash%d" % i, "ctf": i % 2} for i in range(1, rows + 1)]
+    states = ["want-provision", "provisioned", "in-queue", "in-use", "deprovisioned"]
+    devices = [
+        {
+            "id": i, "name": "device%d" % i, "password": "device%d" % i, "state": states[i % len(states)],
+            "type": i % TYPES + 1, "owner": i if states[i % len(states)] in ("in-queue", "in-use") else None,
+            "webUrl": "https://example/%d" % i, "roUrl": "https://example/ro%d" % i,
+        }
+        for i in range(1, rows // 10 + 2)
+    ]
+    with engine.begin() as connection:
+        connection.execute(DeviceType.__table__.insert(), [{"id": i, "name": "type%d" % i, "enabled": 1} for i in range(1, TYPES + 1)])
+        connection.execute(User.__table__.insert(), users)
+        connection.execute(UserQueue.__table__.insert(), [{"userId": i, "type": i % TYPES + 1} for i in range(1, rows + 1)])
+        connection.execute(DeviceQueue.__table__.insert(), devices)
+    return engine
+
+
+def queries(rows):
+    user = rows // 2
+    return {
+        "login": lambda s: s.query(User.id, User.password).filter_by(name="user%d" % user),
+        "next in queue": lambda s: s.query(UserQueue.id, UserQueue.userId).filter_by(type=3).order_by(UserQueue.id).limit(1),
+        "leave queue": lambda s: s.query(UserQueue.id).filter_by(userId=user),
+        "free devices": lambda s: s.query(DeviceQueue.id, DeviceQueue.type).filter_by(state="provisioned").order_by(DeviceQueue.id),
+        "owned devices": lambda s: s.query(DeviceType.name, DeviceQueue.sshAddr, DeviceQueue.webUrl, DeviceQueue.id).join(DeviceType).filter(
+            or_(DeviceQueue.state == "in-queue", DeviceQueue.state == "in-use"), DeviceQueue.owner == 4
+        ),
+        "terminals": lambda s: s.query(User.name, DeviceQueue.roUrl).join(User.deviceQueueEntry).filter(DeviceQueue.state == "in-use").filter(User.ctf == 0),
+    }
+
+
+def measure(engine, rows, repeat):
+    session = sessionmaker(bind=engine)()
+    results = {}
+    for name, make in queries(rows).items():
+        query = make(session)
+        statement = query.statement.compile(engine, compile_kwargs={"literal_binds": True})
+        plan = [row[-1] for row in session.execute(text("EXPLAIN QUERY PLAN " + str(statement)))]
+        start = time.perf_counter()
+        for _ in range(repeat):
+            query.all()
+        results[name] = ((time.perf_counter() - start) / repeat * 1000, plan)
+    session.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rows", type=int, nargs="+", default=[1000, 10000, 100000], help="users and queue entries, devices are a tenth of that")
+    parser.add_argument("--repeat", type=int, default=50, help="runs of every query")
+    args = parser.parse_args()
+
+    for rows in args.rows:
+        with tempfile.TemporaryDirectory() as directory:
+            engine = build(os.path.join(directory, "bench.db"), rows)
+            before = measure(engine, rows, args.repeat)
+            migrate(engine)
+            after = measure(engine, rows, args.repeat)
+            engine.dispose()
+
+        print("\n{} rows, schema version {}".format(rows, MIGRATIONS[-1][0]))
+        print("{:<15} {:>12} {:>12}".format("query", "before ms", "after ms"))
+        for name in before:
+            print("{:<15} {:>12.3f} {:>12.3f}".format(name, before[name][0], after[name][0]))
+            for label, (_, plan) in (("before", before[name]), ("after", after[name])):
+                print("    {:<7} {}".format(label, " | ".join(plan)))
+
+
+if __name__ == "__main__":
+    main()
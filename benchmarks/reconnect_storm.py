@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+"""
+Restarts a stand-in server under `--controllers` tmate controllers and checks they recover.
+
+The stand-in speaks the controller protocol of device.ControllerHandler and
+nothing else. Every controller is a tmate/controller.py Client with a few
+devices. Its commands sleep for `--command-seconds` instead of running pkill.
+Once every controller is registered, each gets a batch of commands and the
+server goes down while they run. It comes back `--downtime` seconds later.
+
+Then every controller must have reconnected, re-registered all its devices
+with replace set, and acknowledged every command of the batch, including the
+ones that finished while the server was down. The peak reconnects per 100 ms
+shows how well the backoff spreads the herd, --no-jitter shows it without.
+Exits non-zero if anything is off.
+
+    python3 benchmarks/reconnect_storm.py --controllers 200
+    python3 benchmarks/reconnect_storm.py --controllers 200 --no-jitter
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+from collections import Counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "tmate"))
+
+from tornado.httpserver import HTTPServer
+from tornado.netutil import bind_sockets
+from tornado.web import Application
+from tornado.websocket import WebSocketHandler
+
+import controller
+
+DEVICES = 3
+
+
+class StandInController(WebSocketHandler):
+    """
+    Records what every controller registers and acknowledges.
+    """
+
+    def initialize(self, state):
+        self.state = state
+
+    def open(self):
+        self.state["sockets"].add(self)
+        self.state["connects"].append(time.perf_counter())
+        self.name = None
+
+    def on_message(self, message):
+        data = json.loads(message)
+        if data["type"] == "register_many":
+            params = data["params"]
+            if params.get("replace"):
+                self.name = params["add"][0].split("-")[0] if params["add"] else None
+                self.state["registered"][self.name] = set(params["add"])
+                self.state["resyncs"][self.name] += 1
+            else:
+                self.state["registered"][self.name].update(params["add"])
+                self.state["registered"][self.name].difference_update(params["remove"])
+        elif data["type"] == "received":
+            self.state["received"].update(data["ids"])
+        elif data["type"] == "ack":
+            self.state["acked"][data["id"]] = data
+
+    def on_close(self):
+        self.state["sockets"].discard(self)
+
+
+class Client(controller.Client):
+    def __init__(self, *args, command_seconds, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.command_seconds = command_seconds
+
+    async def kill(self, device, session=None, keep=None, ended=False):
+        await asyncio.sleep(self.command_seconds)
+        return 0
+
+
+def start_server(port, state):
+    app = Application([("/device/controller", StandInController, {"state": state})])
+    server = HTTPServer(app)
+    server.add_sockets(bind_sockets(port, "127.0.0.1"))
+    return server
+
+
+async def wait_for(condition, seconds):
+    deadline = time.perf_counter() + seconds
+    while not condition():
+        if time.perf_counter() > deadline:
+            return False
+        await asyncio.sleep(0.05)
+    return True
+
+
+def peak(times, start):
+    buckets = Counter(int((t - start) * 10) for t in times)
+    return max(buckets.values()) if buckets else 0
+
+
+async def storm(args):
+    state = {"sockets": set(), "connects": [], "registered": {}, "resyncs": Counter(), "received": set(), "acked": {}}
+    sockets = bind_sockets(0, "127.0.0.1")
+    port = sockets[0].getsockname()[1]
+    for sock in sockets:
+        sock.close()
+    server = start_server(port, state)
+
+    clients = []
+    for number in range(args.controllers):
+        name = "c{}".format(number)
+        client = Client(
+            "ws://127.0.0.1:{}/device/controller".format(port), name, "secret", {},
+            base_delay=args.base_delay, max_delay=args.max_delay, command_seconds=args.command_seconds,
+        )
+        client.jitter = not args.no_jitter
+        client.devices = set("{}-device{}".format(name, device) for device in range(DEVICES))
+        clients.append(client)
+    tasks = [asyncio.ensure_future(client.run()) for client in clients]
+
+    problems = []
+    if not await wait_for(lambda: len(state["registered"]) == len(clients), 30):
+        problems.append("only {} of {} controllers registered".format(len(state["registered"]), len(clients)))
+        return problems
+
+    commands = {}
+    for socket in list(state["sockets"]):
+        batch = [{"id": "{}-{}".format(socket.name, device), "type": "restart", "params": device} for device in sorted(state["registered"][socket.name])]
+        commands.update((command["id"], socket.name) for command in batch)
+        socket.write_message(json.dumps({"type": "commands", "commands": batch}))
+    await wait_for(lambda: set(commands) <= state["received"], 10)
+
+    # down while the commands run, so some acks have to wait for the next connection
+    server.stop()
+    for socket in list(state["sockets"]):
+        socket.close()
+    down = time.perf_counter()
+    state["connects"] = []
+    await asyncio.sleep(args.downtime)
+    up = time.perf_counter()
+    server = start_server(port, state)
+
+    back = await wait_for(lambda: len(state["connects"]) >= len(clients) and set(commands) <= set(state["acked"]), args.downtime + 4 * args.max_delay)
+    elapsed = time.perf_counter() - up
+    print("{} controllers back {:.2f} s after the server, peak {} reconnects in 100 ms, {} connects in all".format(
+        len(set(s.name for s in state["sockets"])), elapsed, peak(state["connects"], down), len(state["connects"])))
+    print("{} of {} commands acknowledged".format(len(set(commands) & set(state["acked"])), len(commands)))
+
+    if not back:
+        problems.append("not every controller reconnected and acknowledged in time")
+    missing = [name for name in state["registered"] if state["resyncs"][name] < 2]
+    if missing:
+        problems.append("{} controllers did not resync".format(len(missing)))
+    wrong = [client.username for client in clients if state["registered"].get(client.username) != client.devices]
+    if wrong:
+        problems.append("{} controllers registered the wrong devices".format(len(wrong)))
+    lost = set(commands) - set(state["acked"])
+    if lost:
+        problems.append("{} commands never acknowledged".format(len(lost)))
+
+    for task in tasks:
+        task.cancel()
+    server.stop()
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--controllers", type=int, default=100)
+    parser.add_argument("--downtime", type=float, default=2, help="seconds the server is down")
+    parser.add_argument("--command-seconds", type=float, default=1, help="how long every command runs")
+    parser.add_argument("--base-delay", type=float, default=0.5)
+    parser.add_argument("--max-delay", type=float, default=8)
+    parser.add_argument("--no-jitter", action="store_true", help="back off by the full delay, like without the jitter")
+    args = parser.parse_args()
+
+    problems = asyncio.run(storm(args))
+    for problem in problems:
+        print("FAIL", problem)
+    if problems:
+        sys.exit(1)
+    print("every controller recovered")
+
+
+if __name__ == "__main__":
+    main()
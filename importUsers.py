@@ -0,0 +1,32 @@
+#!/usr/bin/env python3
+from HardwareCheckout.bulk import USER_COLUMNS, FORMATS, BulkImportError, add_users, hash_all, passwords, read_rows
+from HardwareCheckout.config import db_path
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from argparse import ArgumentParser
+import sys
+
+parser = ArgumentParser(description="Add users from an INI, CSV or JSON file with username, password and optionally roles and ctf")
+parser.add_argument("file", help="File containing the list of users")
+parser.add_argument("--format", choices=FORMATS, help="Format of the file, guessed from its contents by default")
+parser.add_argument("-r", "--roles", nargs="+", default=["Human"], help="Roles of users that do not name their own")
+args = parser.parse_args()
+
+session = sessionmaker(bind=create_engine(db_path))
+s = session()
+
+with open(args.file) as f:
+    try:
+        rows = read_rows(f.read(), USER_COLUMNS, args.format)
+    except BulkImportError as e:
+        print(e)
+        sys.exit(1)
+
+# hash everything up front across all cores, then insert in one transaction
+added, errors = add_users(s, rows, hash_all(passwords(rows)), default_roles=args.roles)
+s.commit()
+for error in errors:
+    print(error)
+print("Added {} of {} users".format(added, len(rows)))
+if errors:
+    sys.exit(1)
@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 from HardwareCheckout import create_app
 from HardwareCheckout.models import Role, db
+from HardwareCheckout.migrations import migrate
 from HardwareCheckout.config import db_path
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
@@ -19,6 +20,8 @@ if args.clean:
 
 try:
     db.create_all()
+    # a fresh database already has everything, just record that
+    migrate()
 
     session = sessionmaker(bind=create_engine(db_path))
     s = session()
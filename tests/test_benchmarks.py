@@ -0,0 +1,32 @@
+"""
+Runs the benchmarks that check a guarantee, at small sizes, and asserts they pass.
+
+    python3 -m pytest tests
+"""
+import os
+import subprocess
+import sys
+
+import pytest
+
+BENCHMARKS = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..", "benchmarks")
+
+
+def run(script, *args, timeout=120):
+    return subprocess.run(
+        [sys.executable, os.path.join(BENCHMARKS, script)] + list(args),
+        stdout=subprocess.PIPE, stderr=subprocess.STDOUT, timeout=timeout,
+    )
+
+
+def test_claim_race():
+    # nothing claimed twice and the database agrees
+    result = run("claim_race.py", "--processes", "4", "--users", "200", "--devices", "50", "--queues", "2")
+    assert result.returncode == 0, result.stdout.decode()
+
+
+def test_reconnect_storm():
+    # the controller needs inotify, which the server does not
+    pytest.importorskip("pyinotify")
+    result = run("reconnect_storm.py", "--controllers", "20", "--downtime", "0.5", "--command-seconds", "0.2", "--base-delay", "0.1", "--max-delay", "1")
+    assert result.returncode == 0, result.stdout.decode()
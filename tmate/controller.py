@@ -1,30 +1,71 @@
 #!/usr/bin/env python3
+"""
+Registers the tmate sessions of this machine with the server and runs the
+commands the server sends for them.
+
+Every session has a directory in /tmp/devices, watched with inotify on the
+asyncio loop, so nothing runs until a session comes or goes. On connect the
+whole set of devices is sent in one register_many message. Sessions created
+or removed after that are collected for `window` seconds and sent as one delta:
+
+    {"type": "register_many", "params": {"add": ["device0", ...], "remove": [], "replace": true}}
+    {"type": "register_many", "params": {"add": ["device7"], "remove": ["device3"]}}
+
+Client.run() keeps the connection up. A lost connection is retried after a
+random delay of up to `base_delay` * 2^attempt seconds, capped at `max_delay`,
+so the controllers of a restarted server do not all come back at once. Each
+connection has one websocket ping heartbeat, which closes it when the server
+stops answering. After a reconnect the full device set is sent again, along
+with the ids of commands still running and the acks that could not be sent.
+
+A device can run two tmate sessions: session@ as villager-<device> in
+/tmp/devices/<device>, and spare@ as spare-<device> in /tmp/spares/<device>.
+Neither user can reach the other's socket. A restart naming a session kills
+the processes of the user running it, the other session keeps running. When
+the server handed out the spare instead, its user's home is reset first.
+"""
+import asyncio
+import glob
 import os
+import pwd
+import random
 import re
+import time
 from configparser import ConfigParser
-import asyncore
 from base64 import b64encode
+from subprocess import DEVNULL, PIPE
 
 import pyinotify
-from tornado.ioloop import IOLoop, PeriodicCallback
-from tornado import gen
 from tornado.websocket import websocket_connect
 from tornado.escape import json_decode, json_encode
 from tornado.httpclient import HTTPRequest
-from tornado.process import Subprocess as subprocess
 
-ACTIVE_CLIENTS = {}
+DEVICES = "/tmp/devices"
+# spare@.service, a directory per device that only its spare user can enter
+SPARES = "/tmp/spares"
+# the server gives up on a command after this long, CommandChannel.timeout
+COMMAND_TIMEOUT = 60
 device_re = re.compile(r"^.*(device\d+)$")
 
-class Client(object):
-    devices = {}
 
-    def __init__(self, url, username, password, profiles, timeout = 300):
+class Client(object):
+    def __init__(self, url, username, password, profiles, heartbeat = 30, window = 0.1, base_delay = 1, max_delay = 60):
         self.url = url
         self.username = username
         self.password = password
-        self.timeout = timeout
+        self.heartbeat = heartbeat
         self.profiles = profiles
+        self.window = window
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = True
+        self.ws = None
+        self.devices = set()  # usernames of the devices with a session directory
+        self.added = set()  # changes since the last delta
+        self.removed = set()
+        self.flush_handle = None
+        self.running = dict()  # command id -> command, until it is acknowledged
+        self.unsent = dict()  # command id -> (finished, ack) for acks that found no connection
 
     def auth_header(self, username, password):
         return {
@@ -32,47 +73,67 @@ class Client(object):
             + b64encode((username + ":" + password).encode()).decode()
         }
 
-    async def connect(self):
-        print("trying to connect")
-        try:
-            self.ws = await websocket_connect(
-                HTTPRequest(url=self.url, headers=self.auth_header(self.username, self.password))
-            )
-
-            PeriodicCallback(self.keep_alive, self.timeout * 1000).start()
-            IOLoop.current().add_callback(self.recv_loop)
-
-            for files in os.listdir("/tmp/devices"):
-                full_path = os.path.join("/tmp/devices", files)
-                if os.path.isdir(full_path):
-                    await register_device(full_path, self, self.profiles)
-
-        except Exception:
-            print("connection error")
+    async def run(self):
+        """
+        Connect, and reconnect whenever the connection is lost, forever.
+        """
+        attempt = 0
+        while True:
+            try:
+                await self.connect()
+            except Exception as e:
+                attempt += 1
+                delay = self.backoff(attempt)
+                print("connection error: {}, retrying in {:.1f}s".format(e, delay))
+                await asyncio.sleep(delay)
+                continue
+
+            attempt = 0
+            await self.recv_loop(self.ws)
             self.ws = None
+            # most likely the server restarted and every other controller lost its connection too
+            delay = self.backoff(1)
+            print("connection lost, reconnecting in {:.1f}s".format(delay))
+            await asyncio.sleep(delay)
 
-        if self.ws is None:
-            raise Exception("ws is none. Idk what happened.")
+    def backoff(self, attempt):
+        delay = min(self.max_delay, self.base_delay * 2 ** attempt)
+        return random.uniform(0, delay) if self.jitter else delay
 
-    async def recv_loop(self):
+    async def connect(self):
+        print("trying to connect")
+        # tornado pings on the connection and closes it when the pongs stop coming
+        self.ws = await websocket_connect(
+            HTTPRequest(url=self.url, headers=self.auth_header(self.username, self.password)),
+            ping_interval=self.heartbeat,
+            ping_timeout=self.heartbeat * 2,
+        )
+        await self.resync()
+
+    async def resync(self):
+        """
+        Bring a new connection up to date. The server forgot this controller's
+        devices when the last socket closed and may still wait for commands.
+        """
+        self.added.clear()
+        self.removed.clear()
+        await self.send({"type": "register_many", "params": {"add": sorted(self.devices), "remove": [], "replace": True}})
+        if self.running:
+            await self.send({"type": "received", "ids": list(self.running)})
+        stale = time.monotonic() - COMMAND_TIMEOUT
+        for commandID, (finished, ack) in list(self.unsent.items()):
+            del self.unsent[commandID]
+            if finished > stale:
+                await self.send_ack(ack)
+
+    async def recv_loop(self, ws):
         while True:
-            msg = await self.ws.read_message()
+            msg = await ws.read_message()
             if msg is None:
                 break
             else:
                 await self.handle_message(msg)
 
-    async def keep_alive(self):
-        if self.ws is None:
-            await self.connect()
-        else:
-            print("Keep Alive")
-            try:
-                await self.ws.write_message(json_encode({"type": "keep-alive"}))
-            except Exception:
-                self.ws = None
-                IOLoop.current().add_callback(self.keep_alive)
-
     async def handle_message(self, message):
         try:
             data = json_decode(message)
@@ -84,39 +145,155 @@ class Client(object):
         if not msg_type:
             return
         elif msg_type == 'restart':
+            # servers from before acknowledged commands
             print("Got restart request for {}".format(params))
             await self.kill(params)
-
-    async def kill(self, device):
-        for keys in self.profiles:
-            if self.profiles[keys]["username"] == device:
-                deviceName = keys
-                break
-
-        p = subprocess(
-            ["pkill", "-u", "villager-" + deviceName], 
-            stdout = subprocess.STREAM, 
-            stderr = subprocess.STREAM
-            )
-
+        elif msg_type == 'commands':
+            commands = [command for command in data.get("commands", []) if isinstance(command, dict) and "id" in command]
+            # tell the server they got here before running anything, so it can tell a slow command from a lost one
+            await self.send({"type": "received", "ids": [command["id"] for command in commands]})
+            # all at once, and without holding up the messages behind them
+            for command in commands:
+                if command["id"] not in self.running:
+                    self.running[command["id"]] = command
+                    asyncio.ensure_future(self.run_command(command))
+
+    async def run_command(self, command):
+        """
+        Run one command of a batch and acknowledge it with its result and timing.
+        """
+        start = time.monotonic()
+        code, error = None, None
+        if command.get("type") == "restart":
+            print("Got restart request for {}".format(command.get("params")))
+            try:
+                code = await self.kill(command.get("params"), command.get("session"), command.get("keep"), command.get("ended", False))
+            except Exception as e:
+                error = str(e)
+        else:
+            error = "unknown command {}".format(command.get("type"))
+        del self.running[command["id"]]
+        await self.send_ack({
+            "type": "ack",
+            "id": command["id"],
+            # pkill exits with 1 when nothing matched, the session is gone either way
+            "ok": error is None and code in (0, 1),
+            "code": code,
+            "error": error,
+            "seconds": time.monotonic() - start,
+        })
+
+    async def send_ack(self, ack):
+        if not await self.send(ack):
+            # sent by resync() once there is a connection again
+            self.unsent[ack["id"]] = (time.monotonic(), ack)
+
+    async def send(self, message):
+        """
+        Returns whether the message went out.
+        """
+        if self.ws is None:
+            return False
         try:
-            await p.wait_for_exit()
+            await self.ws.write_message(json_encode(message))
         except Exception:
+            print("could not send {} to the server".format(message.get("type")))
             return False
         return True
 
-    async def register_device(self, device):
-        self.ws.write_message(json_encode({'type':"register", "params":device}))
-
+    async def kill(self, device, session = None, keep = None, ended = False):
+        """
+        Kill the processes of the device's users, returns pkill's exit code.
+        Without a session that is all of them. With one, those of the user running
+        it. `keep` is the spare session that took over, its user's home is reset
+        first and its processes are left alone. With `ended` the session is gone
+        already and its unit cleans up after it, only the home is reset. Raises
+        when `keep` is not running, the server must not hand it out.
+        """
+        deviceName = None
+        for keys in self.profiles:
+            if self.profiles[keys]["username"] == device:
+                deviceName = keys
+                break
+        if deviceName is None:
+            raise Exception("no profile for {}".format(device))
 
-class New_Device_Handler(pyinotify.ProcessEvent):
+        users = device_users(deviceName)
+        kept = None
+        if session is None and not ended:
+            targets = users
+        else:
+            live = await live_sessions(deviceName)
+            kept = live.get(keep)
+            if kept is not None:
+                await reset_home(kept)
+            if ended:
+                if keep is not None and kept is None:
+                    raise Exception("the session taking over is not running")
+                return 0
+            if session in live and live[session] != kept:
+                targets = [live[session]]
+            else:
+                # it cannot be told apart, leave nothing running that might be it
+                targets = [user for user in users if user != kept]
+
+        codes = []
+        for user in targets:
+            p = await asyncio.create_subprocess_exec("pkill", "-u", user, stdout=DEVNULL, stderr=DEVNULL)
+            codes.append(await p.wait())
+        if keep is not None and kept is None:
+            # whatever it was, it did not survive the pkill above
+            raise Exception("the session taking over is not running")
+        return 0 if 0 in codes else max(codes, default=1)
+
+    def device_added(self, device):
+        print("Registering new Client: {}".format(device))
+        self.devices.add(device)
+        self.removed.discard(device)
+        self.added.add(device)
+        self.schedule_flush()
+
+    def device_removed(self, device):
+        print("Unregistering Client: {}".format(device))
+        self.devices.discard(device)
+        self.added.discard(device)
+        self.removed.add(device)
+        self.schedule_flush()
+
+    def schedule_flush(self):
+        # a burst of sessions starting up goes out as one message
+        if self.flush_handle is None:
+            self.flush_handle = asyncio.get_event_loop().call_later(self.window, lambda: asyncio.ensure_future(self.flush()))
+
+    async def flush(self):
+        self.flush_handle = None
+        added, removed = self.added, self.removed
+        self.added, self.removed = set(), set()
+        # without a socket there is nothing to update, connect() sends everything
+        if added or removed:
+            await self.send({"type": "register_many", "params": {"add": sorted(added), "remove": sorted(removed)}})
+
+
+class DeviceWatcher(pyinotify.ProcessEvent):
     def my_init(self, client, profiles={}):
         self.client = client
         self.profiles = profiles
 
     def process_IN_CREATE(self, event):
-        print("New Device Created")
-        register_device(event.pathname, self.client, self.profiles)
+        if event.dir:
+            device = device_username(event.pathname, self.profiles)
+            if device is not None:
+                self.client.device_added(device)
+
+    def process_IN_DELETE(self, event):
+        if event.dir:
+            device = device_username(event.pathname, self.profiles)
+            if device is not None:
+                self.client.device_removed(device)
+
+    # a directory moved in or out counts the same
+    process_IN_MOVED_TO = process_IN_CREATE
+    process_IN_MOVED_FROM = process_IN_DELETE
 
 
 def get_profiles():
@@ -140,36 +317,84 @@ def get_profiles():
     return all_profiles
 
 
-async def register_device(path, client, profiles):
+def device_users(deviceName):
+    """
+    The users the device's sessions run as, the spare one where install.sh created it.
+    """
+    users = ["villager-" + deviceName]
+    try:
+        pwd.getpwnam("spare-" + deviceName)
+        users.append("spare-" + deviceName)
+    except KeyError:
+        pass
+    return users
+
+
+async def live_sessions(deviceName):
+    """
+    The ssh command of every tmate session the device runs, with the user it runs as.
+    """
+    sessions = dict()
+    sockets = glob.glob(os.path.join(DEVICES, deviceName, "*.sock")) + glob.glob(os.path.join(SPARES, deviceName, "*.sock"))
+    for socket in sockets:
+        p = await asyncio.create_subprocess_exec(
+            "tmate", "-S", socket, "display", "-p", "#{tmate_ssh}", stdout=PIPE, stderr=DEVNULL
+        )
+        out, _ = await p.communicate()
+        # a socket left behind by a session that is gone
+        if p.returncode != 0 or not out.strip():
+            continue
+        try:
+            sessions[out.decode().strip()] = pwd.getpwuid(os.stat(socket).st_uid).pw_name
+        except (OSError, KeyError):
+            continue
+    return sessions
+
+
+async def reset_home(user):
+    """
+    Empty the user's home like .bashrc does in CTF mode, what install.sh made immutable stays.
+    """
+    p = await asyncio.create_subprocess_exec(
+        "su", user, "-s", "/bin/bash", "-c", "rm -rf ~/.* ~/* 2>/dev/null", stdout=DEVNULL, stderr=DEVNULL
+    )
+    # rm fails on the immutable files, the rest is gone anyway
+    await p.wait()
+
+
+def device_username(path, profiles):
+    """
+    The username of the device whose session directory is `path`, None if it is not one of ours.
+    """
     matches = device_re.match(path)
     if matches:
-        profile_name = matches.group(1)
-
-        clientProfile = profiles.get(profile_name, False)
+        clientProfile = profiles.get(matches.group(1), False)
         if clientProfile:
-            print("Registering new Client: {}".format(clientProfile['username']))
-            await client.register_device(clientProfile['username'])
-            
+            return clientProfile['username']
+    return None
 
 
 async def main():
     profiles = get_profiles()
 
     newClient = Client("wss://localhost:8080/device/controller", profiles['controller']["username"], profiles['controller']["password"], profiles)
-    await newClient.connect()
 
-    # Create the watch manager
+    # watch before listing, so a session started in between is not missed
     watch_manager = pyinotify.WatchManager()
-
-    # TODO do we need event_notifier?
-    event_notifier = pyinotify.TornadoAsyncNotifier(
-        watch_manager, IOLoop.current(), New_Device_Handler(client=newClient, profiles=profiles)
+    notifier = pyinotify.AsyncioNotifier(
+        watch_manager, asyncio.get_event_loop(), default_proc_fun=DeviceWatcher(client=newClient, profiles=profiles)
     )
-    watch_manager.add_watch("/tmp/devices", pyinotify.IN_CREATE)
+    watch_manager.add_watch(DEVICES, pyinotify.IN_CREATE | pyinotify.IN_DELETE | pyinotify.IN_MOVED_TO | pyinotify.IN_MOVED_FROM)
+    for name in os.listdir(DEVICES):
+        device = device_username(os.path.join(DEVICES, name), profiles)
+        if device is not None and os.path.isdir(os.path.join(DEVICES, name)):
+            newClient.devices.add(device)
 
-    # event_notifier.stop()
+    try:
+        await newClient.run()
+    finally:
+        notifier.stop()
 
 
 if __name__ == "__main__":
-    IOLoop.current().add_callback(main)
-    IOLoop.current().start()
+    asyncio.run(main())
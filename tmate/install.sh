@@ -13,6 +13,12 @@ if test -z "$NUM_SESSIONS"; then
     NUM_SESSIONS=6
 fi
 
+# a second tmate session per device, handed out as soon as the first one is returned.
+# It runs as spare-device<n>, a user of its own the villager on the device cannot reach.
+if test -z "$SPARE_SESSIONS"; then
+    SPARE_SESSIONS="$(which true)"
+fi
+
 if test -z "$CTF_MODE"; then
     CTF_MODE="$(which true)"
 fi
@@ -20,6 +26,9 @@ fi
 UNAMES=""
 for i in $( seq 0 $((${NUM_SESSIONS} - 1)) ); do
     UNAMES="${UNAMES} villager-device$i "
+    if ${SPARE_SESSIONS}; then
+        UNAMES="${UNAMES} spare-device$i "
+    fi
 done
 
 HOSTNAME="$(hostname)"
@@ -139,7 +148,11 @@ sed -i.bak "s|localhost:8000|$1|g" $SCRIPTPATH/.tmate.conf
 if [ -f $SCRIPTPATH/session.target.bak ]; then
     mv $SCRIPTPATH/session.target.bak  $SCRIPTPATH/session.target
 fi
-sed -i.bak "s/controller.service/controller.service $(echo $(for i in $(seq 0 $((NUM_SESSIONS-1))); do echo session@device$i.service; done))/" $SCRIPTPATH/session.target
+SESSION_UNITS="$(for i in $(seq 0 $((NUM_SESSIONS-1))); do echo session@device$i.service; done)"
+if ${SPARE_SESSIONS}; then
+    SESSION_UNITS="${SESSION_UNITS} $(for i in $(seq 0 $((NUM_SESSIONS-1))); do echo spare@device$i.service; done)"
+fi
+sed -i.bak "s/controller.service/controller.service $(echo ${SESSION_UNITS})/" $SCRIPTPATH/session.target
 
 for name in $UNAMES; do
     prep_user $name
@@ -181,7 +194,7 @@ sudo install -m 755 $SCRIPTPATH/controller.py $APP_PATH/
 
 if [[ "${INIT}" == "systemd" ]]; then
     #TODO: generate contents of session@.service based on NUM_SESSIONS
-    sudo install -m 644 $SCRIPTPATH/{session.target,session@.service,controller.service} /etc/systemd/system/ || die "couldn't install systemd stuff"
+    sudo install -m 644 $SCRIPTPATH/{session.target,session@.service,spare@.service,controller.service} /etc/systemd/system/ || die "couldn't install systemd stuff"
     sudo systemctl daemon-reload || die "couldn't daemon-reload"
     sudo systemctl start session.target || die "couldn't start session.target"
     sudo systemctl enable session.target || die "couldn't enable session.target"